@@ -0,0 +1,38 @@
+# Move the monthly partitions of an SQLite database that end before a date into its read-only archive database.
+#
+#   python archive.py --before 2024-01-01 --database database.db --archive archive.db
+#
+# The server only reads which partitions are archived when it starts, so it has to be stopped while archiving and started
+# again afterwards. Archiving refuses to start while a server has the database open.
+import argparse
+import calendar
+import time
+import database
+
+
+def archive(database_path, before_time, archive_path="archive.db"):
+    """Archive the partitions of the SQLite database at database_path that end at or before before_time.
+
+    :return: names of the partitions that were archived
+    :raises RuntimeError: if a server has the database open, see :func:'~database.lock_database'"""
+    lock = database.lock_database(database_path, exclusive=True)
+    try:
+        storage = database.create_storage("sqlite", database_path=database_path, archive_path=archive_path)
+        try:
+            return storage.archive_partitions(before_time)
+        finally:
+            storage.close()
+    finally:
+        if lock is not None:
+            lock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move old months of sensor data into the read-only archive database.")
+    parser.add_argument("--before", required=True, help="UTC date as YYYY-MM-DD, months that end on or before it are archived")
+    parser.add_argument("--database", default="database.db", help="SQLite database file to archive from")
+    parser.add_argument("--archive", default="archive.db", help="database file that archived months are moved to")
+    arguments = parser.parse_args()
+    before_time = calendar.timegm(time.strptime(arguments.before, "%Y-%m-%d"))
+    names = archive(arguments.database, before_time, arguments.archive)
+    print(f"Archived {len(names)} partitions: {', '.join(names)}" if names else "Nothing to archive")
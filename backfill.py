@@ -0,0 +1,197 @@
+# Re-ingest replay logs into a database, for example to rebuild it after a schema change or a decoder fix.
+#
+#   python backfill.py replay_logs/ --database rebuilt.db
+#
+# Uploads are decoded by a pool of processes and their rows are written straight to the storage backend, without the
+# ingest queue, the batch writer, the replay log or notifications. The number of lines read from each file is recorded in a
+# checkpoint file after every write, so an interrupted backfill continues where it stopped. Rows that are already stored are
+# ignored, so reading a line twice never duplicates data.
+#
+# The server only reads which monthly tables exist and the latest values when it starts, so it has to be stopped while
+# backfilling and started again afterwards. Backfilling refuses to start while a server has the database open.
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+import database
+import encoded_data
+import error_logger
+import replay_log
+from hive_data import DataBatch
+
+logger = logging.getLogger(__name__)
+
+
+def log_files(paths):
+    """Return the replay log files in paths, each either a file or a folder of logs, oldest lines of each log first."""
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        names = os.listdir(path)
+        for log_name in sorted({name.split(".")[0] for name in names}):
+            # Legacy logs, then compressed segments, then rotated and active files, the order they were written in.
+            segments = sorted((name for name in names if name.startswith(log_name + ".") and name.endswith(replay_log.SEGMENT_EXTENSION)),
+                              key=lambda name: int(name.split(".")[1]))
+            rotated = sorted(name for name in names if name.startswith(log_name + ".") and name.count(".") == 2
+                             and name.endswith(replay_log.ACTIVE_EXTENSION))
+            for name in [log_name + replay_log.LEGACY_EXTENSION] + segments + rotated + [log_name + replay_log.ACTIVE_EXTENSION]:
+                if name in names:
+                    files.append(os.path.join(path, name))
+    return files
+
+
+def read_chunks(path, chunk_size, skip=0):
+    """Yield lists of at most chunk_size lines from a replay log file, after skipping the first skip lines."""
+    with (gzip.open(path, "rt") if path.endswith(".gz") else open(path)) as log_file:
+        chunk = []
+        for line_number, line in enumerate(log_file):
+            # The last line of an active file may still be being written.
+            if line_number < skip or not line.endswith("\n"):
+                continue
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def decode_lines(lines):
+    """Return a DataBatch of the rows in lines of a replay log, the number of lines that couldn't be decoded, and a list of
+    (error, serial_number, data) for each payload that couldn't be decoded.
+
+    Run in the worker processes, which leave logging the errors to the main process so that only it writes to the error log.
+    All the payloads in lines are decoded together by :func:'~encoded_data.decode_payloads' to use NumPy when it's installed."""
+    batch = DataBatch()
+    failed = 0
+    errors = []
+    uploads = []
+    payloads = set()
+    for line in lines:
+        try:
+            received_time, upload = replay_log.decode_line(line)
+            payloads.update(data for data in database.Database.payloads(upload) if isinstance(data, str))
+            uploads.append(upload)
+        except Exception:
+            failed += 1
+    payloads = list(payloads)
+    decoded = dict(zip(payloads, encoded_data.decode_payloads(payloads)))
+    for upload in uploads:
+        try:
+            serial_number, weather_station, hives = database.Database.decode(upload, errors, decoded)
+            for hive in hives.values():
+                batch.append(weather_station, hive)
+        except Exception:
+            failed += 1
+    return batch, failed, errors
+
+
+def first_line(path):
+    """Return the first line of a replay log file, which identifies it after the active file of a log has been rotated."""
+    with (gzip.open(path, "rt") if path.endswith(".gz") else open(path)) as log_file:
+        return log_file.readline()
+
+
+class Checkpoint:
+
+    def __init__(self, path):
+        """Number of lines read from each replay log file, saved in a JSON file at path.
+
+        :param path: file to save to, or None to not save progress"""
+        self.path = path
+        # [lines read, hash of the first line] by absolute path
+        self.lines = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self.lines = json.load(checkpoint_file)
+
+    def get(self, log_path, first_line):
+        """Return the number of lines read from a file, or 0 if a different file with that path was read."""
+        lines, first_line_hash = self.lines.get(os.path.abspath(log_path), (0, None))
+        return lines if first_line_hash == hashlib.sha1(first_line.encode()).hexdigest() else 0
+
+    def set(self, log_path, first_line, lines):
+        self.lines[os.path.abspath(log_path)] = (lines, hashlib.sha1(first_line.encode()).hexdigest())
+        if self.path is not None:
+            with open(self.path + ".tmp", "w") as checkpoint_file:
+                json.dump(self.lines, checkpoint_file)
+            os.replace(self.path + ".tmp", self.path)
+
+
+def backfill(paths, storage, checkpoint=None, workers=None, chunk_size=1000, progress_interval=5.0):
+    """Decode every line of the replay logs in paths and write their rows to storage.
+
+    :param paths: replay log files, or folders of them
+    :param storage: :class:'~storage.Storage' that rows are written to
+    :param checkpoint: :class:'~backfill.Checkpoint' used to skip lines that have already been read, or None to read everything
+    :param workers: number of decoding processes, the number of CPUs if None
+    :param int chunk_size: number of lines decoded and written together
+    :param float progress_interval: seconds between progress reports
+    :return: dictionary with the number of lines read, lines that failed and rows written"""
+    checkpoint = Checkpoint(None) if checkpoint is None else checkpoint
+    workers = os.cpu_count() if workers is None else workers
+    totals = {"lines": 0, "failed": 0, "rows": 0}
+    start_time = last_report = time.time()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        for path in log_files(paths):
+            path_first_line = first_line(path)
+            lines_done = checkpoint.get(path, path_first_line)
+            # Chunks are written in the order they were read, so the checkpoint never passes a line whose rows haven't been written.
+            # A few chunks per worker are decoded ahead of the writes, so a large file is never read into memory at once.
+            pending = collections.deque()
+            chunks = read_chunks(path, chunk_size, lines_done)
+            while True:
+                for lines in chunks:
+                    pending.append((len(lines), executor.submit(decode_lines, lines)))
+                    if len(pending) >= 2 * workers:
+                        break
+                if len(pending) == 0:
+                    break
+                line_count, future = pending.popleft()
+                batch, failed, errors = future.result()
+                for error in errors:
+                    error_logger.log_error(*error)
+                storage.write_rows(batch)
+                lines_done += line_count
+                checkpoint.set(path, path_first_line, lines_done)
+                totals["lines"] += line_count
+                totals["failed"] += failed
+                totals["rows"] += len(batch)
+                if time.time() - last_report >= progress_interval:
+                    last_report = time.time()
+                    logger.info("%s: %d lines, %.0f lines/s, %d rows written, %d lines failed", path, lines_done,
+                                totals["lines"] / (last_report - start_time), totals["rows"], totals["failed"])
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-ingest replay logs into a database.")
+    parser.add_argument("paths", nargs="+", help="replay log files, or folders of them")
+    parser.add_argument("--backend", default="sqlite", choices=sorted(database.STORAGE_BACKENDS))
+    parser.add_argument("--database", default=None, help="database file to write to, the backend's default if not given")
+    parser.add_argument("--checkpoint", default="backfill_checkpoint.json", help="file that progress is saved to and resumed from")
+    parser.add_argument("--workers", type=int, default=None, help="number of decoding processes, the number of CPUs by default")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="number of lines decoded and written together")
+    arguments = parser.parse_args()
+    logging.basicConfig(level="INFO", format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    storage_options = {} if arguments.database is None else {"database_path": arguments.database}
+    # Locked before the storage is created, since creating it can migrate the database.
+    lock = database.lock_database(database.storage_database_path(arguments.backend, **storage_options), exclusive=True)
+    try:
+        storage = database.create_storage(arguments.backend, **storage_options)
+        start_time = time.time()
+        try:
+            totals = backfill(arguments.paths, storage, Checkpoint(arguments.checkpoint), arguments.workers, arguments.chunk_size)
+        finally:
+            storage.close()
+    finally:
+        if lock is not None:
+            lock.close()
+    print(f"Finished: {totals['lines']} lines read, {totals['failed']} lines failed, {totals['rows']} rows written in {time.time() - start_time:.1f}s")
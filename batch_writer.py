@@ -0,0 +1,72 @@
+import threading
+import error_logger
+
+
+class BatchWriter:
+
+    def __init__(self, flush_method, batch_size=500, flush_interval=1.0, new_batch=list, max_pending=None):
+        """Collect rows from many uploads and write them together.
+
+        Rows are passed to flush_method by a background thread when batch_size rows are waiting or flush_interval seconds have passed since the first waiting row was added.
+        :param flush_method: method that will be passed the waiting rows to store in a single transaction
+        :param int batch_size: number of rows that triggers a flush
+        :param float flush_interval: maximum number of seconds a row waits before being flushed
+        :param new_batch: method that returns an empty container for rows, such as list or :class:'~hive_data.DataBatch'
+        :param int max_pending: number of waiting rows after which :func:'~batch_writer.BatchWriter.add' waits for a flush,
+                                four times batch_size if None"""
+        self.flush_method = flush_method
+        self.batch_size = batch_size
+        self.max_pending = 4 * batch_size if max_pending is None else max_pending
+        self.flush_interval = flush_interval
+        self.new_batch = new_batch
+        self.pending = new_batch()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="batch-writer", daemon=True)
+        self.thread.start()
+
+    def add(self, rows):
+        """Queue rows to be written in the next flush.
+
+        Waits while max_pending rows are waiting, so that when writes fall behind the ingest workers stop taking uploads
+        from the ingest queue, which fills up and rejects new uploads instead of memory growing without limit."""
+        if len(rows) == 0:
+            return
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.pending) < self.max_pending or self.closed)
+            self.pending.extend(rows)
+            self.condition.notify_all()
+
+    def flush(self):
+        """Write all waiting rows now."""
+        with self.flush_lock:
+            with self.condition:
+                rows, self.pending = self.pending, self.new_batch()
+                # Wakes callers of add that are waiting for room.
+                self.condition.notify_all()
+            if len(rows) == 0:
+                return
+            try:
+                self.flush_method(rows)
+            except Exception as e:
+                error_logger.log_error(e)
+
+    def close(self):
+        """Stop the background thread after writing all waiting rows."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0 and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                # Wait for the batch to fill up, but never longer than flush_interval.
+                self.condition.wait_for(lambda: len(self.pending) >= self.batch_size or self.closed, self.flush_interval)
+            self.flush()
@@ -0,0 +1,176 @@
+# Measure ingest and query performance against a database of synthetic Hawk data, to catch regressions before rollout.
+#
+#   python benchmark.py --serial-numbers 10 --hives 4 --rows-per-hive 50000 --uploads 2000 --json results.json
+#
+# The app is started in a temporary folder with its own config.yaml, so no existing database is touched. Uploads are sent
+# through the Flask test client to main.receive_json, and also passed straight to Database._process_data. Each measurement
+# reports the throughput, the 50th and 99th percentile latencies, and the peak memory used.
+import argparse
+import atexit
+import contextlib
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from hive_data import DataBatch, HiveData, WeatherStationData
+from synthetic import synthetic_upload
+
+
+def populate(storage, serial_numbers, hive_count, rows_per_hive, end_time, interval=600, batch_size=10000):
+    """Write rows_per_hive rows for each hive of each serial number, interval seconds apart and ending at end_time.
+
+    :return: number of rows written"""
+    batch = DataBatch()
+    written = 0
+    for serial_number in serial_numbers:
+        for row in range(rows_per_hive):
+            weather_station = WeatherStationData(serial_number, random.randint(30, 90), round(random.uniform(5, 30), 2))
+            for hive_number in range(1, hive_count + 1):
+                batch.append(weather_station, HiveData(hive_number, 25.0, 26.0, 27.0, 60, round(random.uniform(20, 80), 1), 0, 10, 12, 250,
+                                                       time=end_time - (rows_per_hive - row) * interval))
+            if len(batch) >= batch_size:
+                written += len(storage.write_rows(batch))
+                batch = DataBatch()
+    written += len(storage.write_rows(batch))
+    return written
+
+
+def percentile(sorted_values, fraction):
+    """Return the value at fraction of the way through a sorted list."""
+    if len(sorted_values) == 0:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class Measurement:
+
+    def __init__(self, name, trace_memory=False):
+        """Time each call made inside a with block, and the block as a whole.
+
+        :param bool trace_memory: if True, peak memory is measured with tracemalloc, which is slower but only counts this block.
+                                  Otherwise the peak resident set size of the process so far is reported"""
+        self.name = name
+        self.trace_memory = trace_memory
+        self.latencies = []
+        self.count = 0
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.start_time = time.perf_counter()
+        return self
+
+    def call(self, method, *args, count=1):
+        """Call method with args and record how long it took. count is the number of operations the call is counted as."""
+        start_time = time.perf_counter()
+        result = method(*args)
+        self.latencies.append(time.perf_counter() - start_time)
+        self.count += count
+        return result
+
+    def __exit__(self, *exception):
+        self.seconds = time.perf_counter() - self.start_time
+        if self.trace_memory:
+            self.peak_memory = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        else:
+            self.peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def result(self):
+        latencies = sorted(self.latencies)
+        return {"name": self.name, "count": self.count, "seconds": round(self.seconds, 4),
+                "per_second": round(self.count / self.seconds, 1) if self.seconds > 0 else None,
+                "p50_ms": round(percentile(latencies, 0.5) * 1000, 3), "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+                "peak_memory_kb": self.peak_memory}
+
+
+def run(arguments):
+    """Start the app in a temporary folder, fill its database and return a list of measurement results."""
+    directory = tempfile.mkdtemp(prefix="ibuzz-benchmark-")
+    # Registered before main is imported so that it runs after the database is closed.
+    atexit.register(shutil.rmtree, directory, True)
+    source_directory = os.path.dirname(os.path.abspath(__file__))
+    shutil.copytree(os.path.join(source_directory, "templates"), os.path.join(directory, "templates"))
+    with open(os.path.join(directory, "config.yaml"), "w") as config:
+        json.dump({"secret_key": "benchmark", "storage_backend": arguments.backend,
+                   "ingest_queue_size": arguments.uploads + 1, "ingest_worker_count": arguments.ingest_workers}, config)
+    os.chdir(directory)
+    sys.path.insert(0, source_directory)
+    random.seed(arguments.seed)
+    # Anything printed while the app runs, such as logged errors, would drown out the results.
+    quiet = open(os.devnull, "w")
+    with contextlib.redirect_stdout(quiet):
+        import main
+    db, client = main.db, main.app.test_client()
+    serial_numbers = list(range(100000, 100000 + arguments.serial_numbers))
+    end_time = int(time.time()) // 600 * 600 - 86400
+    results = []
+
+    with Measurement("populate (rows)", arguments.trace_memory) as measurement:
+        measurement.call(populate, db.storage, serial_numbers, arguments.hives, arguments.rows_per_hive, end_time,
+                         count=len(serial_numbers) * arguments.hives * arguments.rows_per_hive)
+    results.append(measurement.result())
+
+    # Every upload is a new reading, so none of them are ignored as duplicates.
+    uploads = [synthetic_upload(random.choice(serial_numbers), end_time + (i + 1) * 10, arguments.hives, flat=i % 2 == 1)
+               for i in range(2 * arguments.uploads)]
+    with contextlib.redirect_stdout(quiet):
+        with Measurement("ingest: POST / (uploads)", arguments.trace_memory) as measurement:
+            for upload in uploads[:arguments.uploads]:
+                response = measurement.call(lambda: client.post("/", json=upload))
+                if response.status_code != 200:
+                    raise RuntimeError(f"Upload failed with status {response.status_code}")
+            # Throughput includes decoding and writing every upload, not just accepting them.
+            db.ingest_queue.join()
+            db.batch_writer.flush()
+        results.append(measurement.result())
+        with Measurement("ingest: Database._process_data (uploads)", arguments.trace_memory) as measurement:
+            for upload in uploads[arguments.uploads:]:
+                measurement.call(db._process_data, upload)
+            db.batch_writer.flush()
+        results.append(measurement.result())
+
+    queries = [("fetch_field raw, last day", lambda serial_number: db.fetch_field(serial_number, 1, "weight", end_time - 86400)),
+               ("fetch_field auto, everything", lambda serial_number: db.fetch_field(serial_number, 1, "weight", resolution="auto")),
+               ("fetch_most_recent_values", db.fetch_most_recent_values),
+               ("data_to_csv, everything", lambda serial_number: sum(len(chunk) for chunk in db.data_to_csv(serial_number)))]
+    for name, query in queries:
+        with Measurement(name, arguments.trace_memory) as measurement:
+            for i in range(arguments.queries):
+                measurement.call(query, serial_numbers[i % len(serial_numbers)])
+        results.append(measurement.result())
+    return results
+
+
+def print_results(results):
+    print(f"{'measurement':<42}{'count':>9}{'per second':>13}{'p50 ms':>10}{'p99 ms':>10}{'peak KiB':>11}")
+    for result in results:
+        print(f"{result['name']:<42}{result['count']:>9}{result['per_second'] or 0:>13.1f}{result['p50_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+              f"{result['peak_memory_kb']:>11}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure iBuzz ingest and query performance with synthetic data.")
+    parser.add_argument("--backend", default="sqlite", help="storage backend, see database.STORAGE_BACKENDS")
+    parser.add_argument("--serial-numbers", type=int, default=5, help="number of Hawks")
+    parser.add_argument("--hives", type=int, default=4, help="number of hives for each Hawk")
+    parser.add_argument("--rows-per-hive", type=int, default=10000, help="rows stored for each hive before measuring")
+    parser.add_argument("--uploads", type=int, default=1000, help="uploads sent through each ingest path")
+    parser.add_argument("--ingest-workers", type=int, default=4, help="number of ingest worker threads")
+    parser.add_argument("--queries", type=int, default=50, help="number of times each query is run")
+    parser.add_argument("--trace-memory", action="store_true", help="measure the peak memory of each measurement with tracemalloc")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic data")
+    parser.add_argument("--json", help="file to write the results to, for comparing runs")
+    arguments = parser.parse_args()
+    # Resolved before the benchmark moves into its temporary folder.
+    json_path = None if arguments.json is None else os.path.abspath(arguments.json)
+    results = run(arguments)
+    print_results(results)
+    if json_path is not None:
+        with open(json_path, "w") as results_file:
+            json.dump({"arguments": vars(arguments), "results": results}, results_file, indent=2)
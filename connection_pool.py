@@ -0,0 +1,106 @@
+import contextlib
+import os
+import sqlite3
+import threading
+import urllib.parse
+import weakref
+
+
+class _ThreadConnection:
+    """Reader connection of one thread. The connection is closed when the thread finishes and this is discarded."""
+    __slots__ = ("connection", "attached", "__weakref__")
+
+    def __init__(self, connection):
+        self.connection = connection
+        # Schema names attached to the connection.
+        self.attached = set()
+
+
+class ConnectionPool:
+
+    def __init__(self, database_path, write_lock=None, cache_size=-16000, mmap_size=268435456):
+        """Provide SQLite connections that are safe to use from many threads.
+
+        Each thread reads through its own connection. All writes go through a single writer connection guarded by write_lock.
+        The database is put in WAL mode so that reads never wait for a write to finish.
+        :param str database_path: path of the SQLite database file
+        :param write_lock: lock held while writing, a new lock is created if this is None
+        :param int cache_size: SQLite page cache size, negative values are in KiB
+        :param int mmap_size: number of bytes of the database file SQLite may memory map"""
+        self.database_path = database_path
+        self.write_lock = threading.Lock() if write_lock is None else write_lock
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        # Path of each database attached read-only to every connection, by schema name.
+        self.attachments = {}
+        self.write_connection = self._connect()
+        self.write_connection_attached = set()
+        self.write_connection.execute("PRAGMA journal_mode=WAL")
+
+    def _connect(self):
+        # Connections are only used by one thread at a time, but close() may be called from any thread.
+        connection = sqlite3.connect(self.database_path, check_same_thread=False, uri=True)
+        # NORMAL is durable in WAL mode except against power loss, and avoids an fsync on every commit.
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(f"PRAGMA cache_size={int(self.cache_size)}")
+        connection.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        with self.connections_lock:
+            self.connections.append(connection)
+        return connection
+
+    def attach(self, schema_name, database_path):
+        """Attach another database file read-only to every connection under schema_name.
+
+        Connections attach it the next time they are returned by :func:'~connection_pool.ConnectionPool.reader' or
+        :func:'~connection_pool.ConnectionPool.writer'."""
+        with self.connections_lock:
+            self.attachments.setdefault(schema_name, database_path)
+
+    def _attach_missing(self, connection, attached):
+        # Attaching isn't allowed inside a transaction, so this is done before a connection is handed out.
+        if len(attached) == len(self.attachments):
+            return
+        with self.connections_lock:
+            attachments = dict(self.attachments)
+        for schema_name, database_path in attachments.items():
+            if schema_name not in attached:
+                uri = "file:" + urllib.parse.quote(os.path.abspath(database_path)) + "?mode=ro"
+                connection.execute("ATTACH DATABASE ? AS " + schema_name, (uri,))
+                attached.add(schema_name)
+
+    def _release(self, connection):
+        with self.connections_lock:
+            if connection not in self.connections:
+                return
+            self.connections.remove(connection)
+        connection.close()
+
+    def reader(self):
+        """Return the connection belonging to the current thread.
+
+        The connection is closed when the thread finishes."""
+        thread_connection = getattr(self.local, "thread_connection", None)
+        if thread_connection is None:
+            thread_connection = self.local.thread_connection = _ThreadConnection(self._connect())
+            weakref.finalize(thread_connection, self._release, thread_connection.connection)
+        self._attach_missing(thread_connection.connection, thread_connection.attached)
+        return thread_connection.connection
+
+    @contextlib.contextmanager
+    def writer(self):
+        """Return the writer connection inside a transaction, holding the write lock."""
+        with self.write_lock:
+            self._attach_missing(self.write_connection, self.write_connection_attached)
+            with self.write_connection:
+                yield self.write_connection
+
+    def close(self):
+        """Close every connection opened by the pool."""
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+        self.local = threading.local()
@@ -1,78 +1,261 @@
-# import duckdb
 import calendar
-import sqlite3
-import os
-import threading
+import csv
+import importlib
+import io
+import logging
 import time
 import encoded_data
 import error_logger
+import metrics
+from batch_writer import BatchWriter
+from ingest_queue import IngestQueue
+from latest_values import LatestValuesCache, serial_number_key
+from pubsub import PubSub
 from replay_log import ReplayLog
-from hive_data import WeatherStationData, HiveData
+from hive_data import COLUMN_NAMES, INTEGER_COLUMNS, WeatherStationData, HiveData, DataBatch
+from sqlite_storage import SQLiteStorage
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Content type and file extension of each export format.
+EXPORT_FORMATS = {"csv": ("text/csv", "csv"),
+                  "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+                  "parquet": ("application/vnd.apache.parquet", "parquet"),
+                  "npz": ("application/octet-stream", "npz")}
+
+# NumPy archives are built in memory, so they are limited to this many seconds of data.
+NPZ_MAX_TIME_RANGE = 31 * 86400
+
+logger = logging.getLogger(__name__)
+
+DECODE_SECONDS = metrics.Histogram("ibuzz_decode_seconds", "Time taken to decode the JSON of an upload.")
+DECODE_FAILURES = metrics.Counter("ibuzz_decode_failures_total", "Payloads that couldn't be decoded.")
+WRITE_SECONDS = metrics.Histogram("ibuzz_write_seconds", "Time taken to write a batch of rows to storage.")
+ROWS_WRITTEN = metrics.Counter("ibuzz_rows_written_total", "Rows written to storage.")
+NOTIFICATION_SECONDS = metrics.Histogram("ibuzz_notification_seconds", "Time taken to evaluate notifications for an upload.")
+QUERY_SECONDS = metrics.Histogram("ibuzz_query_seconds", "Time taken to answer a sensor data query.", ("query",))
+
+# Module and storage class of each backend that can be chosen with storage_backend in config.yaml.
+# Backends other than sqlite are imported by create_storage only when chosen, so their libraries aren't loaded otherwise.
+STORAGE_BACKENDS = {"sqlite": ("sqlite_storage", "SQLiteStorage"),
+                    "duckdb": ("duckdb_storage", "DuckDBStorage")}
+# Database file of each backend when no database_path option is given.
+DEFAULT_DATABASE_PATHS = {"sqlite": "database.db",
+                          "duckdb": "database.duckdb"}
+
+
+def storage_database_path(backend="sqlite", **options):
+    """Return the database file that :func:'~database.create_storage' would open with the same arguments, so that it can be
+    locked with :func:'~database.lock_database' before the storage is created.
+
+    :raises KeyError: if backend isn't recognised"""
+    return options.get("database_path", DEFAULT_DATABASE_PATHS[backend])
+
+
+def create_storage(backend="sqlite", **options):
+    """Return the storage for a backend in STORAGE_BACKENDS, passing options to its constructor.
+
+    :raises KeyError: if backend isn't recognised
+    :raises ValueError: if archive_path is given for a backend that can't archive partitions
+    :raises ImportError: if the library needed for backend isn't installed"""
+    module_name, class_name = STORAGE_BACKENDS[backend]
+    storage_class = getattr(importlib.import_module(module_name), class_name)
+    if "archive_path" in options and not storage_class.supports_archiving:
+        # Rejected when the app starts rather than when the first archive is attempted.
+        raise ValueError(f"The {backend} storage backend doesn't support archiving partitions, remove archive_path from storage_options")
+    return storage_class(**options)
+
+
+def lock_database(database_path, exclusive=False):
+    """Return an open lock file that holds a lock on the database at database_path until it is closed.
+
+    Every :class:'~database.Database' holds a shared lock, and backfill and archive hold an exclusive one. A Database only
+    reads which partitions exist and the latest values when it is created, so it would not see rows written by another
+    process. Take the lock before creating the storage, since creating it can migrate the database.
+    Does nothing and returns None where file locks aren't available.
+    :raises RuntimeError: if the lock is held by another process, or by another Database if exclusive is True"""
+    if fcntl is None:
+        return None
+    lock_file = open(database_path + ".lock", "a")
+    try:
+        fcntl.flock(lock_file, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        raise RuntimeError(f"{database_path} is being used by {'a running server' if exclusive else 'a backfill'}, "
+                           f"stop it before {'backfilling' if exclusive else 'starting the server'}")
+    return lock_file
+
+
+class StreamSink(io.RawIOBase):
+    """File-like object that collects written bytes so they can be streamed while a file is still being written."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        """Return and forget everything written since the last drain."""
+        data, self.chunks = b"".join(self.chunks), []
+        return data
 
 
 class Database:
-    database_lock = threading.Lock()
 
-    column_names = ['serial_number', 'outside_humidity', 'outside_temperature', 'time', 'hive_number',
-                    'temperature_1', 'temperature_2', 'temperature_3', 'humidity', 'weight', 'accelerometer', 'bees_out', 'bees_in', 'frequency']
+    column_names = COLUMN_NAMES
 
-    def __init__(self, database_path="database.db"):
+    def __init__(self, database_path="database.db", ingest_queue_size=1000, ingest_worker_count=4, batch_size=500, flush_interval=1.0, latest_values_table=False,
+                 archive_path="archive.db", storage=None, replay_log=None, server_lock=None):
         """Manage a database used for storing sensor data.
 
-        Creates and manages an SQLite database for storing sensor data.
+        Receives sensor data from the Hawks and stores it with a :class:'~storage.Storage' backend,
+        an SQLite database at database_path if storage is None.
 
         'serial_number' is assigned by Digital Matter and is unique to the Hawk.
         'time' is the number of seconds since 1/1/1970.
         There are three internal temperature sensor slots available because that is the maximum allowed by this project's hardware.
         'entrance' is the number of bees going in and out of the hive.
+        Received JSON is processed by ingest_worker_count threads from a queue holding at most ingest_queue_size payloads.
+        Rows are written in batches of up to batch_size rows, at most flush_interval seconds after they are received. Ingest
+        workers wait while several batches are waiting to be written, so the ingest queue fills up and rejects uploads instead.
+        The most recent row for each hive is held in memory.
+        latest_values_table and archive_path are passed to :class:'~sqlite_storage.SQLiteStorage' if storage is None.
+        Received JSON is written to replay_log, a :class:'~replay_log.ReplayLog' in replay_logs/ if replay_log is None.
+        server_lock is the shared lock from :func:'~database.lock_database' taken on the database of storage before it was
+        created, and is closed with the Database. If it is None the lock is taken here, before storage is created if it is None.
+        :raises RuntimeError: if the database is being backfilled or archived
         """
-        self.database_path = database_path
-        database_exists = os.path.isfile(self.database_path)
-        self.connection = sqlite3.connect(self.database_path, check_same_thread=False)
-        if not database_exists:
-            self.connection.execute("""CREATE TABLE Data (
-                                    serial_number	INTEGER,
-                                    outside_humidity	NUMERIC,
-                                    outside_temperature	NUMERIC,
-                                    time	INTEGER,
-                                    hive_number INTEGER,
-                                    temperature_1  NUMERIC,
-                                    temperature_2  NUMERIC,
-                                    temperature_3  NUMERIC,
-                                    humidity NUMERIC,
-                                    weight NUMERIC,
-                                    accelerometer   NUMERIC,
-                                    bees_out INTEGER,
-                                    bees_in INTEGER,
-                                    frequency NUMERIC,
-                                    PRIMARY KEY(serial_number, hive_number, time)
-                                );""")
-        self.replay_log = ReplayLog()
+        if storage is None:
+            server_lock = lock_database(database_path) if server_lock is None else server_lock
+            try:
+                storage = SQLiteStorage(database_path, latest_values_table, archive_path)
+            except Exception:
+                if server_lock is not None:
+                    server_lock.close()
+                raise
+        elif server_lock is None:
+            try:
+                server_lock = lock_database(storage.database_path)
+            except RuntimeError:
+                storage.close()
+                raise
+        self.storage = storage
+        self.server_lock = server_lock
+        self.latest_values = LatestValuesCache()
+        self.latest_values.update(self.storage.load_latest_rows())
+        # Time that rows were last written for each serial_number. Anything cached before startup is treated as stale.
+        self.start_time = time.time()
+        self.last_modified = {}
+        # Newly written rows are published under serial_number_key(serial_number) for live dashboards.
+        self.live_rows = PubSub()
+        self.replay_log = ReplayLog() if replay_log is None else replay_log
+        self.batch_writer = BatchWriter(self._write_rows, batch_size, flush_interval, DataBatch)
+        self.ingest_queue = IngestQueue(self._process_data, ingest_queue_size, ingest_worker_count)
+
+    def close(self):
+        """Process and write all accepted JSON and close the database connection and replay log."""
+        self.ingest_queue.shutdown()
+        self.batch_writer.close()
+        self.storage.close()
+        self.replay_log.close()
+        if self.server_lock is not None:
+            self.server_lock.close()
 
     def data_received(self, json, notification_method=None):
-        """Run :func:'~database.Database._process_data' as a thread.
+        """Queue :func:'~database.Database._process_data' to be run by an ingest worker.
         
-        :param notification_method: method that will be called after each hive is processed for notifications. Will be passed current_weather_station_data, current_hive_data, previous_weather_station_data, previous_hive_data."""
-        thread = threading.Thread(target=self._process_data, args=[json, notification_method])
-        thread.start()
+        :param notification_method: method that will be called after each hive is processed for notifications. Will be passed current_weather_station_data, current_hive_data, previous_weather_station_data, previous_hive_data.
+        :raises queue.Full: if the ingest queue is full"""
+        self.ingest_queue.submit(json, notification_method)
 
-    def _compare_and_add_hive(self, hives, new_hive):
-        """Modify hives so that it contains only the most recent data for each hive_number.
-        
-        If a hive with the same hive_number already exists in hives, do not add new_hive.
-        If a hive exists in hives which is an older version of new_hive, remove that hive."""
-        older_version = False
-        to_remove = []
-        for hive in hives:
-            if hive.is_more_recent_or_equal_to(new_hive):
-                older_version = True
-            if new_hive.is_more_recent_version_of(hive):
-                to_remove.append(hive)
-        if not older_version:
-            hives.append(new_hive)
-        for hive_to_remove in to_remove:
-            hives.remove(hive_to_remove)
-        return hives
+    @staticmethod
+    def _record_payloads(record):
+        """Yield the base64 encoded data strings in a record.
+
+        Data can be in one of two places
+        { "Records": [{ "Fields": [{ "Tags": [{"Data": data}] }] }] } or
+        { "Records": [{ "Fields": [{ "Data": data}] }] }"""
+        for field in record["Fields"]:
+            tags = field.get("Tags", None)
+            if tags is not None:
+                for tag in tags:
+                    yield tag.get("Data")
+            else:
+                data_str = field.get("Data", None)
+                if data_str is not None:
+                    yield data_str
+
+    @staticmethod
+    def payloads(json):
+        """Yield the base64 encoded data strings in the JSON from the Hawk.
+
+        :raises KeyError: if the JSON doesn't have records"""
+        for record in json["Records"]:
+            yield from Database._record_payloads(record)
+
+    @staticmethod
+    def decode(json, errors=None, decoded=None):
+        """Decode the data values in the JSON from the Hawk.
+
+        Only the most recent data for each hive_number is kept.
+        :param list errors: if given, (error, serial_number, data) for each payload that can't be decoded is added to it
+                            instead of being logged, for decoding in processes that shouldn't write to the error log
+        :param dict decoded: if given, what :func:'~encoded_data.decode_payloads' returned for each data string, so that
+                             payloads already decoded together in a batch aren't decoded again
+        :return: serial_number, WeatherStationData or None, and a dictionary of HiveData by hive_number
+        :raises KeyError: if the JSON doesn't have a serial number or records"""
+        serial_number = json["SerNo"]
+        weather_station = None
+        hives = {}
+        for record in json["Records"]:
+            date = record["DateUTC"]
+            epoch_time = calendar.timegm(time.strptime(date, '%Y-%m-%d %H:%M:%S'))
+            for data in Database._record_payloads(record):
+                try:
+                    if decoded is None or data not in decoded:
+                        payload_format, values = encoded_data.decode_payload(data)
+                    else:
+                        result = decoded[data]
+                        if isinstance(result, Exception):
+                            raise result
+                        payload_format, values = result
+                    if payload_format == encoded_data.WEATHER_STATION:
+                        weather_station = WeatherStationData(serial_number, *values)
+                    elif payload_format == encoded_data.HIVE:
+                        new_hive = HiveData(*values, time=epoch_time)
+                        hive = hives.get(new_hive.hive_number)
+                        if hive is None or new_hive.is_more_recent_version_of(hive):
+                            hives[new_hive.hive_number] = new_hive
+                except Exception as e:
+                    DECODE_FAILURES.inc()
+                    if errors is None:
+                        error_logger.log_error(e, serial_number, data)
+                    else:
+                        errors.append((e, serial_number, data))
+        return serial_number, weather_station, hives
 
     def _process_data(self, json, notification_method = None):
         """Extract and store the data values in the JSON from the Hawk."""
@@ -81,125 +264,226 @@ class Database:
             self.replay_log.add_to_log(serial_number, json)
         except:
             self.replay_log.add_to_log("error", json)
-            print("Error determining serial_number: ", json)
-        weather_station = None
-        hives = []
-        for record in json["Records"]:
-            date = record["DateUTC"]
-            epoch_time = calendar.timegm(time.strptime(date, '%Y-%m-%d %H:%M:%S'))
-            outside_humidity, outside_temperature = None, None
-            temperature_1 = 0
-
-            # Data can be in one of two places
-            # { "Records": [{ "Fields": [{ "Tags": [{"Data": data}] }] }] } or
-            # { "Records": [{ "Fields": [{ "Data": data}] }] }
-            for field in record["Fields"]:
-                tags = field.get("Tags", None)
-                if tags is not None:
-                    for tag in tags:
-                        try:
-                            try:
-                                weather_station = WeatherStationData(serial_number, *encoded_data.extract_outside_humidity_and_temperature(tag.get("Data")))
-                            except ValueError:
-                                new_hive = HiveData(*encoded_data.extract_custom_data(tag.get("Data")))
-                                new_hive.set_time(epoch_time)
-                                hives = self._compare_and_add_hive(hives, new_hive)
-                        except Exception as e:
-                            error_logger.log_error(e)
-                else:
-                    data_str = field.get("Data", None)
-                    if data_str is not None:
-                        try:
-                            try:
-                                weather_station = WeatherStationData(serial_number, *encoded_data.extract_outside_humidity_and_temperature(data_str))
-                            except ValueError:
-                                new_hive = HiveData(*encoded_data.extract_custom_data(data_str))
-                                new_hive.set_time(epoch_time)
-                                hives = self._compare_and_add_hive(hives, new_hive)
-                        except Exception as e:
-                            error_logger.log_error(e)
+            logger.warning("Error determining serial_number: %s", json)
+        with DECODE_SECONDS.time():
+            serial_number, weather_station, hives = self.decode(json)
 
-        if notification_method is not None:
-            all_previous_values = self.fetch_most_recent_values(serial_number)
+        logger.debug("Hives received from %s: %s", serial_number, hives)
+        batch = DataBatch()
+        for hive in hives.values():
+            batch.append(weather_station, hive)
+        # The latest values are updated before the rows are written, so the next upload is compared with this one
+        # even if it arrives before the batch writer flushes.
+        previous_rows = self.latest_values.exchange(batch.rows())
         notification_method_arguments = []
-        for hive in hives:
-            try:
-                if notification_method is not None:
-                    # Throws KeyError if there aren't any previous values
-                    previous_values = all_previous_values[str(hive.hive_number)]
-                    previous_weather_station_data = WeatherStationData(serial_number, previous_values[1], previous_values[2])
-                    previous_hive_data = HiveData(previous_values[4], previous_values[5], previous_values[6], previous_values[7], previous_values[8], previous_values[9], previous_values[10], previous_values[11], previous_values[12], previous_values[13])
-                    notification_method_arguments.append((weather_station, hive, previous_weather_station_data, previous_hive_data))
-            except KeyError:
-                continue
-        with self.connection:
-            print(hives)
-            for hive in hives:
-                print("constraint values ", (weather_station.serial_number, hive.hive_number, hive.time))
-                r = self.connection.execute("""SELECT * FROM Data WHERE serial_number = ? and hive_number = ? and time = ?""", (weather_station.serial_number, hive.hive_number, hive.time))
-                print(r.fetchall())
-                self.connection.execute(
-                    "INSERT INTO Data VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    (*weather_station.get_data(), *hive.get_data()))
         if notification_method is not None:
-            for arguments in notification_method_arguments:
-                notification_method(*arguments)
+            for hive, previous_values in zip(hives.values(), previous_rows):
+                if previous_values is None:
+                    continue
+                previous_weather_station_data = WeatherStationData(serial_number, previous_values[1], previous_values[2])
+                previous_hive_data = HiveData(*previous_values[4:])
+                notification_method_arguments.append((weather_station, hive, previous_weather_station_data, previous_hive_data))
+        self.batch_writer.add(batch)
+        if notification_method is not None:
+            with NOTIFICATION_SECONDS.time():
+                for arguments in notification_method_arguments:
+                    notification_method(*arguments)
+
+    def _write_rows(self, batch):
+        """Store the rows in a DataBatch and pass them on to the latest values cache and live subscribers."""
+        with WRITE_SECONDS.time():
+            batch = self.storage.write_rows(batch)
+        ROWS_WRITTEN.inc(len(batch))
+        self.latest_values.update(batch.rows())
+        write_time = time.time()
+        for serial_number in set(batch.columns[0]):
+            self.last_modified[serial_number_key(serial_number)] = write_time
+        self._publish_rows(batch)
+
+    def _publish_rows(self, batch):
+        """Publish the rows in a DataBatch to the subscribers of their serial_number as dictionaries keyed by column name."""
+        rows_by_serial_number = {}
+        for row in batch.rows():
+            key = serial_number_key(row[0])
+            if self.live_rows.subscriber_count(key) > 0:
+                rows_by_serial_number.setdefault(key, []).append(dict(zip(self.column_names, row)))
+        for key, rows in rows_by_serial_number.items():
+            self.live_rows.publish(key, rows)
+
+    def subscribe(self, serial_numbers):
+        """Return a queue that receives a list of newly written rows, as dictionaries keyed by column name, after each write for any of serial_numbers.
+
+        Each list only holds rows of one serial_number. Pass the queue to :func:'~database.Database.unsubscribe' when it is no longer needed."""
+        return self.live_rows.subscribe([serial_number_key(serial_number) for serial_number in serial_numbers])
+
+    def unsubscribe(self, serial_numbers, subscription):
+        """Stop passing newly written rows to a queue returned by :func:'~database.Database.subscribe'."""
+        self.live_rows.unsubscribe([serial_number_key(serial_number) for serial_number in serial_numbers], subscription)
+
+
+    def rebuild_rollups(self):
+        """Recalculate every hourly and daily rollup from the Data table partitions."""
+        self.storage.rebuild_rollups()
+
+
+    def archive_partitions(self, before_time):
+        """Move the months that end at or before before_time into the read-only archive database, see :func:'~partitions.Partitions.archive'.
 
-    def fetch_field(self, serial_number, hive_number, field, start_time=0, end_time=None):
+        :return: names of the partitions that were archived
+        :raises NotImplementedError: if the storage backend doesn't support archiving, such as duckdb"""
+        return self.storage.archive_partitions(before_time)
+
+
+    def check_query_plans(self):
+        """Log a warning for each hot query that would read a whole table, see :func:'~schema.check_query_plans'.
+
+        :return: list of (name, query plan step) for each full scan"""
+        return self.storage.check_query_plans()
+
+
+
+    @metrics.timed(QUERY_SECONDS)
+    def fetch_field(self, serial_number, hive_number, field, start_time=0, end_time=None, resolution="raw"):
         """Return the time column and the given column.
 
         Return the time column and the given field column between start_time and end_time.
+        For the 'hourly' and 'daily' resolutions, the times are the start of each bucket, the field values are bucket means,
+        and the bucket minimums and maximums are included as field + '_min' and field + '_max'.
         :param serial_number: Serial Number assigned by Digital Matter to the Hawk
         :param str field: column to fetch
         :type start_time: int
         :type end_time: int or None
-        :raises KeyError: if field isn't a database column"""
-        end_time = time.time() if end_time is None else end_time
-        # Validate the field value to prevent SQL injections
-        if field not in self.column_names:
-            raise KeyError
-        cursor = self.connection.cursor()
-        cursor.execute(f"""SELECT time, {field} FROM Data WHERE serial_number = ? and hive_number = ? and time > ? and time < ? ORDER BY time ASC""",
-                       (serial_number, hive_number, start_time, end_time))
-        data = {'time': [], str(field): []}
-        for line in cursor.fetchall():
-            data['time'].append(line[0])
-            data[str(field)].append(line[1])
-        cursor.close()
-        return data
+        :param str resolution: 'raw', 'hourly', 'daily', or 'auto' to choose based on the time range
+        :raises KeyError: if field isn't a database column or resolution isn't recognised"""
+        return self.storage.fetch_field(serial_number, hive_number, field, start_time, end_time, resolution)
+
+
+    @metrics.timed(QUERY_SECONDS)
+    def fetch_fields(self, serial_number, hive_numbers, fields, start_time=0, end_time=None, resolution="raw"):
+        """Return the time column and the given columns for several hives in a single query.
+
+        The 'hourly' and 'daily' resolutions work as they do for :func:'~database.Database.fetch_field', but are only used if every field has rollups.
+        :param serial_number: Serial Number assigned by Digital Matter to the Hawk
+        :param hive_numbers: list of hive numbers, or None for every hive
+        :param list(str) fields: columns to fetch
+        :param str resolution: 'raw', 'hourly', 'daily', or 'auto' to choose based on the time range
+        :return: dictionary with the resolution used and a dictionary of columns by str(hive_number)
+        :raises KeyError: if any field isn't a database column or resolution isn't recognised"""
+        return self.storage.fetch_fields(serial_number, hive_numbers, fields, start_time, end_time, resolution)
+
 
     def fetch_names(self):
         """Returns the column names for the Data table."""
         return self.column_names
 
+    @metrics.timed(QUERY_SECONDS)
     def fetch_most_recent_values(self, serial_number):
-        """Return the most recent values for each hive_number belonging to the given serial_number."""
-        hive_numbers = self.fetch_hive_numbers(serial_number)
-        most_recent_values = {}
-        cursor = self.connection.cursor()
-        for hive_number in hive_numbers:
-            cursor.execute("""SELECT * FROM Data WHERE serial_number = ? and hive_number = ? ORDER BY time DESC LIMIT 1""", (serial_number, hive_number))
-            values = cursor.fetchone()
-            if values is not None:
-                most_recent_values[str(hive_number)] = values
-        return most_recent_values
+        """Return the most recent values for each hive_number belonging to the given serial_number.
+
+        Values are read from memory and include every row that has been received, including rows the batch writer hasn't written yet."""
+        return self.latest_values.fetch(serial_number)
+
+    def fetch_last_modified(self, serial_number):
+        """Return the time that rows were last written for the given serial_number.
+
+        Data returned for a serial_number can only change after this time, so it can be used to validate cached responses."""
+        return self.last_modified.get(serial_number_key(serial_number), self.start_time)
 
+    @metrics.timed(QUERY_SECONDS)
     def fetch_hive_numbers(self, serial_number):
         """Return all hive numbers associated with the given serial_number."""
-        cursor = self.connection.cursor()
-        cursor.execute("""SELECT DISTINCT hive_number from Data WHERE serial_number = ?""", (serial_number, ))
-        hive_numbers = []
-        for line in cursor.fetchall():
-            hive_numbers.append(line[0])
-        return hive_numbers
-    
-    def data_to_csv(self, serial_number):
-        """Return the text for a csv file that contains all the data linked to the given serial_number."""
-        cursor = self.connection.cursor()
-        cursor.execute("""SELECT * FROM Data WHERE serial_number = ?""", (serial_number,))
-        text = ""
-        for line in cursor.fetchall():
-            for part in line[:-1]:
-                text += str(part) + ","
-            text += str(line[-1]) + "\n"
-        return text
\ No newline at end of file
+        return self.storage.fetch_hive_numbers(serial_number)
+
+
+    def iterate_rows(self, serial_number, start_time=None, end_time=None, hive_number=None, chunk_size=1000):
+        """Yield lists of at most chunk_size Data table rows belonging to the given serial_number, ordered by hive_number and time.
+
+        :param serial_number: Serial Number assigned by Digital Matter to the Hawk
+        :param start_time: if given, only rows with a time at or after start_time are included
+        :param end_time: if given, only rows with a time before end_time are included
+        :param hive_number: if given, only rows for this hive are included"""
+        return self.storage.iterate_rows(serial_number, start_time, end_time, hive_number, chunk_size)
+
+
+    def data_to_csv(self, serial_number, start_time=None, end_time=None, hive_number=None, chunk_size=1000):
+        """Yield the text for a csv file that contains all the data linked to the given serial_number in chunks.
+
+        The rows can be limited to a time range and a single hive, see :func:'~database.Database.iterate_rows'."""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        for rows in self.iterate_rows(serial_number, start_time, end_time, hive_number, chunk_size):
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    def export_formats(self):
+        """Return the export formats that can be produced with the installed libraries."""
+        formats = ["csv"]
+        if pyarrow is not None:
+            formats += ["arrow", "parquet"]
+        if numpy is not None:
+            formats.append("npz")
+        return formats
+
+    def export_data(self, serial_number, export_format="csv", start_time=None, end_time=None, hive_number=None, chunk_size=10000):
+        """Return a generator of the chunks of a file that contains the data linked to the given serial_number.
+
+        Arrow IPC streams and Parquet files are written one record batch or row group per chunk of rows.
+        NumPy archives are compressed and can only be produced once all the rows have been read, so their memory use grows
+        with the number of rows. They need a start_time and end_time at most NPZ_MAX_TIME_RANGE seconds apart.
+        The rows can be limited to a time range and a single hive, see :func:'~database.Database.iterate_rows'.
+        :param str export_format: one of the keys of EXPORT_FORMATS
+        :raises KeyError: if export_format isn't recognised
+        :raises ImportError: if the library needed for export_format isn't installed
+        :raises ValueError: if an npz export doesn't have a short enough time range"""
+        if export_format not in EXPORT_FORMATS:
+            raise KeyError(export_format)
+        if export_format not in self.export_formats():
+            raise ImportError(f"{export_format} export needs a library that isn't installed")
+        if export_format == "npz" and (start_time is None or end_time is None or end_time - start_time > NPZ_MAX_TIME_RANGE):
+            raise ValueError(f"npz exports need a start_time and end_time at most {NPZ_MAX_TIME_RANGE} seconds apart")
+        if export_format == "csv":
+            return self.data_to_csv(serial_number, start_time, end_time, hive_number, chunk_size)
+        chunks = self.iterate_rows(serial_number, start_time, end_time, hive_number, chunk_size)
+        if export_format == "arrow":
+            return self._export_arrow(chunks)
+        if export_format == "parquet":
+            return self._export_parquet(chunks)
+        return self._export_npz(chunks)
+
+    def _arrow_schema(self):
+        return pyarrow.schema([(name, pyarrow.int64() if name in INTEGER_COLUMNS else pyarrow.float64()) for name in self.column_names])
+
+    def _arrow_record_batch(self, schema, rows):
+        columns = list(zip(*rows))
+        return pyarrow.record_batch([pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+
+    def _export_arrow(self, chunks):
+        schema = self._arrow_schema()
+        sink = StreamSink()
+        with pyarrow.ipc.new_stream(sink, schema) as writer:
+            for rows in chunks:
+                writer.write_batch(self._arrow_record_batch(schema, rows))
+                yield sink.drain()
+        yield sink.drain()
+
+    def _export_parquet(self, chunks):
+        schema = self._arrow_schema()
+        sink = StreamSink()
+        with pyarrow.parquet.ParquetWriter(sink, schema, compression="zstd") as writer:
+            for rows in chunks:
+                writer.write_batch(self._arrow_record_batch(schema, rows), row_group_size=len(rows))
+                yield sink.drain()
+        yield sink.drain()
+
+    def _export_npz(self, chunks):
+        column_chunks = {name: [] for name in self.column_names}
+        for rows in chunks:
+            for name, column in zip(self.column_names, zip(*rows)):
+                column_chunks[name].append(numpy.array(column, dtype="i8" if name in INTEGER_COLUMNS else "f8"))
+        columns = {name: (numpy.concatenate(arrays) if len(arrays) > 0 else numpy.empty(0, dtype="i8" if name in INTEGER_COLUMNS else "f8"))
+                   for name, arrays in column_chunks.items()}
+        buffer = io.BytesIO()
+        numpy.savez_compressed(buffer, **columns)
+        yield buffer.getvalue()
@@ -0,0 +1,207 @@
+import threading
+import time
+import weakref
+import rollups
+import storage
+from hive_data import COLUMN_NAMES, INTEGER_COLUMNS
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class _ThreadCursor:
+    """Cursor of one thread. The cursor is closed when the thread finishes and this is discarded."""
+    __slots__ = ("cursor", "__weakref__")
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+
+class DuckDBStorage(storage.Storage):
+
+    def __init__(self, database_path="database.duckdb"):
+        """Store the Data table rows in a DuckDB database.
+
+        DuckDB stores each column separately and reads them in bulk, so hourly and daily summaries are calculated from the rows
+        when they are read instead of being stored, and exports over long time ranges only read the rows they return.
+        :raises ImportError: if DuckDB isn't installed"""
+        if duckdb is None:
+            raise ImportError("The duckdb storage backend needs DuckDB to be installed")
+        self.database_path = database_path
+        self.connection = duckdb.connect(database_path)
+        self.connection.execute(f"""CREATE TABLE IF NOT EXISTS Data (
+                                     {", ".join(f"{name} {'BIGINT' if name in INTEGER_COLUMNS else 'DOUBLE'}" for name in COLUMN_NAMES)},
+                                     PRIMARY KEY(serial_number, hive_number, time)
+                                 )""")
+        # A DuckDB connection can't be used by several threads at once, so each thread gets its own cursor.
+        self.cursors_lock = threading.Lock()
+        self.cursors = []
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        self.write_cursor = self._cursor()
+
+    def _cursor(self):
+        with self.cursors_lock:
+            cursor = self.connection.cursor()
+            self.cursors.append(cursor)
+            return cursor
+
+    def _release(self, cursor):
+        with self.cursors_lock:
+            if cursor not in self.cursors:
+                return
+            self.cursors.remove(cursor)
+        cursor.close()
+
+    def _reader(self):
+        thread_cursor = getattr(self.local, "thread_cursor", None)
+        if thread_cursor is None:
+            thread_cursor = self.local.thread_cursor = _ThreadCursor(self._cursor())
+            weakref.finalize(thread_cursor, self._release, thread_cursor.cursor)
+        return thread_cursor.cursor
+
+    def close(self):
+        """Close every connection to the database."""
+        with self.cursors_lock:
+            cursors, self.cursors = self.cursors, []
+        for cursor in cursors:
+            cursor.close()
+        self.connection.close()
+        self.local = threading.local()
+
+    def write_rows(self, batch):
+        """Insert the rows in a DataBatch into the Data table in a single transaction.
+
+        Rows that already exist for the same serial_number, hive_number and time are ignored.
+        :return: the DataBatch, since every row can be written"""
+        if len(batch) == 0:
+            return batch
+        with self.write_lock:
+            if pyarrow is not None:
+                # Inserting from an Arrow table avoids binding every value separately.
+                self.write_cursor.register("incoming_rows", pyarrow.table(dict(zip(COLUMN_NAMES, batch.columns))))
+                try:
+                    self.write_cursor.execute("""INSERT OR IGNORE INTO Data SELECT * FROM incoming_rows""")
+                finally:
+                    self.write_cursor.unregister("incoming_rows")
+            else:
+                row_parameters = f"""({", ".join("?" for name in COLUMN_NAMES)})"""
+                self.write_cursor.execute(f"""INSERT OR IGNORE INTO Data VALUES {", ".join(row_parameters for row in range(len(batch)))}""",
+                                          [value for row in batch.rows() for value in row])
+        return batch
+
+    def load_latest_rows(self):
+        """Return the most recent row for each serial_number and hive_number."""
+        return self._reader().execute(
+            """SELECT * FROM Data QUALIFY row_number() OVER (PARTITION BY serial_number, hive_number ORDER BY time DESC) = 1""").fetchall()
+
+    def fetch_field(self, serial_number, hive_number, field, start_time=0, end_time=None, resolution="raw"):
+        """Return the time column and the given column, see :func:'~database.Database.fetch_field'.
+
+        :raises KeyError: if field isn't a database column or resolution isn't recognised"""
+        end_time = time.time() if end_time is None else end_time
+        # Validate the field value to prevent SQL injections
+        storage.validate_fields([field])
+        cursor = self._reader()
+        resolution = storage.choose_resolution([field], resolution, lambda: cursor.execute(
+            """SELECT MIN(time) FROM Data WHERE serial_number = ? and hive_number = ?""", [serial_number, hive_number]).fetchone()[0],
+            start_time, end_time)
+        if resolution == "raw":
+            cursor.execute(f"""SELECT time, {field} FROM Data WHERE serial_number = ? and hive_number = ? and time > ? and time < ? ORDER BY time ASC""",
+                           [serial_number, hive_number, start_time, end_time])
+            data = {'time': [], str(field): []}
+            for line in cursor.fetchall():
+                data['time'].append(line[0])
+                data[str(field)].append(line[1])
+            return data
+        bucket_size = rollups.RESOLUTIONS[resolution]
+        cursor.execute(f"""SELECT time // ? * ? AS bucket, AVG({field}), MIN({field}), MAX({field}) FROM Data
+                           WHERE serial_number = ? and hive_number = ? and time >= ? and time < ? GROUP BY bucket ORDER BY bucket ASC""",
+                       [bucket_size, bucket_size, serial_number, hive_number, float(start_time) // bucket_size * bucket_size, end_time])
+        data = {'time': [], field: [], field + '_min': [], field + '_max': []}
+        for line in cursor.fetchall():
+            data['time'].append(line[0])
+            data[field].append(line[1])
+            data[field + '_min'].append(line[2])
+            data[field + '_max'].append(line[3])
+        return data
+
+    def fetch_fields(self, serial_number, hive_numbers, fields, start_time=0, end_time=None, resolution="raw"):
+        """Return the time column and the given columns for several hives, see :func:'~database.Database.fetch_fields'.
+
+        :raises KeyError: if any field isn't a database column or resolution isn't recognised"""
+        end_time = time.time() if end_time is None else end_time
+        # Validate the field values to prevent SQL injections
+        storage.validate_fields(fields)
+        hive_filter, hive_parameters = "", []
+        if hive_numbers is not None:
+            hive_filter = f""" and hive_number IN ({", ".join("?" for hive_number in hive_numbers)})"""
+            hive_parameters = list(hive_numbers)
+        cursor = self._reader()
+        resolution = storage.choose_resolution(fields, resolution, lambda: cursor.execute(
+            f"""SELECT MIN(time) FROM Data WHERE serial_number = ?{hive_filter}""", [serial_number] + hive_parameters).fetchone()[0],
+            start_time, end_time)
+        hives = {}
+        if resolution == "raw":
+            cursor.execute(f"""SELECT hive_number, time, {", ".join(fields)} FROM Data WHERE serial_number = ?{hive_filter} and time > ? and time < ?
+                               ORDER BY hive_number, time ASC""", [serial_number] + hive_parameters + [start_time, end_time])
+            for line in cursor.fetchall():
+                columns = hives.get(str(line[0]))
+                if columns is None:
+                    columns = hives[str(line[0])] = {'time': [], **{field: [] for field in fields}}
+                columns['time'].append(line[1])
+                for field, value in zip(fields, line[2:]):
+                    columns[field].append(value)
+            return {'resolution': resolution, 'hives': hives}
+        bucket_size = rollups.RESOLUTIONS[resolution]
+        summaries = ", ".join(f"""AVG({field}), MIN({field}), MAX({field})""" for field in fields)
+        cursor.execute(f"""SELECT hive_number, time // ? * ? AS bucket, {summaries} FROM Data
+                           WHERE serial_number = ?{hive_filter} and time >= ? and time < ? GROUP BY hive_number, bucket ORDER BY hive_number, bucket ASC""",
+                       [bucket_size, bucket_size, serial_number] + hive_parameters + [float(start_time) // bucket_size * bucket_size, end_time])
+        for line in cursor.fetchall():
+            columns = hives.get(str(line[0]))
+            if columns is None:
+                columns = hives[str(line[0])] = {'time': []}
+                for field in fields:
+                    columns[field], columns[field + '_min'], columns[field + '_max'] = [], [], []
+            columns['time'].append(line[1])
+            for i, field in enumerate(fields):
+                columns[field].append(line[2 + 3 * i])
+                columns[field + '_min'].append(line[3 + 3 * i])
+                columns[field + '_max'].append(line[4 + 3 * i])
+        return {'resolution': resolution, 'hives': hives}
+
+    def fetch_hive_numbers(self, serial_number):
+        """Return all hive numbers associated with the given serial_number."""
+        cursor = self._reader()
+        cursor.execute("""SELECT DISTINCT hive_number FROM Data WHERE serial_number = ? ORDER BY hive_number""", [serial_number])
+        return [line[0] for line in cursor.fetchall()]
+
+    def iterate_rows(self, serial_number, start_time=None, end_time=None, hive_number=None, chunk_size=1000):
+        """Yield lists of at most chunk_size Data table rows, see :func:'~database.Database.iterate_rows'."""
+        query = """SELECT * FROM Data WHERE serial_number = ?"""
+        parameters = [serial_number]
+        if hive_number is not None:
+            query += """ and hive_number = ?"""
+            parameters.append(hive_number)
+        if start_time is not None:
+            query += """ and time >= ?"""
+            parameters.append(start_time)
+        if end_time is not None:
+            query += """ and time < ?"""
+            parameters.append(end_time)
+        # A cursor of its own, since the rows are read while the thread's cursor may be used for other queries.
+        cursor = self._cursor()
+        try:
+            cursor.execute(query + """ ORDER BY serial_number, hive_number, time""", parameters)
+            rows = cursor.fetchmany(chunk_size)
+            while len(rows) > 0:
+                yield rows
+                rows = cursor.fetchmany(chunk_size)
+        finally:
+            self._release(cursor)
@@ -0,0 +1,115 @@
+import queue
+import smtplib
+import threading
+import time
+import error_logger
+
+
+class EmailSender:
+
+    def __init__(self, from_email, password, host="smtp.gmail.com", port=587, starttls=True, batch_window=5.0, max_attempts=5,
+                 retry_delay=1.0, smtp_factory=smtplib.SMTP, timeout=30):
+        """Send emails from a background thread so that callers never wait for the SMTP server.
+
+        Emails sent within batch_window seconds of each other to the same recipient are combined into a single digest.
+        The SMTP connection is kept open between emails and reopened if it fails.
+        :param str host: SMTP server, such as 'localhost' for a local test server
+        :param bool starttls: upgrade the connection with STARTTLS and log in with from_email and password
+        :param float batch_window: number of seconds to wait for more emails before sending
+        :param int max_attempts: number of times an email is attempted before it is dropped
+        :param float retry_delay: seconds to wait before the first retry, doubled for each retry after that
+        :param smtp_factory: method that returns an smtplib.SMTP compatible connection when passed host, port and timeout"""
+        self.from_email = from_email
+        self.password = password
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.batch_window = batch_window
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.smtp_factory = smtp_factory
+        self.timeout = timeout
+        self.smtp = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="email-sender", daemon=True)
+        self.thread.start()
+
+    def send(self, recipient, subject, message):
+        """Queue an email to be sent."""
+        self.queue.put((recipient, subject, message))
+
+    def close(self):
+        """Send all queued emails and close the SMTP connection."""
+        self.queue.put(None)
+        self.thread.join()
+        self._disconnect()
+
+    def _run(self):
+        closing = False
+        while not closing:
+            email = self.queue.get()
+            if email is None:
+                return
+            emails = [email]
+            deadline = time.monotonic() + self.batch_window
+            while True:
+                try:
+                    email = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if email is None:
+                    closing = True
+                    break
+                emails.append(email)
+            for recipient, (subject, message) in self._digest(emails).items():
+                self._deliver(recipient, subject, message)
+        self._disconnect()
+
+    @staticmethod
+    def _digest(emails):
+        """Return a dictionary of (subject, message) by recipient, combining multiple emails to the same recipient."""
+        by_recipient = {}
+        for recipient, subject, message in emails:
+            by_recipient.setdefault(recipient, []).append((subject, message))
+        digests = {}
+        for recipient, recipient_emails in by_recipient.items():
+            if len(recipient_emails) == 1:
+                digests[recipient] = recipient_emails[0]
+            else:
+                digests[recipient] = (f"iBuzz ALERTS ({len(recipient_emails)})",
+                                      "\n\n".join(f"{subject}\n{message}" for subject, message in recipient_emails))
+        return digests
+
+    def _deliver(self, recipient, subject, message):
+        email = f"""From: {self.from_email}\nTo: {recipient}\nSubject: {subject}\n\n{message}"""
+        for attempt in range(self.max_attempts):
+            try:
+                self._connect().sendmail(self.from_email, recipient, email)
+                return
+            except smtplib.SMTPRecipientsRefused as e:
+                # Retrying won't help if the address is rejected.
+                error_logger.log_error(e)
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                self._disconnect()
+                if attempt == self.max_attempts - 1:
+                    error_logger.log_error(f"Failed to send email: {e}", details={"recipient": recipient})
+                    return
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+    def _connect(self):
+        if self.smtp is None:
+            smtp = self.smtp_factory(self.host, self.port, timeout=self.timeout)
+            if self.starttls:
+                smtp.starttls()
+                smtp.login(self.from_email, self.password)
+            self.smtp = smtp
+        return self.smtp
+
+    def _disconnect(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
@@ -1,54 +1,202 @@
 import base64
+import struct
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# The tag name "P RHT 903CCD" is always included in data from the ELA RHT tag, straight after the 6 byte UID.
+RHT_TAG_NAME = b"P RHT 903CCD"
+RHT_TAG_NAME_OFFSET = 6
+# 6 (UID), 12 ("P RHT 903CCD"), 3 (blank), 1 (humidity), 2 (little endian temperature)
+RHT_LAYOUT = struct.Struct("<6x12x3xBH")
+# hive_number(1), temperature_1(2), temperature_2(2), temperature_3(2), humidity(1), weight(2), accelerometer(1), bees_out(1), bees_in(1), frequency(3)
+# struct has no 3 byte integer so frequency is split into its high byte and low two bytes. The 7 bytes that follow are unused.
+CUSTOM_LAYOUT = struct.Struct(">BHHHBHBBBBH")
+
+if numpy is not None:
+    RHT_DTYPE = numpy.dtype([("uid", "V6"), ("name", "S12"), ("blank", "V3"), ("humidity", "u1"), ("temperature", "<u2")])
+    CUSTOM_DTYPE = numpy.dtype([("hive_number", "u1"), ("temperature_1", ">u2"), ("temperature_2", ">u2"), ("temperature_3", ">u2"),
+                                ("humidity", "u1"), ("weight", ">u2"), ("accelerometer", "u1"), ("bees_out", "u1"), ("bees_in", "u1"),
+                                ("frequency_high", "u1"), ("frequency_low", ">u2")])
+    WEATHER_STATION_BATCH_DTYPE = numpy.dtype([("outside_humidity", "i8"), ("outside_temperature", "f8")])
+    HIVE_BATCH_DTYPE = numpy.dtype([("hive_number", "i8"), ("temperature_1", "f8"), ("temperature_2", "f8"), ("temperature_3", "f8"),
+                                    ("humidity", "i8"), ("weight", "f8"), ("accelerometer", "i8"), ("bees_out", "i8"), ("bees_in", "i8"),
+                                    ("frequency", "i8")])
 
 
 def extract_outside_humidity_and_temperature(data):
     """Return a tuple containing outside humidity and outside temperature.
 
-    Calls extract_data() with predefined values for the ELA RHT tag.
+    Decodes data sent by the ELA RHT tag.
     :param str data: base64 encoded string
     :return: humidity and temperature
-    :raises ValueError: if data doesn't include the tag name in hex form"""
-    # hex_string_check contains the hex representation of the tag name "P RHT 903CCD" which is always included
-    # Format is 6 (UID), 12 ("P RHT 903CCD"), 3 (blank), 1 (humidity), 2 (reversed temperature)
-    extracted_data = extract_data(data,
-                                  [6, 12, 3, 1, 2],
-                                  [False, False, False, True, True],
-                                  is_reversed=[False, False, False, False, True],
-                                  hex_string_check="502052485420393033434344")
-    return extracted_data[0], extracted_data[1] / 100
+    :raises ValueError: if data doesn't include the tag name or is too short"""
+    raw = base64.b64decode(data)
+    if not is_outside_humidity_and_temperature(raw):
+        raise ValueError
+    return decode_outside_humidity_and_temperature(raw)
 
 
 def extract_custom_data(data):
-    """Return a tuple containing the values from our custom hardware."""
-    # name(position,size)
-    # hive_number(0,1), temperature_1(1,2), temperature_2(2,2), temperature_3(3,2), humidity(4,1), weight(5,2), accelerometer(6,1), bees_out(7,1), bees_in(8,1), frequency(9,3)
-    extracted_data = extract_data(data, [1, 2, 2, 2, 1, 2, 1, 1, 1, 3, 7], [True, True, True, True, True, True, True, True, True, True, False])
-    return extracted_data[0], extracted_data[1] / 10, extracted_data[2] / 10, extracted_data[3] / 10, extracted_data[4], extracted_data[5]/10, extracted_data[6], extracted_data[7], extracted_data[8], extracted_data[9]
+    """Return a tuple containing the values from our custom hardware.
+
+    :raises ValueError: if data is too short"""
+    return decode_custom_data(base64.b64decode(data))
+
+
+def is_outside_humidity_and_temperature(raw):
+    """Return True if the decoded data was sent by the ELA RHT tag."""
+    return raw[RHT_TAG_NAME_OFFSET:RHT_TAG_NAME_OFFSET + len(RHT_TAG_NAME)] == RHT_TAG_NAME
+
+
+def decode_outside_humidity_and_temperature(raw):
+    """Return a tuple containing outside humidity and outside temperature from decoded ELA RHT tag data."""
+    humidity, temperature = unpack(RHT_LAYOUT, raw)
+    return humidity, temperature / 100
+
+
+def is_custom_data(raw):
+    """Return True if the decoded data is long enough to have been sent by our custom hardware."""
+    return len(raw) >= CUSTOM_LAYOUT.size
+
+
+def decode_custom_data(raw):
+    """Return a tuple containing the values from decoded data sent by our custom hardware."""
+    hive_number, temperature_1, temperature_2, temperature_3, humidity, weight, accelerometer, bees_out, bees_in, frequency_high, frequency_low = unpack(CUSTOM_LAYOUT, raw)
+    return hive_number, temperature_1 / 10, temperature_2 / 10, temperature_3 / 10, humidity, weight / 10, accelerometer, bees_out, bees_in, frequency_high << 16 | frequency_low
+
+
+# Payload formats are checked in order, so formats with a specific signature must be registered before more general ones.
+payload_formats = []
+
+
+# Method passed a list of decoded bytes that returns an array of their values, by payload format name.
+batch_decoders = {}
+
+
+def register_payload_format(name, matches, decode, decode_batch=None):
+    """Add a payload format that :func:'~encoded_data.decode_payload' can recognise.
 
+    :param str name: name returned by decode_payload for data in this format
+    :param matches: method passed the decoded bytes that returns True if they are in this format, should be cheap to call
+    :param decode: method passed the decoded bytes that returns a tuple of values
+    :param decode_batch: method passed a list of decoded bytes that returns a NumPy array with the values of each, used by
+                         :func:'~encoded_data.decode_payloads' if given"""
+    payload_formats.append((name, matches, decode))
+    if decode_batch is not None:
+        batch_decoders[name] = decode_batch
 
-def extract_data(data, sizes, to_return, is_reversed=None, hex_string_check=None):
-    """Return an array of decimal numbers.
 
-    Converts the given base64 string to hex, splits it up based on sizes, converts those sections into decimal, and returns those marked to be returned.
+def decode_payload(data):
+    """Return the name of the payload format and the values contained in the given data.
+
+    The data is only base64 decoded once, and then decoded by the first registered format that matches it.
     :param str data: base64 encoded string
-    :param list(int) sizes: Integer array of how many bytes of hex each section comprises
-    :param list(boolean) to_return: Boolean array determining which sections will be included in the returned array
-    :param list(boolean) is_reversed: Boolean array determining if the respective section's hex needs to be reversed before being converted to decimal
-    :param str hex_string_check: If this isn't None, a ValueError will be returned if the hex doesn't include this
-    :return: Array of decimal values
-    :raises ValueError: if hex_string_check isn't featured in the data"""
-    if is_reversed is None:
-        is_reversed = [False for s in sizes]
-    hex_data = base64.b64decode(data).hex()
-    if hex_string_check is not None:
-        if hex_string_check not in hex_data:
-            raise ValueError
-    extracted_data = []
-    for i in range(len(sizes)):
-        section, hex_data = hex_data[:sizes[i] * 2], hex_data[sizes[i] * 2:]
-        if not to_return[i]:
-            continue
-        if is_reversed[i]:
-            section = "".join(list(section[0 + i:2 + i] for i in range(0, len(section), 2))[::-1])
-        extracted_data.append(int(section, 16))
+    :raises ValueError: if the data doesn't match any format or can't be decoded"""
+    raw = base64.b64decode(data)
+    for name, matches, decode in payload_formats:
+        if matches(raw):
+            return name, decode(raw)
+    # The data isn't included, so that errors for different data are counted together by error_logger.
+    raise ValueError("data doesn't match any payload format")
+
+
+def decode_payloads(payloads):
+    """Return what :func:'~encoded_data.decode_payload' returns for each of a list of base64 strings, or the exception it raises.
+
+    When NumPy is installed, the payloads of each format with a batch decoder are decoded together in a single call, which is
+    much faster for the thousands of payloads read at once when backfilling."""
+    results = [None] * len(payloads)
+    # [indexes, decoded bytes] by payload format name
+    batches = {}
+    for index, data in enumerate(payloads):
+        try:
+            raw = base64.b64decode(data)
+            for name, matches, decode in payload_formats:
+                if matches(raw):
+                    if numpy is not None and name in batch_decoders:
+                        batch = batches.setdefault(name, ([], []))
+                        batch[0].append(index)
+                        batch[1].append(raw)
+                    else:
+                        results[index] = (name, decode(raw))
+                    break
+            else:
+                raise ValueError("data doesn't match any payload format")
+        except Exception as e:
+            results[index] = e
+    for name, (indexes, raws) in batches.items():
+        try:
+            values = batch_decoders[name](raws).tolist()
+        except ValueError:
+            # Data that is too short fails the whole batch, so each payload is decoded on its own to find it.
+            decode = next(decode for format_name, matches, decode in payload_formats if format_name == name)
+            values = []
+            for raw in raws:
+                try:
+                    values.append(decode(raw))
+                except ValueError as e:
+                    values.append(e)
+        for index, value in zip(indexes, values):
+            results[index] = value if isinstance(value, Exception) else (name, tuple(value))
+    return results
+
+
+def unpack(layout, raw):
+    """Return the values in raw bytes according to a struct layout.
+
+    :param struct.Struct layout: layout of the start of raw
+    :param bytes raw: decoded data
+    :raises ValueError: if raw is shorter than the layout"""
+    try:
+        return layout.unpack_from(raw)
+    except struct.error as e:
+        raise ValueError(str(e)) from e
+
+
+def decode_outside_humidity_and_temperature_batch(raws):
+    """Return a NumPy structured array of outside humidity and outside temperature for a list of decoded ELA RHT tag data.
+
+    Each element has the same values as :func:'~encoded_data.decode_outside_humidity_and_temperature' would return.
+    :raises ValueError: if any of the data is too short
+    :raises ImportError: if NumPy isn't installed"""
+    packed = _frombuffer(raws, RHT_DTYPE)
+    extracted_data = numpy.empty(len(packed), dtype=WEATHER_STATION_BATCH_DTYPE)
+    extracted_data["outside_humidity"] = packed["humidity"]
+    extracted_data["outside_temperature"] = packed["temperature"] / 100
+    return extracted_data
+
+
+def decode_custom_data_batch(raws):
+    """Return a NumPy structured array of the values from a list of decoded data sent by our custom hardware.
+
+    Each element has the same values as :func:'~encoded_data.decode_custom_data' would return.
+    :raises ValueError: if any of the data is too short
+    :raises ImportError: if NumPy isn't installed"""
+    packed = _frombuffer(raws, CUSTOM_DTYPE)
+    extracted_data = numpy.empty(len(packed), dtype=HIVE_BATCH_DTYPE)
+    for name in ("hive_number", "humidity", "accelerometer", "bees_out", "bees_in"):
+        extracted_data[name] = packed[name]
+    for name in ("temperature_1", "temperature_2", "temperature_3", "weight"):
+        extracted_data[name] = packed[name] / 10
+    extracted_data["frequency"] = packed["frequency_high"].astype("i8") << 16 | packed["frequency_low"]
     return extracted_data
+
+
+def _frombuffer(raws, dtype):
+    """Return a structured array built from the start of each raw bytes object."""
+    if numpy is None:
+        raise ImportError("NumPy is required to decode batches of data")
+    for raw in raws:
+        if len(raw) < dtype.itemsize:
+            raise ValueError(f"data is shorter than {dtype.itemsize} bytes")
+    return numpy.frombuffer(b"".join(raw[:dtype.itemsize] for raw in raws), dtype=dtype)
+
+
+WEATHER_STATION = "weather_station"
+HIVE = "hive"
+register_payload_format(WEATHER_STATION, is_outside_humidity_and_temperature, decode_outside_humidity_and_temperature,
+                        decode_outside_humidity_and_temperature_batch)
+register_payload_format(HIVE, is_custom_data, decode_custom_data, decode_custom_data_batch)
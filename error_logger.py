@@ -1,10 +1,174 @@
-def log_error(error):
-    print("error received by error logger: ", error)
-    ErrorLogger.write(error)
+# Errors are written to errors.txt as JSON Lines by a background thread, so logging an error never waits for the disk.
+# Repeats of the same error within rate_window seconds are counted rather than written, and a summary of how many times
+# each was repeated is written when its window ends. Errors are the same if they have the same type, message and serial
+# number, so messages shouldn't include values that change every time, which are passed as the payload or details instead.
+# Only one process should log to a file, since the rotation of a file isn't coordinated between processes. The file is rotated to errors.txt.1, errors.txt.2, ... when it gets too large.
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Longest part of a payload that is included in a record.
+PAYLOAD_FRAGMENT_LENGTH = 64
+
+
+def log_error(error, serial_number=None, payload=None, details=None):
+    """Log an error with the default :class:'~error_logger.ErrorLogger'.
+
+    :param error: exception or message
+    :param serial_number: serial number of the Hawk that the error came from, if known
+    :param payload: data being processed when the error happened, only the start of which is kept
+    :param dict details: other values written with the record, such as a file name, that aren't compared to find repeats"""
+    default_logger().log(error, serial_number, payload, details)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_logger():
+    """Return the ErrorLogger used by :func:'~error_logger.log_error', creating one that writes to errors.txt if needed."""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = ErrorLogger()
+            atexit.register(_default.close)
+        return _default
+
+
+def configure(**options):
+    """Replace the default ErrorLogger with one created with options, such as {'path': 'logs/errors.txt', 'max_size': 1048576}."""
+    global _default
+    with _default_lock:
+        previous, _default = _default, ErrorLogger(**options)
+        atexit.register(_default.close)
+    if previous is not None:
+        previous.close()
 
 
 class ErrorLogger:
 
-    def write(error):
-        with open("errors.txt", "a+") as log:
-            log.write(error + "\n")
+    def __init__(self, path="errors.txt", max_size=10 * 1024 * 1024, backup_count=3, rate_window=60.0, queue_size=10000):
+        """Write structured error records to a file from a background thread.
+
+        :param int max_size: number of bytes after which the file is rotated
+        :param int backup_count: number of rotated files kept
+        :param float rate_window: seconds during which repeats of an error are counted instead of written
+        :param int queue_size: number of records waiting to be written, after which new records are dropped and counted"""
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self.rate_window = rate_window
+        self.queue = queue.Queue(maxsize=queue_size)
+        # [time of the first occurrence, number of repeats since] by (type, message, str(serial_number))
+        self.recent = {}
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.log_file = None
+        self.thread = threading.Thread(target=self._run, name="error-logger", daemon=True)
+        self.thread.start()
+
+    def log(self, error, serial_number=None, payload=None, details=None):
+        """Queue a record of an error to be written, unless the same error was written less than rate_window seconds ago.
+
+        Never blocks or raises, so it can be called for every bad payload. See :func:'~error_logger.log_error'."""
+        try:
+            error_type = type(error).__name__ if isinstance(error, BaseException) else "message"
+            message = str(error)
+            serial_number = None if serial_number is None else str(serial_number)
+            key = (error_type, message, serial_number)
+            now = time.time()
+            with self.lock:
+                occurrence = self.recent.get(key)
+                if occurrence is not None and now - occurrence[0] < self.rate_window:
+                    occurrence[1] += 1
+                    return
+                self.recent[key] = [now, 0]
+            record = {"time": now, "type": error_type, "message": message}
+            if serial_number is not None:
+                record["serial_number"] = serial_number
+            if payload is not None:
+                record["payload"] = str(payload)[:PAYLOAD_FRAGMENT_LENGTH]
+            if details is not None:
+                record["details"] = details
+            logger.warning("%s: %s", error_type, message)
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+        except Exception:
+            logger.exception("Unable to log error")
+
+    def close(self):
+        """Write every queued record and summaries of repeated errors, then stop the background thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _summaries(self, now, closing=False):
+        """Return records of the errors whose windows have ended and were repeated, and forget those windows."""
+        records = []
+        with self.lock:
+            for key, (first_time, repeats) in list(self.recent.items()):
+                if closing or now - first_time >= self.rate_window:
+                    del self.recent[key]
+                    if repeats > 0:
+                        error_type, message, serial_number = key
+                        record = {"time": now, "type": error_type, "message": message, "repeated": repeats, "since": first_time}
+                        if serial_number is not None:
+                            record["serial_number"] = serial_number
+                        records.append(record)
+            if self.dropped > 0:
+                records.append({"time": now, "type": "message", "message": "Error log queue full, records dropped", "repeated": self.dropped})
+                self.dropped = 0
+        return records
+
+    def _run(self):
+        closing = False
+        while not closing:
+            records = []
+            try:
+                record = self.queue.get(timeout=min(self.rate_window, 1.0))
+                # Everything else that is waiting is written together.
+                while True:
+                    if record is None:
+                        closing = True
+                        break
+                    records.append(record)
+                    record = self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            records.extend(self._summaries(time.time(), closing))
+            if records:
+                try:
+                    self._write(records)
+                except Exception:
+                    logger.exception("Unable to write to error log %s", self.path)
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def _write(self, records):
+        if self.log_file is None:
+            self.log_file = open(self.path, "a")
+        for record in records:
+            self.log_file.write(json.dumps(record, default=str) + "\n")
+        self.log_file.flush()
+        if self.log_file.tell() >= self.max_size:
+            self._rotate()
+
+    def _rotate(self):
+        self.log_file.close()
+        self.log_file = None
+        for number in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{number}"):
+                os.replace(f"{self.path}.{number}", f"{self.path}.{number + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
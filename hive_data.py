@@ -1,8 +1,13 @@
+# Columns of the Data table, in the order DataBatch rows are stored in.
+COLUMN_NAMES = ['serial_number', 'outside_humidity', 'outside_temperature', 'time', 'hive_number',
+                'temperature_1', 'temperature_2', 'temperature_3', 'humidity', 'weight', 'accelerometer', 'bees_out', 'bees_in', 'frequency']
+INTEGER_COLUMNS = ['serial_number', 'time', 'hive_number', 'bees_out', 'bees_in']
 
 
 class HiveData:
+    __slots__ = ("hive_number", "temperature_1", "temperature_2", "temperature_3", "humidity", "weight", "accelerometer", "bees_out", "bees_in", "frequency", "time")
 
-    def __init__(self, hive_number, temperature_1, temperature_2, temperature_3, humidity, weight, accelerometer, bees_out, bees_in, frequency):
+    def __init__(self, hive_number, temperature_1, temperature_2, temperature_3, humidity, weight, accelerometer, bees_out, bees_in, frequency, time=None):
         self.hive_number = hive_number
         self.temperature_1 = temperature_1
         self.temperature_2 = temperature_2
@@ -13,27 +18,19 @@ class HiveData:
         self.bees_out = bees_out
         self.bees_in = bees_in
         self.frequency = frequency
-
-    def set_time(self, time):
         self.time = time
 
     def is_more_recent_version_of(self, other_hive):
         """Return True if the main HiveData has the same hive_number and a more recent time than other_hive."""
         return self.time > other_hive.time and self.hive_number == other_hive.hive_number
-    
-    def is_more_recent_or_equal_to(self, other_hive):
-        """Return True if the main HiveData has the same hive_number and a more recent or identical time to other_hive."""
-        return self.time >= other_hive.time and self.hive_number == other_hive.hive_number
-
 
     def get_data(self):
-        if self.temperature_2 is None:
-            return (self.time, self.hive_number, self.temperature_1)
+        """Return the values for the Data table columns from time onwards. Missing sensor values are None."""
         return (self.time, self.hive_number, self.temperature_1, self.temperature_2, self.temperature_3, self.humidity, self.weight, self.accelerometer, self.bees_out, self.bees_in, self.frequency)
 
-    
 
 class WeatherStationData:
+    __slots__ = ("serial_number", "outside_humidity", "outside_temperature")
 
     def __init__(self, serial_number, outside_humidity, outside_temperature):
         self.serial_number = serial_number
@@ -43,3 +40,45 @@ class WeatherStationData:
     def get_data(self):
         return (self.serial_number, self.outside_humidity, self.outside_temperature)
 
+
+class DataBatch:
+    """Rows for the Data table stored as one list per column."""
+    __slots__ = ("columns",)
+
+    column_count = len(COLUMN_NAMES)
+
+    def __init__(self):
+        self.columns = tuple([] for i in range(self.column_count))
+
+    def append(self, weather_station, hive):
+        """Add a row made from a WeatherStationData and a HiveData.
+
+        :raises ValueError: if the row doesn't have a value for every column, which would misalign every later row"""
+        row = (*weather_station.get_data(), *hive.get_data())
+        if len(row) != self.column_count:
+            raise ValueError(f"Row has {len(row)} values, expected {self.column_count}")
+        for column, value in zip(self.columns, row):
+            column.append(value)
+
+    def extend(self, other):
+        """Add all the rows from another DataBatch."""
+        for column, other_column in zip(self.columns, other.columns):
+            column.extend(other_column)
+
+    def partition(self, key):
+        """Return a dictionary of DataBatch objects holding the rows that key(row) returns the same value for, by that value."""
+        batches = {}
+        for row in self.rows():
+            batch = batches.get(key(row))
+            if batch is None:
+                batch = batches[key(row)] = DataBatch()
+            for column, value in zip(batch.columns, row):
+                column.append(value)
+        return batches
+
+    def rows(self):
+        """Return an iterator of row tuples in Data table column order."""
+        return zip(*self.columns)
+
+    def __len__(self):
+        return len(self.columns[0])
@@ -0,0 +1,66 @@
+import queue
+import threading
+import error_logger
+
+
+class IngestQueue:
+
+    def __init__(self, process_method, queue_size=1000, worker_count=4):
+        """Process payloads with a fixed number of worker threads.
+
+        Payloads are held in a bounded queue so that a burst of uploads can't create an unbounded number of threads.
+        :param process_method: method that will be called by a worker with the arguments given to submit()
+        :param int queue_size: maximum number of payloads waiting to be processed
+        :param int worker_count: number of worker threads"""
+        self.process_method = process_method
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.workers = []
+        self.closed = False
+        self.closed_lock = threading.Lock()
+        for i in range(worker_count):
+            worker = threading.Thread(target=self._work, name=f"ingest-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, *args):
+        """Add a payload to the queue without blocking.
+
+        :raises queue.Full: if the queue is full or has been shut down"""
+        with self.closed_lock:
+            if self.closed:
+                raise queue.Full
+            self.queue.put_nowait(args)
+
+    def depth(self):
+        """Return the number of payloads waiting to be processed."""
+        return self.queue.qsize()
+
+    def join(self):
+        """Wait until every payload that has been queued so far has been processed."""
+        self.queue.join()
+
+    def shutdown(self, timeout=None):
+        """Stop accepting payloads and wait for every accepted payload to be processed."""
+        with self.closed_lock:
+            if self.closed:
+                return
+            self.closed = True
+        for worker in self.workers:
+            # Sentinels are queued behind the remaining payloads so the queue is drained first.
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
+
+    def _work(self):
+        while True:
+            args = self.queue.get()
+            if args is None:
+                self.queue.task_done()
+                return
+            try:
+                self.process_method(*args)
+            except Exception as e:
+                # The worker must survive a bad payload.
+                error_logger.log_error(e, payload=args[0])
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,53 @@
+import threading
+
+
+def serial_number_key(serial_number):
+    """Return serial_number as an int if possible so that '123' and 123 refer to the same Hawk."""
+    try:
+        return int(serial_number)
+    except (TypeError, ValueError):
+        return serial_number
+
+
+class LatestValuesCache:
+
+    def __init__(self, serial_number_index=0, time_index=3, hive_number_index=4):
+        """Hold the most recent Data table row for each serial_number and hive_number in memory.
+
+        :param int serial_number_index: position of serial_number in a row
+        :param int time_index: position of time in a row
+        :param int hive_number_index: position of hive_number in a row"""
+        self.serial_number_index = serial_number_index
+        self.time_index = time_index
+        self.hive_number_index = hive_number_index
+        self.latest_rows = {}
+        self.lock = threading.Lock()
+
+    def update(self, rows):
+        """Store each row if it is more recent than the stored row for its serial_number and hive_number."""
+        self.exchange(rows)
+
+    def exchange(self, rows):
+        """Store each row if it is more recent than the stored row for its serial_number and hive_number.
+
+        Rows are compared and stored in one step, so two uploads from the same Hawk are never compared with the same previous row.
+        :return: list of the row stored before each row was given, or None if there wasn't one"""
+        previous_rows = []
+        with self.lock:
+            for row in rows:
+                hives = self.latest_rows.setdefault(serial_number_key(row[self.serial_number_index]), {})
+                hive_number = row[self.hive_number_index]
+                latest_row = hives.get(hive_number)
+                previous_rows.append(latest_row)
+                if latest_row is None or row[self.time_index] > latest_row[self.time_index]:
+                    hives[hive_number] = tuple(row)
+        return previous_rows
+
+    def fetch(self, serial_number):
+        """Return the most recent row for each hive_number belonging to the given serial_number.
+
+        :return: dictionary of rows with str(hive_number) keys"""
+        with self.lock:
+            hives = self.latest_rows.get(serial_number_key(serial_number), {})
+            return {str(hive_number): row for hive_number, row in hives.items()}
+
@@ -3,6 +3,11 @@ import os
 import threading
 import werkzeug.security
 import uuid
+import metrics
+import schema
+from connection_pool import ConnectionPool
+from latest_values import serial_number_key
+from ttl_cache import TTLCache
 from user import User
 
 
@@ -14,66 +19,119 @@ def verify_password(user, password):
     return werkzeug.security.check_password_hash(user.password, password)
 
 
+def _add_notification_state_table(connection):
+    # IF NOT EXISTS because databases made before migrations were recorded may already have the table.
+    connection.execute("""CREATE TABLE IF NOT EXISTS NotificationState (
+                            notification_id TEXT,
+                            armed INTEGER,
+                            last_fired NUMERIC,
+                            PRIMARY KEY(notification_id)
+                        );""")
+
+
+def _add_lookup_indexes(connection):
+    """Index the columns that rows are looked up by other than the primary key."""
+    connection.execute("""CREATE INDEX IF NOT EXISTS LoginsEmail ON Logins(email)""")
+    connection.execute("""CREATE INDEX IF NOT EXISTS HawkOwnershipUser ON HawkOwnership(user_id)""")
+    connection.execute("""CREATE INDEX IF NOT EXISTS HawkVisibilitySerialNumber ON HawkVisibility(serial_number)""")
+    connection.execute("""CREATE INDEX IF NOT EXISTS NotificationsSerialNumber ON Notifications(serial_number)""")
+    connection.execute("""CREATE INDEX IF NOT EXISTS NotificationsUser ON Notifications(user_id)""")
+
+
+# Applied in order by :func:'~schema.migrate'. Only ever add to the end of this list.
+MIGRATIONS = [_add_notification_state_table, _add_lookup_indexes]
+
+# Queries that are run for most requests, checked at startup for full table scans.
+HOT_QUERIES = {
+    "fetch_user_by_email": ("""SELECT * FROM Logins WHERE email = ?""", ("",)),
+    "owned_serial_numbers": ("""SELECT serial_number FROM HawkOwnership WHERE user_id = ?""", ("",)),
+    "visible_serial_numbers": ("""SELECT DISTINCT serial_number FROM HawkVisibility WHERE user_id = ? or user_id = ?""", ("", "ALL")),
+    "visibility_by_serial_number": ("""SELECT serial_number, HawkVisibility.user_id, email FROM HawkVisibility
+                                     LEFT OUTER JOIN Logins ON HawkVisibility.user_id = Logins.user_id WHERE serial_number = ?""", (1,)),
+    "notifications_by_serial_number": ("""SELECT * FROM Notifications WHERE serial_number = ?""", (1,)),
+    "notifications_by_user": ("""SELECT * FROM Notifications WHERE user_id = ?""", ("",)),
+}
+
+QUERY_SECONDS = metrics.Histogram("ibuzz_login_query_seconds", "Time taken to answer a login, permission or notification query.", ("query",))
+
+
 class LoginDatabase:
 
     database_lock = threading.Lock()
 
-    def __init__(self, database_path="logins.db"):
+    def __init__(self, database_path="logins.db", cache_ttl=60):
+        """Manage a database used for storing user accounts, Hawk permissions and notifications.
+
+        Users and the serial numbers each user can see are cached for cache_ttl seconds, or until they are changed through this object."""
         self.database_path = database_path
+        self.user_cache = TTLCache(cache_ttl)
+        # (owned serial numbers, serial numbers shared with the user or with everyone) by user_id
+        self.permission_cache = TTLCache(cache_ttl)
+        # Incremented whenever the Notifications table changes so that cached copies of it can be refreshed.
+        self.notifications_version = 0
         database_exists = os.path.isfile(self.database_path)
-        self.connection = sqlite3.connect(self.database_path, check_same_thread=False)
+        self.pool = ConnectionPool(self.database_path, self.database_lock)
         if not database_exists:
-            self.connection.execute("""CREATE TABLE Logins (
-                                    user_id	TEXT,
-                                    first_name TEXT,
-                                    email	TEXT,
-                                    password	TEXT,
-                                    PRIMARY KEY(user_id)
-                                );""")
-            self.connection.execute("""CREATE TABLE HawkOwnership (
-                                    user_id	TEXT,
-                                    serial_number INTEGER,
-                                    PRIMARY KEY(serial_number)
-                                );""")
-            self.connection.execute("""CREATE TABLE HawkVisibility (
-                                    user_id	TEXT,
-                                    serial_number INTEGER,
-                                    PRIMARY KEY(user_id, serial_number)
-                                );""")
-            self.connection.execute("""CREATE TABLE Notifications (
-                                    notification_id TEXT,
-                                    user_id TEXT,
-                                    serial_number INTEGER,
-                                    hive_number INTEGER,
-                                    sensor TEXT,
-                                    sign TEXT,
-                                    value NUMERIC,
-                                    PRIMARY KEY(notification_id)
-                                );""")
+            with self.pool.writer() as connection:
+                connection.execute("""CREATE TABLE Logins (
+                                        user_id	TEXT,
+                                        first_name TEXT,
+                                        email	TEXT,
+                                        password	TEXT,
+                                        PRIMARY KEY(user_id)
+                                    );""")
+                connection.execute("""CREATE TABLE HawkOwnership (
+                                        user_id	TEXT,
+                                        serial_number INTEGER,
+                                        PRIMARY KEY(serial_number)
+                                    );""")
+                connection.execute("""CREATE TABLE HawkVisibility (
+                                        user_id	TEXT,
+                                        serial_number INTEGER,
+                                        PRIMARY KEY(user_id, serial_number)
+                                    );""")
+                connection.execute("""CREATE TABLE Notifications (
+                                        notification_id TEXT,
+                                        user_id TEXT,
+                                        serial_number INTEGER,
+                                        hive_number INTEGER,
+                                        sensor TEXT,
+                                        sign TEXT,
+                                        value NUMERIC,
+                                        PRIMARY KEY(notification_id)
+                                    );""")
+        schema.migrate(self.pool, MIGRATIONS)
+        schema.check_query_plans(self.pool.reader(), HOT_QUERIES)
 
     def close(self):
-        """Close database connection."""
-        self.connection.close()
+        """Close database connections."""
+        self.pool.close()
 
+    @metrics.timed(QUERY_SECONDS)
     def fetch_user(self, user_id):
         """Return a user object for a given user_id.
 
         :param str user_id: uuid4
         :returns: User object if user_id exists, otherwise None"""
-        cursor = self.connection.cursor()
+        return self.user_cache.fetch(user_id, lambda: self._load_user(user_id))
+
+    def _load_user(self, user_id):
+        cursor = self.pool.reader().cursor()
         cursor.execute("""SELECT * FROM Logins WHERE user_id = (?)""", (user_id,))
         item = cursor.fetchone()
         return None if item is None else User(*item)
 
+    @metrics.timed(QUERY_SECONDS)
     def fetch_user_by_email(self, email):
         """Return a user object for a given email.
 
         :returns: User object if email exists in database, otherwise None"""
-        cursor = self.connection.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""SELECT * FROM Logins WHERE email = (?)""", (email,))
         item = cursor.fetchone()
         return None if item is None else User(*item)
 
+    @metrics.timed(QUERY_SECONDS)
     def add_user(self, first_name, email, password):
         """Add a user to the database.
 
@@ -85,24 +143,29 @@ class LoginDatabase:
         user_id = str(uuid.uuid4())
         while not self.check_unique_user_id(user_id):
             user_id = str(uuid.uuid4())
-        with self.connection:
-            self.connection.execute(
+        with self.pool.writer() as connection:
+            connection.execute(
                 """INSERT INTO Logins VALUES (?, ?, ?, ?)""",
                 (user_id, first_name, email, hashed_password))
+        self.user_cache.invalidate(user_id)
 
+    @metrics.timed(QUERY_SECONDS)
     def change_password(self, user_id, new_password):
         """Change the password for a given user in the database."""
         hashed_password = hash_password(new_password)
-        with self.connection:
-            self.connection.execute("""UPDATE Logins SET password = ? WHERE user_id = ?""", (hashed_password, user_id))
+        with self.pool.writer() as connection:
+            connection.execute("""UPDATE Logins SET password = ? WHERE user_id = ?""", (hashed_password, user_id))
+        self.user_cache.invalidate(user_id)
 
+    @metrics.timed(QUERY_SECONDS)
     def check_unique_user_id(self, user_id):
         """Return False if the uuid exists in the database, True otherwise."""
-        cursor = self.connection.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""SELECT * FROM Logins WHERE user_id = (?)""", (user_id,))
         item = cursor.fetchone()
         return item is None
 
+    @metrics.timed(QUERY_SECONDS)
     def register_hawk(self, user_id, serial_number):
         """Add ownership of a hawk to a user account.
 
@@ -111,10 +174,12 @@ class LoginDatabase:
         :raises sqlite3.IntegrityError: if the serial_number is already assigned to a user_id
         :raises ValueError: if serial_number isn't an integer"""
         serial_number = int(serial_number)
-        with self.connection:
-            self.connection.execute(
+        with self.pool.writer() as connection:
+            connection.execute(
                 """INSERT INTO HawkOwnership VALUES (?, ?)""", (user_id, serial_number))
+        self.permission_cache.invalidate(user_id)
 
+    @metrics.timed(QUERY_SECONDS)
     def deregister_hawk(self, user_id, serial_number):
         """Remove a hawk from a user account.
 
@@ -124,21 +189,43 @@ class LoginDatabase:
         :raises PermissionError: if user_id doesn't own the Hawk serial_number"""
         if not self.check_hawk_ownership(user_id, serial_number):
             raise PermissionError
-        with self.connection:
-            self.connection.execute(
+        with self.pool.writer() as connection:
+            connection.execute(
                 """DELETE FROM HawkOwnership WHERE user_id = (?) and serial_number = (?)""", (user_id, serial_number))
-        self.remove_all_hawk_visibility(user_id, serial_number)
+            connection.execute(
+                """DELETE FROM HawkVisibility WHERE serial_number = (?)""", (serial_number,))
+        # Visibility may have been removed from any user.
+        self.permission_cache.clear()
 
+    @metrics.timed(QUERY_SECONDS)
     def check_hawk_ownership(self, user_id, serial_number):
         """Check if user_id owns the Hawk with the given serial_number.
 
         :type user_id: str
-        :type serial_number: int"""
-        cursor = self.connection.cursor()
-        cursor.execute("""SELECT * FROM HawkOwnership WHERE user_id = (?) and serial_number = (?)""", (user_id, int(serial_number)))
-        item = cursor.fetchone()
-        return item is not None
+        :type serial_number: int
+        :raises ValueError: if serial_number isn't an integer"""
+        owned_serial_numbers, visible_serial_numbers = self._fetch_permissions(user_id)
+        return int(serial_number) in owned_serial_numbers
+
+    def _fetch_permissions(self, user_id):
+        """Return the set of serial numbers user_id owns and the set of serial numbers shared with user_id or with everyone."""
+        return self.permission_cache.fetch(user_id, lambda: self._load_permissions(user_id))
+
+    def _load_permissions(self, user_id):
+        cursor = self.pool.reader().cursor()
+        cursor.execute("""SELECT serial_number FROM HawkOwnership WHERE user_id = ?""", (user_id,))
+        owned_serial_numbers = {serial_number_key(line[0]) for line in cursor.fetchall()}
+        cursor.execute("""SELECT DISTINCT serial_number FROM HawkVisibility WHERE user_id = ? or user_id = ?""", (user_id, 'ALL'))
+        visible_serial_numbers = {serial_number_key(line[0]) for line in cursor.fetchall()}
+        return owned_serial_numbers, visible_serial_numbers
 
+    def _invalidate_visibility(self, target_user_id):
+        if target_user_id == 'ALL':
+            self.permission_cache.clear()
+        else:
+            self.permission_cache.invalidate(target_user_id)
+
+    @metrics.timed(QUERY_SECONDS)
     def add_hawk_visibility(self, owner_user_id, serial_number, target_user_id):
         """Give visibility permissions for a hawk's data to a user_id.
 
@@ -154,13 +241,15 @@ class LoginDatabase:
             if self.fetch_user(target_user_id) is None:
                 raise ValueError
         try:
-            with self.connection:
-                self.connection.execute(
+            with self.pool.writer() as connection:
+                connection.execute(
                     """INSERT INTO HawkVisibility VALUES (?, ?)""", (target_user_id, serial_number))
         # There is no need for an error if the permission has already been given before.
         except sqlite3.IntegrityError as e:
             pass
+        self._invalidate_visibility(target_user_id)
 
+    @metrics.timed(QUERY_SECONDS)
     def remove_hawk_visibility(self, owner_user_id, serial_number, target_user_id):
         """Remove visibility permissions for a hawk's data from a user_id.
 
@@ -171,10 +260,12 @@ class LoginDatabase:
         :raises PermissionError: if granting_user_id doesn't own the Hawk serial_number"""
         if not self.check_hawk_ownership(owner_user_id, serial_number):
             raise PermissionError
-        with self.connection:
-            self.connection.execute(
+        with self.pool.writer() as connection:
+            connection.execute(
                 """DELETE FROM HawkVisibility WHERE user_id = (?) and serial_number = (?)""", (target_user_id, serial_number))
+        self._invalidate_visibility(target_user_id)
 
+    @metrics.timed(QUERY_SECONDS)
     def remove_all_hawk_visibility(self, owner_user_id, serial_number):
         """Remove all visibility permissions for a hawk.
 
@@ -183,40 +274,41 @@ class LoginDatabase:
         :raises PermissionError: if granting_user_id doesn't own the Hawk serial_number"""
         if not self.check_hawk_ownership(owner_user_id, serial_number):
             raise PermissionError
-        with self.connection:
-            self.connection.execute(
+        with self.pool.writer() as connection:
+            connection.execute(
                 """DELETE FROM HawkVisibility WHERE serial_number = (?)""", (serial_number,))
+        self.permission_cache.clear()
 
+    @metrics.timed(QUERY_SECONDS)
     def check_visibility_permissions(self, user_id, serial_number):
         """Check if the given user_id has permission to view the Hawk with the given serial_number."""
-        if self.check_hawk_ownership(user_id, serial_number):
-            return True
-        cursor = self.connection.cursor()
-        cursor.execute(
-            """SELECT * FROM HawkVisibility WHERE (user_id = ? or user_id = ?) and serial_number = ?""",
-            (user_id, 'ALL', serial_number))
-        return cursor.fetchone() is not None
+        owned_serial_numbers, visible_serial_numbers = self._fetch_permissions(user_id)
+        serial_number = serial_number_key(serial_number)
+        return serial_number in owned_serial_numbers or serial_number in visible_serial_numbers
     
+    @metrics.timed(QUERY_SECONDS)
     def fetch_all_visibility_permissions(self, user_id, serial_number):
         """Return all visibility permissions for the given serial_number with emails and user_ids.
         
         :raises PermissionError: if user_id doesn't own the hawk with the given serial_number"""
         if not self.check_hawk_ownership(user_id, serial_number):
             raise PermissionError
-        cursor = self.connection.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""SELECT serial_number, HawkVisibility.user_id, email FROM HawkVisibility LEFT OUTER JOIN Logins ON HawkVisibility.user_id = Logins.user_id WHERE serial_number = ?""", (serial_number, ))
         return cursor.fetchall()
 
     
+    @metrics.timed(QUERY_SECONDS)
     def fetch_owned_serial_numbers(self, user_id):
         """Return list of serial numbers the given user_id is registered as the owner of."""
-        cursor = self.connection.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""SELECT serial_number FROM HawkOwnership WHERE user_id = ?""", (user_id,))
         return cursor.fetchall()
     
+    @metrics.timed(QUERY_SECONDS)
     def fetch_visible_serial_numbers(self, user_id):
         """Return list of serial numbers the given user_id has permission to see."""
-        cursor = self.connection.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""SELECT DISTINCT serial_number FROM HawkVisibility WHERE user_id = ? or user_id = ?""", (user_id, 'ALL'))
         serial_numbers = cursor.fetchall()
         owned_serial_numbers = self.fetch_owned_serial_numbers(user_id)
@@ -226,6 +318,7 @@ class LoginDatabase:
                     serial_numbers.insert(0, owned_serial_number)
         return serial_numbers
 
+    @metrics.timed(QUERY_SECONDS)
     def add_notification(self, user_id, serial_number, hive_number, sensor, sign, value):
         """Add a notification to the database.
         
@@ -236,18 +329,20 @@ class LoginDatabase:
         try:
             if not (sign == ">" or sign == "<"):
                 return ValueError
-            with self.connection:
-                self.connection.execute("""INSERT INTO Notifications VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            with self.pool.writer() as connection:
+                connection.execute("""INSERT INTO Notifications VALUES (?, ?, ?, ?, ?, ?, ?)""",
                                         (str(uuid.uuid4()), user_id, serial_number, hive_number, sensor, sign, float(value)))
+            self.notifications_version += 1
         except sqlite3.IntegrityError:
             # Only occurs if the uuid4 isn't unique. Reattempting should fix this.
             self.add_notification(user_id, serial_number, hive_number, sensor, sign, value)
         
+    @metrics.timed(QUERY_SECONDS)
     def remove_notification(self, user_id, notification_id):
         """Remove a notification from the database.
         
         :raises PermissionError: if the notification doesn't belong to user_id."""
-        cursor = self.connection.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""SELECT user_id FROM Notifications WHERE notification_id = ?""", (notification_id, ))
         notification_user_id = cursor.fetchone()
 
@@ -256,19 +351,22 @@ class LoginDatabase:
             return
 
         if user_id == notification_user_id[0]:
-            with self.connection:
-                self.connection.execute("""DELETE FROM Notifications WHERE notification_id = ?""", (notification_id,))
+            with self.pool.writer() as connection:
+                connection.execute("""DELETE FROM Notifications WHERE notification_id = ?""", (notification_id,))
+                connection.execute("""DELETE FROM NotificationState WHERE notification_id = ?""", (notification_id,))
+            self.notifications_version += 1
             return
         else:
             raise PermissionError
     
+    @metrics.timed(QUERY_SECONDS)
     def fetch_notifications(self, serial_number=None, user_id=None):
         """Return all notifications linked to the given serial_number or user_id.
         
         :param serial_number: Serial Number assigned by Digital Matter to the Hawk
         :param user_id: uuid of the user
         :raises ValueError: if both serial_number and user_id are None"""
-        cursor = self.connection.cursor()
+        cursor = self.pool.reader().cursor()
         if serial_number is not None:
             cursor.execute("""SELECT * FROM Notifications WHERE serial_number = ?""", (serial_number, ))
             return cursor.fetchall()
@@ -278,9 +376,30 @@ class LoginDatabase:
         else:
             raise ValueError
         
+    @metrics.timed(QUERY_SECONDS)
+    def fetch_all_notifications(self):
+        """Return every notification in the database."""
+        cursor = self.pool.reader().cursor()
+        cursor.execute("""SELECT * FROM Notifications""")
+        return cursor.fetchall()
+
+    @metrics.timed(QUERY_SECONDS)
+    def fetch_notification_states(self):
+        """Return a dictionary of (armed, last_fired) by notification_id for every notification that has been sent."""
+        cursor = self.pool.reader().cursor()
+        cursor.execute("""SELECT notification_id, armed, last_fired FROM NotificationState""")
+        return {notification_id: (armed, last_fired) for notification_id, armed, last_fired in cursor.fetchall()}
+
+    @metrics.timed(QUERY_SECONDS)
+    def set_notification_state(self, notification_id, armed, last_fired):
+        """Store whether a notification can currently be sent and when it was last sent."""
+        with self.pool.writer() as connection:
+            connection.execute("""INSERT OR REPLACE INTO NotificationState VALUES (?, ?, ?)""", (notification_id, int(armed), last_fired))
+
+    @metrics.timed(QUERY_SECONDS)
     def fetch_hawk_owner(self, serial_number):
         """Return the user object for the user than owns the hawk with the given serial_number."""
-        cursor = self.connection.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""SELECT user_id FROM HawkOwnership WHERE serial_number = ?""", (serial_number, ))
         return self.fetch_user(cursor.fetchone()[0])
     
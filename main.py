@@ -1,24 +1,87 @@
+import atexit
+import datetime
+import hmac
+import json
+import logging
+import queue
 import sqlite3
+import threading
+import time
+import zlib
 import flask
 import flask_login
 import database
 import error_logger
 import login_database
+import metrics
 import notifications
+import replay_log
 import yaml
 
 
 config = yaml.safe_load(open("config.yaml"))
+# log_level is a logging level name such as 'DEBUG' to log every upload, 'WARNING', or 'CRITICAL' to turn logging off.
+logging.basicConfig(level=config.get("log_level", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+# error_log_options are passed to error_logger.ErrorLogger, such as {'path': 'errors.txt', 'max_size': 10485760, 'rate_window': 60}
+error_logger.configure(**config.get("error_log_options", {}))
 app = flask.Flask(__name__, template_folder='templates')
 app.config['SECRET_KEY'] = config["secret_key"]
-db = database.Database()
-login_db = login_database.LoginDatabase()
+# storage_backend is 'sqlite' or 'duckdb', storage_options are passed to the backend, such as {'database_path': 'database.duckdb'}.
+# Only sqlite can archive old months, so an archive_path option stops the app starting with duckdb.
+# The database is locked before the storage is created, so the app never migrates a database that is being backfilled.
+server_lock = database.lock_database(database.storage_database_path(config.get("storage_backend", "sqlite"), **config.get("storage_options", {})))
+db = database.Database(ingest_queue_size=config.get("ingest_queue_size", 1000),
+                       ingest_worker_count=config.get("ingest_worker_count", 4),
+                       storage=database.create_storage(config.get("storage_backend", "sqlite"), **config.get("storage_options", {})),
+                       server_lock=server_lock,
+                       replay_log=replay_log.ReplayLog(max_segment_size=config.get("replay_log_max_segment_size", 16 * 1024 * 1024),
+                                                       flush_interval=config.get("replay_log_flush_interval", 1.0)))
+login_db = login_database.LoginDatabase(cache_ttl=config.get("login_cache_ttl", 60))
 login_manager = flask_login.LoginManager(app)
 login_manager.login_view = "login"
 try:
-    notification = notifications.Notifications(config["notifications_email"], config["notifications_email_password"], login_db)
+    notification = notifications.Notifications(config["notifications_email"], config["notifications_email_password"], login_db,
+                                               hysteresis=config.get("notifications_hysteresis"),
+                                               cooldown=config.get("notifications_cooldown", 3600),
+                                               **config.get("notifications_smtp", {}))
+    atexit.register(notification.close)
 except Exception:
     notification = None
+# Registered last so that it runs first, letting queued uploads send their notifications before the email sender closes.
+atexit.register(db.close)
+
+REQUEST_SECONDS = metrics.Histogram("ibuzz_http_request_seconds", "Time taken to handle a request, not including streamed bodies.", ("endpoint",))
+SERIALIZATION_SECONDS = metrics.Histogram("ibuzz_json_serialization_seconds", "Time taken to serialize a JSON response.", ("endpoint",))
+UPLOADS_REJECTED = metrics.Counter("ibuzz_uploads_rejected_total", "Uploads rejected because the ingest queue was full.")
+STREAMS_REJECTED = metrics.Counter("ibuzz_streams_rejected_total", "Live data streams rejected because max_streams were open.")
+metrics.Gauge("ibuzz_ingest_queue_depth", "Uploads waiting to be processed.", db.ingest_queue.depth)
+metrics.Gauge("ibuzz_pending_rows", "Rows waiting to be written by the batch writer.", lambda: len(db.batch_writer.pending))
+
+
+@app.before_request
+def start_request_timer():
+    flask.g.request_start_time = time.perf_counter()
+
+
+@app.after_request
+def observe_request_time(response):
+    start_time = flask.g.get("request_start_time")
+    if start_time is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - start_time, endpoint=flask.request.endpoint or "unknown")
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def fetch_metrics():
+    # Scrapers authenticate with the bearer token set by metrics_token in config.yaml. Without one, metrics aren't served,
+    # since requests passed on by a proxy on the same machine can't be told apart from local ones.
+    token = config.get("metrics_token")
+    if token is None:
+        return '', 404
+    if not hmac.compare_digest(flask.request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return '', 401
+    return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route('/', methods=['GET'])
@@ -31,8 +94,13 @@ def redirect_user():
 @app.route('/', methods=['POST'])
 def receive_json():
     json = flask.request.json
-    print(json)
-    db.data_received(json, notification.evaluate)
+    logger.debug("Upload received: %s", json)
+    try:
+        db.data_received(json, None if notification is None else notification.evaluate)
+    except queue.Full:
+        UPLOADS_REJECTED.inc()
+        # The Hawk will retry the upload later.
+        return '', 503, {"Retry-After": str(config.get("ingest_retry_after", 30))}
     return '', 200
 
 
@@ -68,7 +136,6 @@ def signup():
 @app.route('/signup', methods=['POST'])
 def signup_post():
     email = flask.request.form.get('email')
-    print(email)
     if login_db.fetch_user_by_email(email) is not None:
         return signup()
     name = flask.request.form.get('name')
@@ -110,19 +177,69 @@ def send_template(path):
     return flask.send_from_directory('templates', path)
 
 
+def conditional_response(serial_number, load):
+    """Return the JSON returned by load(), or 304 Not Modified if the client's copy is still current.
+
+    The ETag comes from the time in milliseconds that rows were last written for serial_number,
+    so load() isn't called when nothing has changed since the client last asked.
+    If-Modified-Since is ignored because it only has whole seconds, so a later write in the same second would be missed.
+    no-cache lets the browser and proxies store the data but makes them revalidate it with us on every use, which checks the
+    login. It varies by Cookie so that a cache doesn't give one user's copy to another."""
+    last_modified = db.fetch_last_modified(serial_number)
+    etag = f"{serial_number}-{int(last_modified * 1000)}"
+    last_modified_date = datetime.datetime.fromtimestamp(int(last_modified), datetime.timezone.utc)
+    request = flask.request
+    not_modified = request.if_none_match.contains_weak(etag)
+    if not_modified:
+        response = flask.Response(status=304)
+    else:
+        data = load()
+        with SERIALIZATION_SECONDS.time(endpoint=request.endpoint):
+            response = flask.jsonify(data)
+    # Weak because a proxy may compress the body.
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified_date
+    response.headers["Cache-Control"] = "no-cache"
+    response.vary.update(("Cookie", "Accept-Encoding"))
+    return response
+
+
 @app.route('/data/<path:path>', methods=['GET'])
 @flask_login.login_required
 def fetch_data(path):
+    # Passing a start time returns only the rows after it, so charts can ask for what is new since their last point.
+    # Those rows are raw unless a resolution is given, since a rollup bucket can start before the chart's last point.
     try:
         serial_number, hive_number, field, *start_time = path.split("/")
         if not login_db.check_visibility_permissions(flask_login.current_user.id, serial_number):
             return '', 400
-        return db.fetch_field(serial_number, hive_number, field, (0 if len(start_time) == 0 else start_time[0]))
+        return conditional_response(serial_number, lambda: db.fetch_field(
+            serial_number, hive_number, field, (0 if len(start_time) == 0 else start_time[0]),
+            resolution=flask.request.args.get("resolution", "auto" if len(start_time) == 0 else "raw")))
     except KeyError as e:
         error_logger.log_error(e)
         return {}
 
 
+@app.route('/batch_data/<path:path>', methods=['GET'])
+@flask_login.login_required
+def fetch_batch_data(path):
+    # ?fields=weight,humidity&hives=1,2 where hives is optional
+    # The resolution is raw by default when start_time is given, as for /data.
+    if not login_db.check_visibility_permissions(flask_login.current_user.id, path):
+        return '', 400
+    try:
+        fields = flask.request.args["fields"].split(",")
+        hives = flask.request.args.get("hives")
+        hive_numbers = None if hives is None else [int(hive_number) for hive_number in hives.split(",")]
+        start_time = flask.request.args.get("start_time", 0, type=float)
+        end_time = flask.request.args.get("end_time", type=float)
+        resolution = flask.request.args.get("resolution", "raw" if "start_time" in flask.request.args else "auto")
+        return conditional_response(path, lambda: db.fetch_fields(path, hive_numbers, fields, start_time, end_time, resolution))
+    except (KeyError, ValueError):
+        return '', 400
+
+
 @app.route('/names', methods=['GET'])
 def fetch_names():
     return {'names': db.fetch_names()}
@@ -153,11 +270,60 @@ def fetch_hive_numbers(path):
 @flask_login.login_required
 def fetch_recent_values(path):
     if login_db.check_visibility_permissions(flask_login.current_user.id, path):
-        return {'recent_values': db.fetch_most_recent_values(path)}
+        return conditional_response(path, lambda: {'recent_values': db.fetch_most_recent_values(path)})
     else:
         return '', 400
 
 
+# Each open stream holds a worker thread, so only max_streams can be open at once and the rest of the threads stay free for
+# uploads and other requests. Keep it well below the number of threads in start.sh.
+stream_slots = threading.BoundedSemaphore(config.get("max_streams", 8))
+
+
+@app.route('/stream', methods=['GET'])
+@flask_login.login_required
+def stream_live_data():
+    # ?serial=1234&serial=5678
+    # Server-sent events with a list of newly stored rows for a Hawk after each write, so dashboards don't have to poll.
+    # A dashboard uses one stream for all of its Hawks, since browsers only open a few connections to each site.
+    user_id = flask_login.current_user.id
+    serial_numbers = flask.request.args.getlist("serial")
+    if len(serial_numbers) == 0 or not all(login_db.check_visibility_permissions(user_id, serial_number) for serial_number in serial_numbers):
+        return '', 400
+    if not stream_slots.acquire(blocking=False):
+        STREAMS_REJECTED.inc()
+        return '', 503, {"Retry-After": str(config.get("stream_retry_after", 30))}
+    heartbeat_interval = config.get("stream_heartbeat_interval", 15)
+
+    def events():
+        subscription = db.subscribe(serial_numbers)
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    rows = subscription.get(timeout=heartbeat_interval)
+                except queue.Empty:
+                    rows = None
+                # Visibility can be removed while the stream is open.
+                if not all(login_db.check_visibility_permissions(user_id, serial_number) for serial_number in serial_numbers):
+                    return
+                if rows is None:
+                    # Comment lines keep proxies from closing an idle connection.
+                    yield ": heartbeat\n\n"
+                else:
+                    yield f"event: rows\ndata: {json.dumps(rows)}\n\n"
+        finally:
+            db.unsubscribe(serial_numbers, subscription)
+
+    response = flask.Response(events(), mimetype="text/event-stream")
+    # Called when the response is closed, even if the client disconnects before the stream starts.
+    response.call_on_close(stream_slots.release)
+    response.headers["Cache-Control"] = "no-cache"
+    # Stops nginx buffering the stream.
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
 @app.route('/register/<path:path>')
 @flask_login.login_required
 def register_hawk(path):
@@ -252,16 +418,54 @@ def fetch_notifications():
 @app.route('/download_replay/<path:path>')
 @flask_login.login_required
 def download_replay_log(path):
-    if login_db.check_hawk_ownership(flask_login.current_user.id, path):
-        return flask.send_file('replay_logs/' + path + ".txt", as_attachment=True)
-    else:
+    if not login_db.check_hawk_ownership(flask_login.current_user.id, path):
         return '', 403
-    
+    if not db.replay_log.exists(path):
+        return '', 404
+    start_time = flask.request.args.get("start_time", type=float)
+    end_time = flask.request.args.get("end_time", type=float)
+    # Lines of legacy logs are Python literals, so they are converted to make every line JSON.
+    chunks = replay_log.as_json_lines(db.replay_log.read(path, start_time, end_time))
+    headers = {"Content-Disposition": f"attachment; filename={path}.jsonl", "Vary": "Accept-Encoding"}
+    if "gzip" in flask.request.accept_encodings:
+        chunks = gzip_stream(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return flask.Response(flask.stream_with_context(chunks), mimetype="application/jsonl", headers=headers)
+
+
+def gzip_stream(chunks):
+    """Yield the gzip compressed form of a stream of text or bytes chunks."""
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
 
 @app.route('/download_data/<path:path>')
 @flask_login.login_required
 def download_data(path):
-    if login_db.check_visibility_permissions(flask_login.current_user.id, path):
-        return db.data_to_csv(path), {"Content-Type": "text/csv"}
-    else:
-        return '', 403
\ No newline at end of file
+    if not login_db.check_visibility_permissions(flask_login.current_user.id, path):
+        return '', 403
+    start_time = flask.request.args.get("start_time", type=int)
+    end_time = flask.request.args.get("end_time", type=int)
+    hive_number = flask.request.args.get("hive_number", type=int)
+    export_format = flask.request.args.get("format", "csv")
+    try:
+        chunks = db.export_data(path, export_format, start_time, end_time, hive_number)
+    except (KeyError, ImportError, ValueError):
+        return '', 400
+    content_type, extension = database.EXPORT_FORMATS[export_format]
+    headers = {"Content-Disposition": f"attachment; filename={path}.{extension}", "Vary": "Accept-Encoding"}
+    # Parquet and NumPy archives are already compressed.
+    if export_format in ("csv", "arrow") and "gzip" in flask.request.accept_encodings:
+        chunks = gzip_stream(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return flask.Response(flask.stream_with_context(chunks), mimetype=content_type, headers=headers)
+
+
+@app.route('/export_formats', methods=['GET'])
+@flask_login.login_required
+def fetch_export_formats():
+    return {'export_formats': db.export_formats()}
\ No newline at end of file
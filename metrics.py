@@ -0,0 +1,142 @@
+# Counters and histograms collected in memory and exposed in the Prometheus text format at /metrics.
+# Metrics are created once at import time by the modules that update them, and every update only takes a short lock.
+import bisect
+import functools
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets, from half a millisecond to ten seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Every metric that has been created, in the order they are rendered.
+REGISTRY = []
+
+
+def _label_text(label_names, label_values, extra=""):
+    labels = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+
+    def __init__(self, name, description, label_names=()):
+        """Number of times something has happened, for each combination of label values.
+
+        :param label_names: names of the labels that must be passed to :func:'~metrics.Counter.inc'"""
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        # A counter without labels is reported as 0 before anything has happened.
+        self.values = {} if self.label_names else {(): 0}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(_escape(labels[name]) for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_label_text(self.label_names, key)} {value}")
+        return lines
+
+
+class Gauge:
+
+    def __init__(self, name, description, function):
+        """Value that is read by calling function when the metrics are rendered, such as the length of a queue."""
+        self.name = name
+        self.description = description
+        self.function = function
+        REGISTRY.append(self)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge", f"{self.name} {self.function()}"]
+
+
+class Histogram:
+
+    def __init__(self, name, description, label_names=(), buckets=LATENCY_BUCKETS):
+        """Distribution of observed values, usually durations in seconds, for each combination of label values.
+
+        :param buckets: increasing upper bounds of the buckets that observations are counted in"""
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # [count in each bucket, with one more for values above every bound, sum of observed values] by label values
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(_escape(labels[name]) for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def time(self, **labels):
+        """Return a context manager that observes how many seconds its block takes."""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bound_label = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_label_text(self.label_names, key, bound_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_label_text(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start_time")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.histogram.observe(time.perf_counter() - self.start_time, **self.labels)
+
+
+def timed(histogram, label_name="query"):
+    """Decorator that observes how long each call to a method takes in histogram, labelled with the method's name."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**{label_name: method.__name__}):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -1,80 +1,185 @@
-import smtplib
+import bisect
+import threading
+import time
+from email_sender import EmailSender
+from latest_values import serial_number_key
+
+
+WEATHER_STATION_SENSORS = ["outside_temperature", "outside_humidity"]
+HIVE_SENSORS = ["temperature_1", "temperature_2", "temperature_3", "humidity", "weight", "accelerometer", "bees_out", "bees_in", "frequency"]
+
+# How far a value has to move back past a threshold before the notification can be sent again, in each sensor's units.
+DEFAULT_HYSTERESIS = {"outside_temperature": 0.5, "outside_humidity": 2, "temperature_1": 0.5, "temperature_2": 0.5, "temperature_3": 0.5,
+                      "humidity": 2, "weight": 0.5, "accelerometer": 1, "bees_out": 5, "bees_in": 5, "frequency": 5}
 
 
 class Notifications:
 
 
-    def __init__(self, gmail, password, login_db):
+    def __init__(self, gmail, password, login_db, hysteresis=None, cooldown=3600, **email_sender_options):
+        """Send email notifications when sensor values cross the thresholds set by users.
+
+        After a notification is sent it isn't sent again until the value has moved back past the threshold by the sensor's hysteresis,
+        and never more than once every cooldown seconds.
+        :param dict hysteresis: hysteresis by sensor name, overriding DEFAULT_HYSTERESIS
+        :param float cooldown: minimum number of seconds between emails for the same notification
+        :param email_sender_options: keyword arguments passed to :class:'~email_sender.EmailSender', such as host and port"""
         self.from_email = gmail
-        self.smtp = smtplib.SMTP('smtp.gmail.com', 587)
-        self.smtp.starttls()
-        self.smtp.login(self.from_email, password)
+        self.email_sender = EmailSender(self.from_email, password, **email_sender_options)
         self.login_db = login_db
+        self.index = NotificationIndex(login_db)
+        self.hysteresis = dict(DEFAULT_HYSTERESIS, **(hysteresis or {}))
+        self.cooldown = cooldown
 
+    def close(self):
+        """Send all queued emails."""
+        self.email_sender.close()
 
     def send_email_notification(self, recipient, subject, message):
-        """Send an email to the given recipient.
+        """Queue an email to the given recipient to be sent in the background.
         
         :param str recipient: recipient's email address"""
-        email = f"""From: {self.from_email}\nTo: {recipient}\nSubject: {subject}\n\n{message}"""
-        self.smtp.sendmail(self.from_email, recipient, email)
+        self.email_sender.send(recipient, subject, message)
 
 
     def evaluate(self, current_weather_station_data, current_hive_data, previous_weather_station_data, previous_hive_data):
         """Check if any of the current data given meet the requirements for a notification and the previous values don't and send a notification if this is the case."""
         serial_number = current_weather_station_data.serial_number
-        notifications = self.login_db.fetch_notifications(serial_number=serial_number)
-        if len(notifications) == 0:
-            return
-        print(len(notifications), notifications)
-        for notification in notifications:
-            user = self.login_db.fetch_user(notification[1])
-            # If the user account doesn't exist anymore, delete the notification.
-            if user is None:
-                self.login_db.remove_notification(notification[1], notification[0])
-                continue
-            hive_number, sensor, sign, value = notification[3], notification[4], notification[5], notification[6]
-            # There may be a better way to do this... perhaps this should be in the HiveData classes.
-            if sensor == "outside_temperature":
-                current_sensor_value = current_weather_station_data.outside_temperature
-                previous_sensor_value = previous_weather_station_data.outside_temperature
-            elif sensor == "outside_humidity":
-                current_sensor_value = current_weather_station_data.outside_humidity
-                previous_sensor_value = previous_weather_station_data.outside_humidity
-            elif sensor == "temperature_1":
-                current_sensor_value = current_hive_data.temperature_1
-                previous_sensor_value = previous_hive_data.temperature_1
-            elif sensor == "temperature_2":
-                current_sensor_value = current_hive_data.temperature_2
-                previous_sensor_value = previous_hive_data.temperature_2
-            elif sensor == "temperature_3":
-                current_sensor_value = current_hive_data.temperature_3
-                previous_sensor_value = previous_hive_data.temperature_3
-            elif sensor == "humidity":
-                current_sensor_value = current_hive_data.humidity
-                previous_sensor_value = previous_hive_data.humidity
-            elif sensor == "weight":
-                current_sensor_value = current_hive_data.weight
-                previous_sensor_value = previous_hive_data.weight
-            elif sensor == "accelerometer":
-                current_sensor_value = current_hive_data.accelerometer
-                previous_sensor_value = previous_hive_data.accelerometer
-            elif sensor == "bees_out":
-                current_sensor_value = current_hive_data.bees_out
-                previous_sensor_value = previous_hive_data.bees_out
-            elif sensor == "bees_in":
-                current_sensor_value = current_hive_data.bees_in
-                previous_sensor_value = previous_hive_data.bees_in
-            elif sensor == "frequency":
-                current_sensor_value = current_hive_data.frequency
-                previous_sensor_value = previous_hive_data.frequency
+        hive_number = current_hive_data.hive_number
+        for sensor, rules in self.index.fetch(serial_number, hive_number):
+            if sensor in WEATHER_STATION_SENSORS:
+                current_sensor_value = getattr(current_weather_station_data, sensor)
+                previous_sensor_value = getattr(previous_weather_station_data, sensor)
             else:
+                current_sensor_value = getattr(current_hive_data, sensor)
+                previous_sensor_value = getattr(previous_hive_data, sensor)
+            if current_sensor_value is None or previous_sensor_value is None:
                 continue
-            print(hive_number, sensor, sign, value, current_sensor_value, previous_sensor_value, user.email, sign == ">", current_sensor_value > value, not previous_sensor_value > value, sign == "<", current_sensor_value < value, not previous_sensor_value < value)
-            if sign == ">" and current_sensor_value > value and not previous_sensor_value > value:
-                    self.send_email_notification(user.email, f"iBuzz ALERT {sensor}", f"{sensor} in hive '{serial_number} - {hive_number}' was detected at {current_sensor_value} which is greater than your threshold of {value}")
+            now = time.time()
+            self.index.rearm(rules, current_sensor_value, self.hysteresis.get(sensor, 0))
+            for rule in rules.crossed_above(previous_sensor_value, current_sensor_value):
+                if self.index.fire(rules, rule, now, self.cooldown):
+                    self.send_email_notification(rule.email, f"iBuzz ALERT {sensor}", f"{sensor} in hive '{serial_number} - {hive_number}' was detected at {current_sensor_value} which is greater than your threshold of {rule.value}")
+            for rule in rules.crossed_below(previous_sensor_value, current_sensor_value):
+                if self.index.fire(rules, rule, now, self.cooldown):
+                    self.send_email_notification(rule.email, f"iBuzz ALERT {sensor}", f"{sensor} in hive '{serial_number} - {hive_number}' was detected at {current_sensor_value} which is lower than your threshold of {rule.value}")
+
+
+class Rule:
+    __slots__ = ("notification_id", "email", "sign", "value", "armed", "last_fired")
+
+    def __init__(self, notification_id, email, sign, value, armed=True, last_fired=None):
+        """A single notification and whether it can currently be sent.
+
+        :param bool armed: False after the notification has been sent until the value moves back past the threshold
+        :param last_fired: time the notification was last sent, or None"""
+        self.notification_id = notification_id
+        self.email = email
+        self.sign = sign
+        self.value = value
+        self.armed = armed
+        self.last_fired = last_fired
+
+
+class SensorRules:
+
+    def __init__(self):
+        """Hold the thresholds of the notifications for one sensor of one hive, sorted so crossed thresholds can be found by bisection."""
+        self.above_values, self.above_rules = [], []
+        self.below_values, self.below_rules = [], []
+        # Rules that have been sent and are waiting for the value to move back past their threshold.
+        self.disarmed = {}
+
+    def add(self, rule):
+        if rule.sign == ">":
+            values, rules = self.above_values, self.above_rules
+        elif rule.sign == "<":
+            values, rules = self.below_values, self.below_rules
+        else:
+            return
+        position = bisect.bisect(values, rule.value)
+        values.insert(position, rule.value)
+        rules.insert(position, rule)
+        if not rule.armed:
+            self.disarmed[rule.notification_id] = rule
+
+    def crossed_above(self, previous_value, current_value):
+        """Return each '>' rule where previous_value <= value < current_value."""
+        return self.above_rules[bisect.bisect_left(self.above_values, previous_value):bisect.bisect_left(self.above_values, current_value)]
+
+    def crossed_below(self, previous_value, current_value):
+        """Return each '<' rule where current_value < value <= previous_value."""
+        return self.below_rules[bisect.bisect_right(self.below_values, current_value):bisect.bisect_right(self.below_values, previous_value)]
+
+
+class NotificationIndex:
+
+    def __init__(self, login_db):
+        """Hold every notification in memory grouped by serial_number, hive_number and sensor.
+
+        The index is rebuilt when login_db reports that the Notifications table has changed."""
+        self.login_db = login_db
+        self.version = None
+        self.rules = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Rebuild the index if the Notifications table has changed since it was built."""
+        with self.lock:
+            version = self.login_db.notifications_version
+            if version == self.version:
+                return
+            rules = {}
+            users = {}
+            states = self.login_db.fetch_notification_states()
+            for notification in self.login_db.fetch_all_notifications():
+                notification_id, user_id, serial_number, hive_number, sensor, sign, value = notification
+                if sensor not in WEATHER_STATION_SENSORS and sensor not in HIVE_SENSORS:
                     continue
-            if sign == "<" and current_sensor_value < value and not previous_sensor_value < value:
-                    self.send_email_notification(user.email, f"iBuzz ALERT {sensor}", f"{sensor} in hive '{serial_number} - {hive_number}' was detected at {current_sensor_value} which is lower than your threshold of {value}")
+                if user_id not in users:
+                    users[user_id] = self.login_db.fetch_user(user_id)
+                # If the user account doesn't exist anymore, delete the notification.
+                if users[user_id] is None:
+                    self.login_db.remove_notification(user_id, notification_id)
                     continue
-            
+                hive_rules = rules.setdefault((serial_number_key(serial_number), serial_number_key(hive_number)), {})
+                armed, last_fired = states.get(notification_id, (True, None))
+                hive_rules.setdefault(sensor, SensorRules()).add(Rule(notification_id, users[user_id].email, sign, value, bool(armed), last_fired))
+            self.rules = rules
+            self.version = version
+
+    def fetch(self, serial_number, hive_number):
+        """Return a list of (sensor, SensorRules) for the given hive, including notifications set for every hive of the Hawk."""
+        self.refresh()
+        serial_number, hive_number = serial_number_key(serial_number), serial_number_key(hive_number)
+        return list(self.rules.get((serial_number, hive_number), {}).items()) + list(self.rules.get((serial_number, None), {}).items())
+
+    def fire(self, sensor_rules, rule, now, cooldown):
+        """Record that a rule in sensor_rules has had its threshold crossed and return True if its notification should be sent.
+
+        The notification isn't sent if the rule is disarmed or was sent less than cooldown seconds ago.
+        Either way the rule is disarmed until :func:'~notifications.NotificationIndex.rearm' sees the value move back past the threshold."""
+        with self.lock:
+            if not rule.armed:
+                return False
+            send = rule.last_fired is None or now - rule.last_fired >= cooldown
+            rule.armed = False
+            if send:
+                rule.last_fired = now
+            sensor_rules.disarmed[rule.notification_id] = rule
+        self.login_db.set_notification_state(rule.notification_id, rule.armed, rule.last_fired)
+        return send
+
+    def rearm(self, sensor_rules, current_value, hysteresis):
+        """Rearm the disarmed rules in sensor_rules whose threshold current_value has moved back past by at least hysteresis."""
+        if len(sensor_rules.disarmed) == 0:
+            return
+        rearmed = []
+        with self.lock:
+            for rule in list(sensor_rules.disarmed.values()):
+                if (rule.sign == ">" and current_value <= rule.value - hysteresis) or (rule.sign == "<" and current_value >= rule.value + hysteresis):
+                    rule.armed = True
+                    del sensor_rules.disarmed[rule.notification_id]
+                    rearmed.append(rule)
+        for rule in rearmed:
+            self.login_db.set_notification_state(rule.notification_id, rule.armed, rule.last_fired)
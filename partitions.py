@@ -0,0 +1,154 @@
+# Data rows are stored in one table per calendar month (UTC), named Data_YYYYMM, so that writes and recent reads only touch
+# small tables however much history is kept. Old months can be moved into a separate archive database that is attached read-only.
+import calendar
+import sqlite3
+import threading
+import time
+
+PREFIX = "Data_"
+ARCHIVE_ALIAS = "archive"
+
+
+def create_table(connection, name):
+    """Create a table with the Data table layout if it doesn't exist.
+
+    Rows are stored in primary key order so that a hive's rows over a time range are read together, with every column."""
+    connection.execute(f"""CREATE TABLE IF NOT EXISTS {name} (
+                            serial_number	INTEGER,
+                            outside_humidity	NUMERIC,
+                            outside_temperature	NUMERIC,
+                            time	INTEGER,
+                            hive_number INTEGER,
+                            temperature_1  NUMERIC,
+                            temperature_2  NUMERIC,
+                            temperature_3  NUMERIC,
+                            humidity NUMERIC,
+                            weight NUMERIC,
+                            accelerometer   NUMERIC,
+                            bees_out INTEGER,
+                            bees_in INTEGER,
+                            frequency NUMERIC,
+                            PRIMARY KEY(serial_number, hive_number, time)
+                        ) WITHOUT ROWID;""")
+
+
+def create_registry(connection):
+    """Create the Partitions table that lists every partition and whether it has been archived."""
+    connection.execute("""CREATE TABLE IF NOT EXISTS Partitions (
+                            name TEXT,
+                            start_time INTEGER,
+                            end_time INTEGER,
+                            archived INTEGER,
+                            PRIMARY KEY(name)
+                        );""")
+
+
+def name_for_time(row_time):
+    """Return the name of the partition that holds rows with the given time."""
+    month = time.gmtime(int(row_time))
+    return f"{PREFIX}{month.tm_year:04}{month.tm_mon:02}"
+
+
+def bounds(name):
+    """Return the first time in a partition and the first time after it."""
+    year, month = int(name[len(PREFIX):len(PREFIX) + 4]), int(name[len(PREFIX) + 4:])
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return calendar.timegm((year, month, 1, 0, 0, 0)), calendar.timegm((next_year, next_month, 1, 0, 0, 0))
+
+
+def add(connection, name):
+    """Create a partition and record it in the Partitions table if it doesn't exist."""
+    create_table(connection, name)
+    connection.execute("""INSERT OR IGNORE INTO Partitions VALUES (?, ?, ?, 0)""", (name, *bounds(name)))
+
+
+class Partitions:
+
+    def __init__(self, pool, archive_path="archive.db"):
+        """Route Data table queries to the monthly partitions that can hold the rows they ask for.
+
+        :param pool: :class:'~connection_pool.ConnectionPool' of a database with a Partitions table
+        :param str archive_path: database file that archived partitions are moved to"""
+        self.pool = pool
+        self.archive_path = archive_path
+        self.lock = threading.Lock()
+        # (start_time, end_time, archived) by partition name
+        self.partitions = {}
+        cursor = self.pool.reader().cursor()
+        cursor.execute("""SELECT name, start_time, end_time, archived FROM Partitions""")
+        for name, start_time, end_time, archived in cursor.fetchall():
+            self.partitions[name] = (start_time, end_time, bool(archived))
+        cursor.close()
+        if any(archived for start_time, end_time, archived in self.partitions.values()):
+            self.pool.attach(ARCHIVE_ALIAS, self.archive_path)
+
+    def table(self, name):
+        """Return the name that a partition's table is queried by."""
+        start_time, end_time, archived = self.partitions[name]
+        return f"{ARCHIVE_ALIAS}.{name}" if archived else name
+
+    def between(self, start_time=None, end_time=None):
+        """Return the tables of the partitions that can hold rows with times from start_time up to end_time, oldest first.
+
+        Fetch the tables before the connection that will query them, so that an archive that has just been attached is included."""
+        start_time = float("-inf") if start_time is None else float(start_time)
+        end_time = float("inf") if end_time is None else float(end_time)
+        with self.lock:
+            names = sorted(name for name, (partition_start, partition_end, archived) in self.partitions.items()
+                           if partition_end > start_time and partition_start < end_time)
+            return [self.table(name) for name in names]
+
+    def is_archived(self, name):
+        """Return True if the partition has been moved into the archive database."""
+        with self.lock:
+            partition = self.partitions.get(name)
+            return partition is not None and partition[2]
+
+    def add(self, name):
+        """Create a partition if it doesn't exist yet.
+
+        Must not be called while holding the write lock. The partition is committed before rows are written to it,
+        so it is never missing from the Partitions table."""
+        with self.lock:
+            if name in self.partitions:
+                return
+        with self.pool.writer() as connection:
+            add(connection, name)
+        with self.lock:
+            self.partitions[name] = (*bounds(name), False)
+
+    def archive(self, before_time):
+        """Move every partition that ends at or before before_time into the read-only archive database.
+
+        Rollups, latest values and hive numbers stay in the main database, so only raw reads and exports of archived months
+        read the archive. Rows for archived months can no longer be written. The main database is vacuumed afterwards, so that
+        the dropped tables no longer take up space in its file. See archive.py for archiving from the command line.
+        :return: names of the partitions that were archived"""
+        with self.lock:
+            names = sorted(name for name, (start_time, end_time, archived) in self.partitions.items() if end_time <= before_time and not archived)
+        for name in names:
+            with self.pool.writer() as connection:
+                archive = sqlite3.connect(self.archive_path)
+                try:
+                    create_table(archive, name)
+                    rows = connection.execute(f"""SELECT * FROM {name}""")
+                    while True:
+                        chunk = rows.fetchmany(10000)
+                        if len(chunk) == 0:
+                            break
+                        archive.executemany(f"""INSERT OR IGNORE INTO {name} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", chunk)
+                    archive.commit()
+                finally:
+                    archive.close()
+                # Queries are routed to the archive before the table is dropped, so none of them find it missing.
+                self.pool.attach(ARCHIVE_ALIAS, self.archive_path)
+                with self.lock:
+                    self.partitions[name] = (*bounds(name), True)
+                connection.execute("""BEGIN""")
+                connection.execute(f"""DROP TABLE {name}""")
+                connection.execute("""UPDATE Partitions SET archived = 1 WHERE name = ?""", (name,))
+        if names:
+            # Dropping a table only frees its pages for reuse, VACUUM rewrites the file without them.
+            with self.pool.writer() as connection:
+                connection.execute("""VACUUM""")
+        return names
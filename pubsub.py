@@ -0,0 +1,53 @@
+import queue
+import threading
+
+
+class PubSub:
+
+    def __init__(self, queue_size=100):
+        """Pass messages published under a key to every subscriber of that key.
+
+        Each subscriber has its own queue of at most queue_size messages. A subscriber that falls behind loses its oldest messages
+        instead of slowing down the publisher.
+        :param int queue_size: number of messages held for each subscriber"""
+        self.queue_size = queue_size
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, keys):
+        """Return a single queue that will receive every message published under any of keys until it is unsubscribed."""
+        subscription = queue.Queue(self.queue_size)
+        with self.lock:
+            for key in keys:
+                self.subscribers.setdefault(key, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, keys, subscription):
+        """Stop passing messages published under keys to subscription."""
+        with self.lock:
+            for key in keys:
+                subscriptions = self.subscribers.get(key)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if len(subscriptions) == 0:
+                        del self.subscribers[key]
+
+    def subscriber_count(self, key):
+        """Return the number of subscribers of key."""
+        with self.lock:
+            return len(self.subscribers.get(key, ()))
+
+    def publish(self, key, message):
+        """Pass message to every subscriber of key without waiting."""
+        with self.lock:
+            subscriptions = list(self.subscribers.get(key, ()))
+        for subscription in subscriptions:
+            while True:
+                try:
+                    subscription.put_nowait(message)
+                    break
+                except queue.Full:
+                    try:
+                        subscription.get_nowait()
+                    except queue.Empty:
+                        pass
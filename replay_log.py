@@ -1,19 +1,275 @@
+# Each log is written to <name>.jsonl in the replay log folder, one JSON object per line holding the time it was received
+# and the received JSON. When the active file gets too large, or a new UTC day starts, it is renamed to a rotated segment that
+# a background thread compresses into <name>.<first time>.jsonl.gz and records in <name>.index.json with the times it covers.
+# Logs written before this format are kept in <name>.txt, one str() of the received dictionary per line.
+import ast
+import gzip
+import json
 import os
+import threading
+import time
+from collections import OrderedDict
+import error_logger
+
+ACTIVE_EXTENSION = ".jsonl"
+SEGMENT_EXTENSION = ".jsonl.gz"
+INDEX_EXTENSION = ".index.json"
+LEGACY_EXTENSION = ".txt"
+
+
+def encode_line(received_time, data):
+    """Return the line that is written to a log for data received at received_time."""
+    return json.dumps({"time": received_time, "json": data}, separators=(",", ":"), default=str) + "\n"
+
+
+def decode_line(line):
+    """Return (received time, JSON) for a line of a log.
+
+    Lines of logs written before the JSON Lines format have no received time, so None is returned for it.
+    :raises ValueError: if the line can't be read"""
+    line = line.strip()
+    if line.startswith('{"time":'):
+        entry = json.loads(line)
+        return entry["time"], entry["json"]
+    # Older logs hold the str() of the received dictionary, which is a Python literal rather than JSON.
+    return None, ast.literal_eval(line)
+
+
+def as_json_lines(lines):
+    """Yield lines of a log with lines of logs written before the JSON Lines format re-encoded as JSON Lines, without a
+    received time. Legacy lines that can't be read are left out."""
+    for line in lines:
+        if line.startswith('{"time":'):
+            yield line
+            continue
+        try:
+            yield encode_line(None, decode_line(line)[1])
+        except (ValueError, SyntaxError):
+            continue
+
 
 class ReplayLog:
 
-    def __init__(self, replay_log_folder="replay_logs/"):
+    def __init__(self, replay_log_folder="replay_logs/", max_segment_size=16 * 1024 * 1024, flush_interval=1.0, max_open_files=64):
+        """Write everything received from each Hawk to a log that it can be replayed from.
+
+        Files are kept open and written through a buffer that a background thread flushes every flush_interval seconds.
+        :param int max_segment_size: number of bytes after which the active file of a log is compressed into a segment
+        :param int max_open_files: number of logs kept open at once, the least recently written is closed first"""
         self.replay_log_folder = replay_log_folder
         if not os.path.isdir(replay_log_folder):
             os.mkdir(replay_log_folder)
+        self.max_segment_size = max_segment_size
+        self.flush_interval = flush_interval
+        self.max_open_files = max_open_files
+        # [file, UTC day of the first line] of each open active file, by log name, least recently written first.
+        self.open_files = OrderedDict()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.condition = threading.Condition(self.lock)
+        # Rotated segments waiting to be compressed. They stay listed until they are in the index, so they can still be read.
+        self.rotated = []
+        # Rotated segments that couldn't be compressed. They are read in place and compressed again by the next run.
+        self.failed = []
+        # Segments left rotated but not compressed by a previous run are compressed first.
+        for file_name in sorted(os.listdir(replay_log_folder)):
+            if file_name.endswith(ACTIVE_EXTENSION) and file_name.count(".") == 2:
+                self.rotated.append(os.path.join(replay_log_folder, file_name))
+        self.thread = threading.Thread(target=self._run, name="replay-log", daemon=True)
+        self.thread.start()
 
-    def add_to_log(self, log_name, text):
-        """Write a string to a log with the given name.
-        
-        :param str log_name: Name of the log file that will be written to. Doesn't need to end in '.txt'."""
+    def _path(self, log_name, extension):
+        return os.path.join(self.replay_log_folder, str(log_name) + extension)
+
+    def add_to_log(self, log_name, data):
+        """Write received JSON to the log with the given name.
+
+        :param log_name: name of the log, usually the serial number of the Hawk
+        :param data: received JSON"""
         try:
-            path = self.replay_log_folder + ("" if self.replay_log_folder.endswith("/") else "/") + str(log_name) + ("" if str(log_name).endswith(".txt") else ".txt")
-            with open(path, "a+") as log:
-                log.write(str(text) + "\n")
+            log_name = str(log_name)
+            if log_name == "" or "." in log_name or os.path.basename(log_name) != log_name:
+                raise ValueError("Invalid replay log name")
+            received_time = time.time()
+            line = encode_line(received_time, data)
+            with self.lock:
+                self._write(log_name, line, received_time)
         except Exception as e:
-            print(e)
\ No newline at end of file
+            error_logger.log_error(f"Unable to write to replay log: {e}", details={"log": log_name})
+
+    def _write(self, log_name, line, received_time):
+        day = int(received_time // 86400)
+        entry = self.open_files.get(log_name)
+        if entry is None:
+            entry = self._open(log_name, day)
+        elif entry[1] != day:
+            self._rotate(log_name)
+            entry = self._open(log_name, day)
+        self.open_files.move_to_end(log_name)
+        entry[0].write(line)
+        if entry[0].tell() >= self.max_segment_size:
+            self._rotate(log_name)
+
+    def _open(self, log_name, day):
+        path = self._path(log_name, ACTIVE_EXTENSION)
+        if os.path.exists(path):
+            # Continue an active file left by a previous run unless it was started on a different day.
+            with open(path) as existing:
+                first_line = existing.readline()
+            try:
+                first_day = int(decode_line(first_line)[0] // 86400)
+            except Exception:
+                first_day = day
+            if first_day != day:
+                self._rename_for_compression(log_name)
+        while len(self.open_files) >= self.max_open_files:
+            oldest_file, oldest_day = self.open_files.popitem(last=False)[1]
+            oldest_file.close()
+        entry = self.open_files[log_name] = [open(path, "a", buffering=64 * 1024), day]
+        return entry
+
+    def _rotate(self, log_name):
+        log_file, day = self.open_files.pop(log_name)
+        log_file.close()
+        self._rename_for_compression(log_name)
+
+    def _rename_for_compression(self, log_name):
+        path = self._path(log_name, ACTIVE_EXTENSION)
+        rotated_path = self._path(log_name, f".{time.time_ns()}{ACTIVE_EXTENSION}")
+        os.replace(path, rotated_path)
+        self.rotated.append(rotated_path)
+        self.condition.notify()
+
+    def flush(self):
+        """Write all buffered lines to their files."""
+        with self.lock:
+            for log_file, day in self.open_files.values():
+                log_file.flush()
+
+    def close(self):
+        """Stop the background thread after compressing rotated segments, and close every file."""
+        with self.lock:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        with self.lock:
+            for log_file, day in self.open_files.values():
+                log_file.close()
+            self.open_files.clear()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.rotated and not self.closed:
+                    self.condition.wait(self.flush_interval)
+                for log_file, day in self.open_files.values():
+                    log_file.flush()
+                rotated = list(self.rotated)
+                closed = self.closed
+            for rotated_path in rotated:
+                try:
+                    self._compress(rotated_path)
+                except Exception as e:
+                    error_logger.log_error(f"Unable to compress replay log segment: {e}", details={"segment": rotated_path})
+                    with self.lock:
+                        self.rotated.remove(rotated_path)
+                        self.failed.append(rotated_path)
+            if closed:
+                return
+
+    def _compress(self, rotated_path):
+        """Compress a rotated segment and record the times it covers in the index of its log."""
+        log_name = os.path.basename(rotated_path).split(".")[0]
+        lines = 0
+        with open(rotated_path) as source:
+            first_line = source.readline()
+            if first_line == "":
+                with self.lock:
+                    os.remove(rotated_path)
+                    self.rotated.remove(rotated_path)
+                return
+            start_time = end_time = decode_line(first_line)[0]
+            segment_path = self._path(log_name, f".{int(start_time * 1000)}{SEGMENT_EXTENSION}")
+            with gzip.open(segment_path + ".tmp", "wt") as segment:
+                segment.write(first_line)
+                lines += 1
+                for line in source:
+                    segment.write(line)
+                    lines += 1
+                    try:
+                        end_time = decode_line(line)[0]
+                    except ValueError:
+                        # A partial line from a crash is kept, but doesn't change the times.
+                        pass
+        os.replace(segment_path + ".tmp", segment_path)
+        with self.lock:
+            index = self.segments(log_name)
+            index.append({"file": os.path.basename(segment_path), "start_time": start_time, "end_time": end_time, "lines": lines})
+            index.sort(key=lambda segment: segment["start_time"])
+            with open(self._path(log_name, INDEX_EXTENSION + ".tmp"), "w") as index_file:
+                json.dump(index, index_file)
+            os.replace(self._path(log_name, INDEX_EXTENSION + ".tmp"), self._path(log_name, INDEX_EXTENSION))
+            os.remove(rotated_path)
+            self.rotated.remove(rotated_path)
+
+    def segments(self, log_name):
+        """Return the compressed segments of a log, each a dictionary of file, start_time, end_time and lines, oldest first."""
+        try:
+            with open(self._path(log_name, INDEX_EXTENSION)) as index_file:
+                return json.load(index_file)
+        except FileNotFoundError:
+            return []
+
+    def exists(self, log_name):
+        """Return True if anything has been written to the log with the given name."""
+        log_name = str(log_name)
+        with self.lock:
+            return (log_name in self.open_files or len(self.segments(log_name)) > 0
+                    or any(os.path.exists(self._path(log_name, extension)) for extension in (ACTIVE_EXTENSION, LEGACY_EXTENSION))
+                    or any(os.path.basename(path).split(".")[0] == log_name for path in self.rotated + self.failed))
+
+    def read(self, log_name, start_time=None, end_time=None):
+        """Yield the lines of a log that were received from start_time up to end_time, oldest first.
+
+        Compressed segments outside the time range aren't read. Lines of logs written before the JSON Lines format have no
+        received time, so they are only included when start_time is None.
+        :param log_name: name of the log, usually the serial number of the Hawk
+        :param start_time: if given, only lines received at or after start_time are included
+        :param end_time: if given, only lines received before end_time are included"""
+        log_name = str(log_name)
+        lower = float("-inf") if start_time is None else float(start_time)
+        upper = float("inf") if end_time is None else float(end_time)
+        files = []
+        # Every file is opened while holding the lock, so a segment being compressed or rotated is read exactly once.
+        with self.lock:
+            entry = self.open_files.get(log_name)
+            if entry is not None:
+                entry[0].flush()
+            if start_time is None and os.path.exists(self._path(log_name, LEGACY_EXTENSION)):
+                files.append(open(self._path(log_name, LEGACY_EXTENSION)))
+            for segment in self.segments(log_name):
+                if segment["end_time"] >= lower and segment["start_time"] < upper:
+                    files.append(gzip.open(os.path.join(self.replay_log_folder, segment["file"]), "rt"))
+            for path in sorted(self.rotated + self.failed):
+                if os.path.basename(path).split(".")[0] == log_name:
+                    files.append(open(path))
+            if os.path.exists(self._path(log_name, ACTIVE_EXTENSION)):
+                files.append(open(self._path(log_name, ACTIVE_EXTENSION)))
+        try:
+            for log_file in files:
+                for line in log_file:
+                    # The last line of the active file may still be being written.
+                    if not line.endswith("\n"):
+                        break
+                    try:
+                        received_time = decode_line(line)[0] if line.startswith('{"time":') else None
+                    except ValueError:
+                        continue
+                    if received_time is None:
+                        if start_time is None:
+                            yield line
+                    elif lower <= received_time < upper:
+                        yield line
+        finally:
+            for log_file in files:
+                log_file.close()
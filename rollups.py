@@ -0,0 +1,148 @@
+# The Rollups table holds the minimum, maximum, mean and count of each sensor field for each hive over each hour and day,
+# so that long time ranges can be charted without reading every row.
+
+# Number of seconds covered by each bucket.
+RESOLUTIONS = {"hourly": 3600, "daily": 86400}
+HOURLY = RESOLUTIONS["hourly"]
+DAILY = RESOLUTIONS["daily"]
+
+FIELDS = ['outside_humidity', 'outside_temperature', 'temperature_1', 'temperature_2', 'temperature_3', 'humidity', 'weight',
+          'accelerometer', 'bees_out', 'bees_in', 'frequency']
+
+# Longest time ranges that are returned at each resolution when the resolution is chosen automatically.
+AUTOMATIC_RAW_RANGE = 7 * DAILY
+AUTOMATIC_HOURLY_RANGE = 180 * DAILY
+
+
+def _field_summaries(table, bucket_expression, where):
+    """Return a query that summarises every field of the rows in a Data table partition matching where, grouped into buckets."""
+    return " UNION ALL ".join(
+        f"""SELECT :resolution, serial_number, hive_number, {bucket_expression}, '{field}', MIN({field}), MAX({field}), AVG({field}), COUNT({field})
+        FROM {table} WHERE {where} GROUP BY serial_number, hive_number, {bucket_expression}"""
+        for field in FIELDS)
+
+
+def _update_hourly(table):
+    return "INSERT OR REPLACE INTO Rollups " + _field_summaries(
+        table, ":bucket", "serial_number = :serial_number and hive_number = :hive_number and time >= :bucket and time < :bucket + :resolution")
+
+
+def _rebuild_hourly(table):
+    return "INSERT OR REPLACE INTO Rollups " + _field_summaries(table, "time / :resolution * :resolution", "1")
+
+
+UPDATE_DAILY = """INSERT OR REPLACE INTO Rollups
+                  SELECT :resolution, serial_number, hive_number, :bucket, field, MIN(minimum), MAX(maximum), SUM(mean * count) / SUM(count), SUM(count)
+                  FROM Rollups WHERE resolution = :hourly and serial_number = :serial_number and hive_number = :hive_number and bucket >= :bucket and bucket < :bucket + :resolution
+                  GROUP BY serial_number, hive_number, field"""
+REBUILD_DAILY = """INSERT OR REPLACE INTO Rollups
+                   SELECT :resolution, serial_number, hive_number, bucket / :resolution * :resolution, field, MIN(minimum), MAX(maximum), SUM(mean * count) / SUM(count), SUM(count)
+                   FROM Rollups WHERE resolution = :hourly
+                   GROUP BY serial_number, hive_number, bucket / :resolution, field"""
+
+
+def create_table(connection):
+    """Create the Rollups table if it doesn't exist.
+
+    :return: True if the table was created"""
+    exists = connection.execute("""SELECT name FROM sqlite_master WHERE type = 'table' and name = 'Rollups'""").fetchone() is not None
+    connection.execute("""CREATE TABLE IF NOT EXISTS Rollups (
+                            resolution INTEGER,
+                            serial_number INTEGER,
+                            hive_number INTEGER,
+                            bucket INTEGER,
+                            field TEXT,
+                            minimum NUMERIC,
+                            maximum NUMERIC,
+                            mean NUMERIC,
+                            count INTEGER,
+                            PRIMARY KEY(resolution, serial_number, hive_number, field, bucket)
+                        );""")
+    return not exists
+
+
+def update(connection, serial_numbers, hive_numbers, times, table_for_time):
+    """Recalculate the hourly and daily rollups that contain the given rows.
+
+    Buckets are recalculated from the stored rows, so rows that were ignored as duplicates aren't counted twice.
+    :param connection: connection with an open transaction that the rows were inserted in
+    :param serial_numbers: serial_number of each inserted row
+    :param hive_numbers: hive_number of each inserted row
+    :param times: time of each inserted row
+    :param table_for_time: method that returns the Data table partition holding rows with a given time"""
+    hours = {(serial_number, hive_number, row_time // HOURLY * HOURLY) for serial_number, hive_number, row_time in zip(serial_numbers, hive_numbers, times)}
+    days = {(serial_number, hive_number, bucket // DAILY * DAILY) for serial_number, hive_number, bucket in hours}
+    # Partitions are whole months, so every hour is in a single partition.
+    hours_by_table = {}
+    for serial_number, hive_number, bucket in hours:
+        hours_by_table.setdefault(table_for_time(bucket), []).append(
+            {"resolution": HOURLY, "serial_number": serial_number, "hive_number": hive_number, "bucket": bucket})
+    for table, parameters in hours_by_table.items():
+        connection.executemany(_update_hourly(table), parameters)
+    connection.executemany(UPDATE_DAILY, [
+        {"resolution": DAILY, "hourly": HOURLY, "serial_number": serial_number, "hive_number": hive_number, "bucket": bucket}
+        for serial_number, hive_number, bucket in days])
+
+
+def rebuild(connection, tables):
+    """Recalculate every rollup from the given Data table partitions."""
+    connection.execute("""DELETE FROM Rollups""")
+    for table in tables:
+        connection.execute(_rebuild_hourly(table), {"resolution": HOURLY})
+    connection.execute(REBUILD_DAILY, {"resolution": DAILY, "hourly": HOURLY})
+
+
+def choose_resolution(first_time, start_time, end_time):
+    """Return the resolution that keeps the number of points returned for a time range manageable.
+
+    :param first_time: time of the first stored row, or None if there are no rows"""
+    if first_time is not None:
+        start_time = max(start_time, first_time)
+    time_range = end_time - start_time
+    if time_range <= AUTOMATIC_RAW_RANGE:
+        return "raw"
+    if time_range <= AUTOMATIC_HOURLY_RANGE:
+        return "hourly"
+    return "daily"
+
+
+def fetch(cursor, serial_number, hive_number, field, resolution, start_time, end_time):
+    """Return the bucket start times and the mean, minimum and maximum of field for each bucket between start_time and end_time."""
+    bucket_size = RESOLUTIONS[resolution]
+    cursor.execute("""SELECT bucket, mean, minimum, maximum FROM Rollups
+                      WHERE resolution = ? and serial_number = ? and hive_number = ? and field = ? and bucket >= ? and bucket < ? ORDER BY bucket ASC""",
+                   (bucket_size, serial_number, hive_number, field, float(start_time) // bucket_size * bucket_size, end_time))
+    data = {'time': [], field: [], field + '_min': [], field + '_max': []}
+    for line in cursor.fetchall():
+        data['time'].append(line[0])
+        data[field].append(line[1])
+        data[field + '_min'].append(line[2])
+        data[field + '_max'].append(line[3])
+    return data
+
+
+def fetch_many(cursor, serial_number, hive_filter, hive_parameters, fields, resolution, start_time, end_time):
+    """Return a dictionary of bucket start times and the mean, minimum and maximum of each field by str(hive_number).
+
+    :param str hive_filter: condition on hive_number to add to the query
+    :param list hive_parameters: parameters used by hive_filter"""
+    bucket_size = RESOLUTIONS[resolution]
+    cursor.execute(f"""SELECT hive_number, bucket, field, mean, minimum, maximum FROM Rollups
+                       WHERE resolution = ? and serial_number = ?{hive_filter} and field IN ({", ".join("?" for field in fields)}) and bucket >= ? and bucket < ?
+                       ORDER BY hive_number, bucket ASC""",
+                   [bucket_size, serial_number] + hive_parameters + list(fields) + [float(start_time) // bucket_size * bucket_size, end_time])
+    hives = {}
+    for hive_number, bucket, field, mean, minimum, maximum in cursor.fetchall():
+        columns = hives.get(str(hive_number))
+        if columns is None:
+            columns = hives[str(hive_number)] = {'time': []}
+            for name in fields:
+                columns[name], columns[name + '_min'], columns[name + '_max'] = [], [], []
+        if len(columns['time']) == 0 or columns['time'][-1] != bucket:
+            columns['time'].append(bucket)
+            for name in fields:
+                columns[name].append(None)
+                columns[name + '_min'].append(None)
+                columns[name + '_max'].append(None)
+        columns[field][-1], columns[field + '_min'][-1], columns[field + '_max'][-1] = mean, minimum, maximum
+    return hives
@@ -0,0 +1,46 @@
+# Databases record how many of their migrations have been applied in PRAGMA user_version.
+# Migrations are only ever appended to a list, so each one is applied exactly once to every database.
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def migrate(pool, migrations):
+    """Apply the migrations that haven't been applied to the database yet, each in its own transaction.
+
+    :param pool: :class:'~connection_pool.ConnectionPool' of the database
+    :param migrations: list of methods that will be passed a connection with an open transaction
+    :return: number of migrations applied"""
+    applied = 0
+    with pool.writer() as connection:
+        version = connection.execute("""PRAGMA user_version""").fetchone()[0]
+    for number, migration in enumerate(migrations[version:], version + 1):
+        with pool.writer() as connection:
+            # Started explicitly so that table changes are part of the transaction too.
+            connection.execute("""BEGIN""")
+            migration(connection)
+            connection.execute(f"""PRAGMA user_version = {number}""")
+        applied += 1
+    return applied
+
+
+def full_scans(connection, queries):
+    """Return the names of the queries that SQLite would answer by reading a whole table or index.
+
+    :param queries: dictionary of (query, parameters) by name
+    :return: list of (name, query plan step) for each full scan"""
+    scans = []
+    for name, (query, parameters) in queries.items():
+        for row in connection.execute("""EXPLAIN QUERY PLAN """ + query, parameters):
+            detail = row[-1]
+            if detail.startswith("SCAN"):
+                scans.append((name, detail))
+    return scans
+
+
+def check_query_plans(connection, queries):
+    """Log a warning for each query that would read a whole table or index, so missing indexes are noticed at startup."""
+    scans = full_scans(connection, queries)
+    for name, detail in scans:
+        logger.warning("Query '%s' uses a full scan: %s", name, detail)
+    return scans
@@ -0,0 +1,319 @@
+import os
+import threading
+import time
+import error_logger
+import partitions
+import rollups
+import schema
+import storage
+from connection_pool import ConnectionPool
+from hive_data import COLUMN_NAMES, DataBatch
+
+
+def _add_hives_table(connection):
+    """Keep each hive and the time of its first row so that they can be found without reading the Data table."""
+    connection.execute("""CREATE TABLE IF NOT EXISTS Hives (
+                            serial_number INTEGER,
+                            hive_number INTEGER,
+                            first_time INTEGER,
+                            PRIMARY KEY(serial_number, hive_number)
+                        ) WITHOUT ROWID;""")
+    connection.execute("""INSERT OR IGNORE INTO Hives SELECT serial_number, hive_number, MIN(time) FROM Data GROUP BY serial_number, hive_number""")
+
+
+def _no_migration(connection):
+    """Kept in place of a migration that copied the Data table into primary key order, so later migrations keep their numbers.
+
+    The partitions made by _partition_data_table are already in primary key order, so every row is only copied once."""
+
+
+def _partition_data_table(connection):
+    """Move the rows in the Data table into monthly partitions."""
+    partitions.create_registry(connection)
+    months = connection.execute("""SELECT DISTINCT strftime('%Y%m', time, 'unixepoch') FROM Data""").fetchall()
+    for month, in months:
+        name = partitions.PREFIX + month
+        start_time, end_time = partitions.bounds(name)
+        partitions.add(connection, name)
+        connection.execute(f"""INSERT INTO {name} SELECT * FROM Data WHERE time >= ? and time < ?""", (start_time, end_time))
+    connection.execute("""DROP TABLE Data""")
+
+
+# Applied in order by :func:'~schema.migrate'. Only ever add to the end of this list.
+MIGRATIONS = [_add_hives_table, _no_migration, _partition_data_table]
+
+# Queries that are run for every chart, export or upload, checked at startup for full table scans.
+# {data} is replaced by a table with the layout of a Data table partition.
+HOT_QUERIES = {
+    "fetch_field": ("""SELECT time, weight FROM {data} WHERE serial_number = ? and hive_number = ? and time > ? and time < ? ORDER BY time ASC""", (1, 1, 0, 1)),
+    "fetch_fields": ("""SELECT hive_number, time, weight FROM {data} WHERE serial_number = ? and hive_number IN (?, ?) and time > ? and time < ?
+                       ORDER BY hive_number, time ASC""", (1, 1, 2, 0, 1)),
+    "iterate_rows": ("""SELECT * FROM {data} WHERE serial_number = ? and time >= ? ORDER BY serial_number, hive_number, time""", (1, 0)),
+    "fetch_hive_numbers": ("""SELECT hive_number FROM Hives WHERE serial_number = ?""", (1, )),
+    "first_time": ("""SELECT MIN(first_time) FROM Hives WHERE serial_number = ? and hive_number = ?""", (1, 1)),
+    "rollups": ("""SELECT bucket, mean, minimum, maximum FROM Rollups
+                   WHERE resolution = ? and serial_number = ? and hive_number = ? and field = ? and bucket >= ? and bucket < ? ORDER BY bucket ASC""",
+                (3600, 1, 1, 'weight', 0, 1)),
+}
+
+
+class SQLiteStorage(storage.Storage):
+    database_lock = threading.Lock()
+    supports_archiving = True
+
+    def __init__(self, database_path="database.db", latest_values_table=False, archive_path="archive.db"):
+        """Store the Data table rows in an SQLite database.
+
+        Rows are stored in one table per month, see :mod:'partitions'. Archived months are moved to archive_path.
+        Hourly and daily summaries are kept up to date in the Rollups table, see :mod:'rollups'.
+        The most recent row for each hive is also kept in a LatestValues table if latest_values_table is True."""
+        self.database_path = database_path
+        database_exists = os.path.isfile(self.database_path)
+        self.pool = ConnectionPool(self.database_path, self.database_lock)
+        if not database_exists:
+            with self.pool.writer() as connection:
+                partitions.create_table(connection, "Data")
+        schema.migrate(self.pool, MIGRATIONS)
+        self.partitions = partitions.Partitions(self.pool, archive_path)
+        tables = self.partitions.between()
+        with self.pool.writer() as connection:
+            if rollups.create_table(connection):
+                rollups.rebuild(connection, tables)
+        self.latest_values_table = latest_values_table
+        if self.latest_values_table:
+            with self.pool.writer() as connection:
+                partitions.create_table(connection, "LatestValues")
+                connection.execute("""CREATE UNIQUE INDEX IF NOT EXISTS LatestValuesHive ON LatestValues(serial_number, hive_number)""")
+        self.check_query_plans()
+
+    def close(self):
+        """Close every connection to the database."""
+        self.pool.close()
+
+    def write_rows(self, batch):
+        """Insert the rows in a DataBatch into the Data table partitions in a single transaction.
+
+        Rows that already exist for the same serial_number, hive_number and time are ignored.
+        Rows for archived months can't be written and are dropped.
+        :return: DataBatch of the rows that could be written"""
+        batches = {}
+        for name, partition_batch in batch.partition(lambda row: partitions.name_for_time(row[3])).items():
+            if self.partitions.is_archived(name):
+                error_logger.log_error("Dropped rows for an archived partition", details={"partition": name, "rows": len(partition_batch)})
+                continue
+            self.partitions.add(name)
+            batches[name] = partition_batch
+        batch = DataBatch()
+        for partition_batch in batches.values():
+            batch.extend(partition_batch)
+        if len(batch) == 0:
+            return batch
+        with self.pool.writer() as connection:
+            for name, partition_batch in batches.items():
+                connection.executemany(
+                    f"INSERT OR IGNORE INTO {name} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", partition_batch.rows())
+            if self.latest_values_table:
+                updates = ", ".join(f"{name} = excluded.{name}" for name in COLUMN_NAMES)
+                connection.executemany(
+                    f"""INSERT INTO LatestValues VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(serial_number, hive_number) DO UPDATE SET {updates} WHERE excluded.time > LatestValues.time""",
+                    batch.rows())
+            connection.executemany(
+                """INSERT INTO Hives VALUES (?, ?, ?)
+                ON CONFLICT(serial_number, hive_number) DO UPDATE SET first_time = excluded.first_time WHERE excluded.first_time < Hives.first_time""",
+                [(serial_number, hive_number, first_time) for (serial_number, hive_number), first_time in self._first_times(batch).items()])
+            rollups.update(connection, batch.columns[0], batch.columns[4], batch.columns[3], partitions.name_for_time)
+        return batch
+
+    @staticmethod
+    def _first_times(batch):
+        """Return the earliest time in a DataBatch for each (serial_number, hive_number)."""
+        first_times = {}
+        for serial_number, hive_number, row_time in zip(batch.columns[0], batch.columns[4], batch.columns[3]):
+            first_time = first_times.get((serial_number, hive_number))
+            if first_time is None or row_time < first_time:
+                first_times[(serial_number, hive_number)] = row_time
+        return first_times
+
+    def load_latest_rows(self):
+        """Return the most recent row for each hive from the LatestValues table, or from the Data table partitions if it is empty.
+
+        Partitions are read newest first, stopping once every hive in the Hives table has been found."""
+        tables = self.partitions.between()
+        cursor = self.pool.reader().cursor()
+        if self.latest_values_table:
+            cursor.execute("""SELECT * FROM LatestValues""")
+            rows = cursor.fetchall()
+            if len(rows) > 0:
+                return rows
+        cursor.execute("""SELECT serial_number, hive_number FROM Hives""")
+        missing_hives = set(cursor.fetchall())
+        rows = []
+        for table in reversed(tables):
+            if len(missing_hives) == 0:
+                break
+            # SQLite returns the other columns from the row with the maximum time.
+            cursor.execute(f"""SELECT {", ".join(COLUMN_NAMES)}, MAX(time) FROM {table} GROUP BY serial_number, hive_number""")
+            for row in cursor.fetchall():
+                if (row[0], row[4]) in missing_hives:
+                    missing_hives.remove((row[0], row[4]))
+                    rows.append(row[:-1])
+        if self.latest_values_table and len(rows) > 0:
+            with self.pool.writer() as connection:
+                connection.executemany("""INSERT OR REPLACE INTO LatestValues VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+        return rows
+
+    def rebuild_rollups(self):
+        """Recalculate every hourly and daily rollup from the Data table partitions."""
+        tables = self.partitions.between()
+        with self.pool.writer() as connection:
+            rollups.rebuild(connection, tables)
+
+    def archive_partitions(self, before_time):
+        """Move the months that end at or before before_time into the read-only archive database, see :func:'~partitions.Partitions.archive'.
+
+        :return: names of the partitions that were archived"""
+        return self.partitions.archive(before_time)
+
+    def check_query_plans(self):
+        """Log a warning for each hot query that would read a whole table, see :func:'~schema.check_query_plans'.
+
+        :return: list of (name, query plan step) for each full scan"""
+        connection = self.pool.reader()
+        partitions.create_table(connection, "temp.PartitionLayout")
+        return schema.check_query_plans(connection, {name: (query.format(data="temp.PartitionLayout"), parameters)
+                                                     for name, (query, parameters) in HOT_QUERIES.items()})
+
+    def _select_from_partitions(self, columns, where, start_time, end_time, order_by):
+        """Return a query for the rows matching where in every partition that can hold rows between start_time and end_time.
+
+        Partitions are combined with UNION ALL, which SQLite merges in order because each partition is read in primary key order.
+        Parameters must be named since where is repeated for each partition.
+        :return: the query, or None if there are no partitions in the time range"""
+        tables = self.partitions.between(start_time, end_time)
+        if len(tables) == 0:
+            return None
+        return " UNION ALL ".join(f"""SELECT {columns} FROM {table} WHERE {where}""" for table in tables) + f""" ORDER BY {order_by}"""
+
+    def fetch_field(self, serial_number, hive_number, field, start_time=0, end_time=None, resolution="raw"):
+        """Return the time column and the given column.
+
+        Return the time column and the given field column between start_time and end_time.
+        For the 'hourly' and 'daily' resolutions, the times are the start of each bucket, the field values are bucket means,
+        and the bucket minimums and maximums are included as field + '_min' and field + '_max'.
+        :param serial_number: Serial Number assigned by Digital Matter to the Hawk
+        :param str field: column to fetch
+        :type start_time: int
+        :type end_time: int or None
+        :param str resolution: 'raw', 'hourly', 'daily', or 'auto' to choose based on the time range
+        :raises KeyError: if field isn't a database column or resolution isn't recognised"""
+        end_time = time.time() if end_time is None else end_time
+        # Validate the field value to prevent SQL injections
+        storage.validate_fields([field])
+        query = self._select_from_partitions(f"""time, {field}""", """serial_number = :serial_number and hive_number = :hive_number and time > :start_time and time < :end_time""",
+                                             start_time, end_time, """time ASC""")
+        cursor = self.pool.reader().cursor()
+        if field not in rollups.FIELDS:
+            resolution = "raw"
+        if resolution == "auto":
+            cursor.execute("""SELECT MIN(first_time) FROM Hives WHERE serial_number = ? and hive_number = ?""", (serial_number, hive_number))
+            resolution = rollups.choose_resolution(cursor.fetchone()[0], float(start_time), float(end_time))
+        if resolution != "raw":
+            data = rollups.fetch(cursor, serial_number, hive_number, field, resolution, start_time, end_time)
+            cursor.close()
+            return data
+        data = {'time': [], str(field): []}
+        if query is None:
+            cursor.close()
+            return data
+        cursor.execute(query, {"serial_number": serial_number, "hive_number": hive_number, "start_time": start_time, "end_time": end_time})
+        for line in cursor.fetchall():
+            data['time'].append(line[0])
+            data[str(field)].append(line[1])
+        cursor.close()
+        return data
+
+    def fetch_fields(self, serial_number, hive_numbers, fields, start_time=0, end_time=None, resolution="raw"):
+        """Return the time column and the given columns for several hives in a single query.
+
+        The 'hourly' and 'daily' resolutions work as they do for :func:'~database.Database.fetch_field', but are only used if every field has rollups.
+        :param serial_number: Serial Number assigned by Digital Matter to the Hawk
+        :param hive_numbers: list of hive numbers, or None for every hive
+        :param list(str) fields: columns to fetch
+        :param str resolution: 'raw', 'hourly', 'daily', or 'auto' to choose based on the time range
+        :return: dictionary with the resolution used and a dictionary of columns by str(hive_number)
+        :raises KeyError: if any field isn't a database column or resolution isn't recognised"""
+        end_time = time.time() if end_time is None else end_time
+        # Validate the field values to prevent SQL injections
+        storage.validate_fields(fields)
+        hive_filter, hive_parameters = "", []
+        if hive_numbers is not None:
+            hive_filter = f""" and hive_number IN ({", ".join("?" for hive_number in hive_numbers)})"""
+            hive_parameters = list(hive_numbers)
+        parameters = {"serial_number": serial_number, "start_time": start_time, "end_time": end_time}
+        where = """serial_number = :serial_number and time > :start_time and time < :end_time"""
+        if hive_numbers is not None:
+            where += f""" and hive_number IN ({", ".join(f":hive_{i}" for i in range(len(hive_numbers)))})"""
+            parameters.update({f"hive_{i}": hive_number for i, hive_number in enumerate(hive_numbers)})
+        query = self._select_from_partitions(f"""hive_number, time, {", ".join(fields)}""", where, start_time, end_time, """hive_number, time ASC""")
+        cursor = self.pool.reader().cursor()
+        if any(field not in rollups.FIELDS for field in fields):
+            resolution = "raw"
+        if resolution == "auto":
+            cursor.execute(f"""SELECT MIN(first_time) FROM Hives WHERE serial_number = ?{hive_filter}""", [serial_number] + hive_parameters)
+            resolution = rollups.choose_resolution(cursor.fetchone()[0], float(start_time), float(end_time))
+        if resolution != "raw":
+            hives = rollups.fetch_many(cursor, serial_number, hive_filter, hive_parameters, fields, resolution, start_time, end_time)
+            cursor.close()
+            return {'resolution': resolution, 'hives': hives}
+        hives = {}
+        if query is None:
+            cursor.close()
+            return {'resolution': resolution, 'hives': hives}
+        cursor.execute(query, parameters)
+        for line in cursor.fetchall():
+            columns = hives.get(str(line[0]))
+            if columns is None:
+                columns = hives[str(line[0])] = {'time': [], **{field: [] for field in fields}}
+            columns['time'].append(line[1])
+            for field, value in zip(fields, line[2:]):
+                columns[field].append(value)
+        cursor.close()
+        return {'resolution': resolution, 'hives': hives}
+
+    def fetch_hive_numbers(self, serial_number):
+        """Return all hive numbers associated with the given serial_number."""
+        cursor = self.pool.reader().cursor()
+        cursor.execute("""SELECT hive_number FROM Hives WHERE serial_number = ?""", (serial_number, ))
+        hive_numbers = []
+        for line in cursor.fetchall():
+            hive_numbers.append(line[0])
+        return hive_numbers
+
+    def iterate_rows(self, serial_number, start_time=None, end_time=None, hive_number=None, chunk_size=1000):
+        """Yield lists of at most chunk_size Data table rows belonging to the given serial_number, ordered by hive_number and time.
+
+        :param serial_number: Serial Number assigned by Digital Matter to the Hawk
+        :param start_time: if given, only rows with a time at or after start_time are included
+        :param end_time: if given, only rows with a time before end_time are included
+        :param hive_number: if given, only rows for this hive are included"""
+        where = """serial_number = :serial_number"""
+        parameters = {"serial_number": serial_number, "hive_number": hive_number, "start_time": start_time, "end_time": end_time}
+        if hive_number is not None:
+            where += """ and hive_number = :hive_number"""
+        if start_time is not None:
+            where += """ and time >= :start_time"""
+        if end_time is not None:
+            where += """ and time < :end_time"""
+        query = self._select_from_partitions("""*""", where, start_time, end_time, """serial_number, hive_number, time""")
+        if query is None:
+            return
+        cursor = self.pool.reader().cursor()
+        try:
+            cursor.execute(query, parameters)
+            rows = cursor.fetchmany(chunk_size)
+            while len(rows) > 0:
+                yield rows
+                rows = cursor.fetchmany(chunk_size)
+        finally:
+            cursor.close()
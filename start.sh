@@ -1,4 +1,4 @@
 #!/bin/bash
 . ./venv/bin/activate
-gunicorn main:app --bind "127.0.0.1" --access-logfile - --error-logfile - --daemon
+gunicorn main:app --bind "127.0.0.1" --threads 16 --access-logfile - --error-logfile - --daemon
 nginx -g "daemon off;"
\ No newline at end of file
@@ -0,0 +1,79 @@
+import rollups
+from hive_data import COLUMN_NAMES
+
+
+def validate_fields(fields):
+    """Check that every field is a Data table column, so that it is safe to use in a query.
+
+    :raises KeyError: if any field isn't a database column"""
+    for field in fields:
+        if field not in COLUMN_NAMES:
+            raise KeyError(field)
+
+
+def choose_resolution(fields, resolution, fetch_first_time, start_time, end_time):
+    """Return the resolution that fields will be returned at.
+
+    Fields without rollups are always returned raw. The 'auto' resolution is resolved with :func:'~rollups.choose_resolution'.
+    :param fetch_first_time: method that returns the time of the first stored row, only called for the 'auto' resolution
+    :raises KeyError: if resolution isn't recognised"""
+    if any(field not in rollups.FIELDS for field in fields):
+        return "raw"
+    if resolution == "auto":
+        return rollups.choose_resolution(fetch_first_time(), float(start_time), float(end_time))
+    if resolution != "raw" and resolution not in rollups.RESOLUTIONS:
+        raise KeyError(resolution)
+    return resolution
+
+
+class Storage:
+    """Database engine that stores the Data table rows for :class:'~database.Database'.
+
+    Each method is called from many threads. Rows are only ever written by write_rows, which is called by one thread at a time."""
+    # True if archive_partitions is implemented and an archive_path option is accepted.
+    supports_archiving = False
+
+    def close(self):
+        """Close every connection to the database."""
+        raise NotImplementedError
+
+    def write_rows(self, batch):
+        """Store the rows in a DataBatch, ignoring rows that already exist for the same serial_number, hive_number and time.
+
+        :return: DataBatch of the rows that could be written"""
+        raise NotImplementedError
+
+    def load_latest_rows(self):
+        """Return the most recent row for each serial_number and hive_number."""
+        raise NotImplementedError
+
+    def fetch_field(self, serial_number, hive_number, field, start_time=0, end_time=None, resolution="raw"):
+        """See :func:'~database.Database.fetch_field'."""
+        raise NotImplementedError
+
+    def fetch_fields(self, serial_number, hive_numbers, fields, start_time=0, end_time=None, resolution="raw"):
+        """See :func:'~database.Database.fetch_fields'."""
+        raise NotImplementedError
+
+    def fetch_hive_numbers(self, serial_number):
+        """Return all hive numbers associated with the given serial_number."""
+        raise NotImplementedError
+
+    def iterate_rows(self, serial_number, start_time=None, end_time=None, hive_number=None, chunk_size=1000):
+        """See :func:'~database.Database.iterate_rows'."""
+        raise NotImplementedError
+
+    def rebuild_rollups(self):
+        """Recalculate any stored hourly and daily summaries. Does nothing for engines that summarise rows when they are read."""
+
+    def archive_partitions(self, before_time):
+        """Move old rows into read-only storage.
+
+        :raises NotImplementedError: if the engine doesn't support archiving"""
+        raise NotImplementedError(f"{type(self).__name__} doesn't support archiving partitions")
+
+    def check_query_plans(self):
+        """Log a warning for each hot query that would read a whole table.
+
+        :return: list of (name, query plan step) for each full scan"""
+        return []
@@ -0,0 +1,38 @@
+# Builders of uploads in the formats sent by the Hawks, shared by the tests and the benchmark.
+import base64
+import random
+import time
+
+
+def weather_station_payload(humidity, temperature):
+    """Return base64 data in the format sent by the ELA RHT tag."""
+    raw = bytes(6) + b"P RHT 903CCD" + bytes(3) + bytes([humidity]) + int(temperature * 100).to_bytes(2, "little")
+    return base64.b64encode(raw).decode()
+
+
+def hive_payload(hive_number, temperature_1=21.5, temperature_2=22.5, temperature_3=23.5, humidity=60, weight=40.2,
+                 accelerometer=0, bees_out=10, bees_in=12, frequency=250):
+    """Return base64 data in the format sent by our custom hardware."""
+    raw = (bytes([hive_number]) + int(temperature_1 * 10).to_bytes(2, "big") + int(temperature_2 * 10).to_bytes(2, "big")
+           + int(temperature_3 * 10).to_bytes(2, "big") + bytes([humidity]) + int(weight * 10).to_bytes(2, "big")
+           + bytes([accelerometer, bees_out, bees_in]) + frequency.to_bytes(3, "big") + bytes(7))
+    return base64.b64encode(raw).decode()
+
+
+def hawk_json(serial_number, date, *payloads):
+    """Return JSON in the format uploaded by the Hawk."""
+    return {"SerNo": serial_number, "Records": [{"DateUTC": date, "Fields": [{"Tags": [{"Data": payload} for payload in payloads]}]}]}
+
+
+def synthetic_upload(serial_number, upload_time, hive_count, flat=False):
+    """Return JSON in the format uploaded by the Hawk with a random weather station reading and a random reading for each hive.
+
+    :param bool flat: if True, data is placed directly in each field rather than nested in tags, which Hawks also send"""
+    payloads = [weather_station_payload(random.randint(30, 90), random.uniform(5, 30))]
+    for hive_number in range(1, hive_count + 1):
+        payloads.append(hive_payload(hive_number, random.uniform(20, 36), random.uniform(20, 36), random.uniform(20, 36),
+                                     random.randint(40, 90), random.uniform(20, 80), random.randint(0, 3), random.randint(0, 255),
+                                     random.randint(0, 255), random.randint(100, 500)))
+    fields = [{"Data": payload} for payload in payloads] if flat else [{"Tags": [{"Data": payload} for payload in payloads]}]
+    date = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(upload_time))
+    return {"SerNo": serial_number, "Records": [{"DateUTC": date, "Fields": fields}]}
@@ -1,8 +1,38 @@
+import archive
+import atexit
+import base64
+import backfill
+import batch_writer
+import connection_pool
+import io
+import json
 import os
+import queue
+import shutil
+import smtplib
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import uuid
 
+import database
+import duckdb_storage
+import email_sender
+import error_logger
+import hive_data
+import encoded_data
+import ingest_queue
 import login_database
+import metrics
+import notifications
+import replay_log
+import schema
+import sqlite_storage
+from synthetic import hawk_json, hive_payload, weather_station_payload
 
 
 class UserAccounts(unittest.TestCase):
@@ -30,10 +60,650 @@ class UserAccounts(unittest.TestCase):
             new_id = str(uuid.uuid4())
         self.assertTrue(self.login_db.check_unique_user_id(new_id))
 
+    def test_visibility_permissions(self):
+        self.login_db.add_user("Alex", "alex@test.com", "password")
+        self.login_db.add_user("William", "william@test.com", "password")
+        owner = self.login_db.fetch_user_by_email("alex@test.com").id
+        viewer = self.login_db.fetch_user_by_email("william@test.com").id
+        self.assertFalse(self.login_db.check_visibility_permissions(owner, "1234"))
+        self.login_db.register_hawk(owner, "1234")
+        self.assertTrue(self.login_db.check_visibility_permissions(owner, "1234"), "Cache not invalidated by register_hawk")
+        self.assertFalse(self.login_db.check_visibility_permissions(viewer, "1234"))
+        self.login_db.add_hawk_visibility(owner, "1234", viewer)
+        self.assertTrue(self.login_db.check_visibility_permissions(viewer, 1234), "Cache not invalidated by add_hawk_visibility")
+        self.login_db.remove_hawk_visibility(owner, "1234", viewer)
+        self.assertFalse(self.login_db.check_visibility_permissions(viewer, "1234"), "Cache not invalidated by remove_hawk_visibility")
+        self.login_db.add_hawk_visibility(owner, "1234", "ALL")
+        self.assertTrue(self.login_db.check_visibility_permissions(viewer, "1234"), "Cache not invalidated for 'ALL'")
+        self.login_db.deregister_hawk(owner, "1234")
+        self.assertFalse(self.login_db.check_visibility_permissions(owner, "1234"))
+        self.assertFalse(self.login_db.check_visibility_permissions(viewer, "1234"), "Visibility not removed by deregister_hawk")
+
+    def test_notification_index(self):
+        self.login_db.add_user("Alex", "alex@test.com", "password")
+        user = self.login_db.fetch_user_by_email("alex@test.com")
+        self.login_db.register_hawk(user.id, 1234)
+        self.login_db.add_notification(user.id, 1234, "1", "weight", ">", 40)
+        self.login_db.add_notification(user.id, 1234, "1", "weight", ">", 45)
+        self.login_db.add_notification(user.id, 1234, None, "weight", "<", 30)
+        self.login_db.add_notification(user.id, 1234, "2", "weight", ">", 35)
+        index = notifications.NotificationIndex(self.login_db)
+
+        self.assertEqual([sensor for sensor, rules in index.fetch("1234", 1)], ["weight", "weight"])
+        rules = index.fetch("1234", 1)[0][1]
+        self.assertEqual([(rule.email, rule.value) for rule in rules.crossed_above(39, 41)], [("alex@test.com", 40)])
+        self.assertEqual([rule.value for rule in rules.crossed_above(40, 50)], [40, 45])
+        self.assertEqual(rules.crossed_above(41, 39), [])
+        self.assertEqual([sensor for sensor, rules in index.fetch(1234, 3)], ["weight"], "Rule for every hive not included")
+        self.assertEqual([rule.value for rule in index.fetch(1234, 3)[0][1].crossed_below(31, 29)], [30])
+
+        self.login_db.remove_notification(user.id, self.login_db.fetch_notifications(serial_number=1234)[0][0])
+        self.assertEqual(sum(len(rules.above_values) + len(rules.below_values) for sensor, rules in index.fetch(1234, 1)), 2,
+                         "Index not refreshed after removing a notification")
+
+    def test_notification_hysteresis_and_cooldown(self):
+        self.login_db.add_user("Alex", "alex@test.com", "password")
+        user = self.login_db.fetch_user_by_email("alex@test.com")
+        self.login_db.register_hawk(user.id, 1234)
+        self.login_db.add_notification(user.id, 1234, "1", "weight", ">", 40)
+        notification = notifications.Notifications("ibuzz@test.com", "password", self.login_db, cooldown=0, starttls=False, smtp_factory=FakeSMTP)
+        sent = []
+        notification.send_email_notification = lambda recipient, subject, message: sent.append(message)
+        weather_station = hive_data.WeatherStationData(1234, 50, 20)
+        weights = [39, 41, 39.8, 40.5, 39, 41]
+        for previous_weight, current_weight in zip(weights, weights[1:]):
+            notification.evaluate(weather_station, hive_data.HiveData(1, 20, 20, 20, 50, current_weight, 0, 0, 0, 0),
+                                  weather_station, hive_data.HiveData(1, 20, 20, 20, 50, previous_weight, 0, 0, 0, 0))
+        self.assertEqual(len(sent), 2, "Notification repeated within the hysteresis band")
+
+        notification.cooldown = 3600
+        for previous_weight, current_weight in ((41, 39), (39, 41)):
+            notification.evaluate(weather_station, hive_data.HiveData(1, 20, 20, 20, 50, current_weight, 0, 0, 0, 0),
+                                  weather_station, hive_data.HiveData(1, 20, 20, 20, 50, previous_weight, 0, 0, 0, 0))
+        self.assertEqual(len(sent), 2, "Notification repeated within the cooldown")
+        notification.close()
+
+        rule = notifications.NotificationIndex(self.login_db).fetch(1234, 1)[0][1].above_rules[0]
+        self.assertFalse(rule.armed, "State not persisted")
+        self.assertIsNotNone(rule.last_fired)
+
+    def test_login_queries_use_indexes(self):
+        self.assertEqual(schema.full_scans(self.login_db.pool.reader(), login_database.HOT_QUERIES), [])
+
     def tearDown(self):
         self.login_db.close()
         os.remove(self.login_db_path)
 
 
+class Ingest(unittest.TestCase):
+
+    def test_ingest_queue_backpressure_and_drain(self):
+        release = threading.Event()
+        processed = []
+
+        def process(value):
+            release.wait()
+            processed.append(value)
+
+        ingest = ingest_queue.IngestQueue(process, queue_size=2, worker_count=1)
+        ingest.submit(0)
+        # Wait for the worker to take the first payload so the queue holds exactly two.
+        while ingest.depth() != 0:
+            time.sleep(0.01)
+        ingest.submit(1)
+        ingest.submit(2)
+        self.assertRaises(queue.Full, ingest.submit, 3)
+
+        release.set()
+        ingest.shutdown()
+        self.assertEqual(processed, [0, 1, 2], "Accepted payloads lost on shutdown")
+        self.assertRaises(queue.Full, ingest.submit, 4)
+
+    def test_batch_writer_waits_for_room(self):
+        release = threading.Event()
+        written = []
+
+        def write(rows):
+            release.wait()
+            written.extend(rows)
+
+        writer = batch_writer.BatchWriter(write, batch_size=2, flush_interval=0.01, max_pending=2)
+        writer.add([0, 1])
+        # Wait for the background thread to take the first rows and block writing them.
+        while len(writer.pending) != 0:
+            time.sleep(0.01)
+        writer.add([2, 3])
+        adder = threading.Thread(target=writer.add, args=([4],))
+        adder.start()
+        adder.join(0.1)
+        self.assertTrue(adder.is_alive(), "Rows added past max_pending")
+        release.set()
+        adder.join()
+        writer.close()
+        self.assertEqual(written, [0, 1, 2, 3, 4])
+
+
+class ConnectionPools(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.pool = connection_pool.ConnectionPool(os.path.join(self.directory.name, "pool_test.db"))
+        with self.pool.writer() as connection:
+            connection.execute("""CREATE TABLE Numbers (number INTEGER)""")
+
+    def test_readers_are_reused_by_each_thread_and_released(self):
+        self.assertIs(self.pool.reader(), self.pool.reader())
+        other_readers = []
+        thread = threading.Thread(target=lambda: other_readers.append(self.pool.reader()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other_readers[0], self.pool.reader())
+        # The other thread has finished, so its connection is closed.
+        self.assertNotIn(other_readers[0], self.pool.connections)
+        self.assertRaises(sqlite3.ProgrammingError, other_readers[0].execute, """SELECT 1""")
+
+    def test_single_writer_holds_the_lock(self):
+        with self.pool.writer() as connection:
+            self.assertTrue(self.pool.write_lock.locked())
+            self.assertIs(connection, self.pool.write_connection)
+            connection.execute("""INSERT INTO Numbers VALUES (1)""")
+        self.assertFalse(self.pool.write_lock.locked())
+        self.assertEqual(self.pool.reader().execute("""SELECT number FROM Numbers""").fetchall(), [(1,)])
+
+    def test_attached_databases_are_read_only(self):
+        archive_path = os.path.join(self.directory.name, "archive_test.db")
+        archive = sqlite3.connect(archive_path)
+        archive.execute("""CREATE TABLE Old (number INTEGER)""")
+        archive.execute("""INSERT INTO Old VALUES (7)""")
+        archive.commit()
+        archive.close()
+        reader = self.pool.reader()
+        self.pool.attach("archive", archive_path)
+        self.assertEqual(self.pool.reader().execute("""SELECT number FROM archive.Old""").fetchall(), [(7,)])
+        with self.pool.writer() as connection:
+            self.assertRaises(sqlite3.OperationalError, connection.execute, """INSERT INTO archive.Old VALUES (8)""")
+        self.assertIs(reader, self.pool.reader())
+
+    def test_close_closes_every_connection(self):
+        reader = self.pool.reader()
+        self.pool.close()
+        self.assertEqual(self.pool.connections, [])
+        self.assertRaises(sqlite3.ProgrammingError, reader.execute, """SELECT 1""")
+        self.assertRaises(sqlite3.ProgrammingError, self.pool.write_connection.execute, """SELECT 1""")
+
+    def tearDown(self):
+        self.pool.close()
+        self.directory.cleanup()
+
+
+class Server(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.working_directory = os.getcwd()
+        directory = tempfile.mkdtemp()
+        # Registered before main is imported so that it runs after the database is closed.
+        atexit.register(shutil.rmtree, directory, True)
+        with open(os.path.join(directory, "config.yaml"), "w") as config:
+            json.dump({"secret_key": "test", "metrics_token": "token", "max_streams": 2, "stream_heartbeat_interval": 0.05, "log_level": "CRITICAL"}, config)
+        os.chdir(directory)
+        import main
+        cls.main = main
+        main.login_db.add_user("Alex", "alex@test.com", "password")
+        cls.user_id = main.login_db.fetch_user_by_email("alex@test.com").id
+        main.login_db.register_hawk(cls.user_id, "1234")
+        main.login_db.register_hawk(cls.user_id, "5678")
+
+    def client(self):
+        client = self.main.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = self.user_id
+        return client
+
+    def test_metrics_need_the_token(self):
+        client = self.main.app.test_client()
+        self.assertEqual(client.get("/metrics").status_code, 401)
+        self.assertEqual(client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code, 401)
+        response = client.get("/metrics", headers={"Authorization": "Bearer token"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"ibuzz_rows_written_total", response.data)
+        self.main.config.pop("metrics_token")
+        try:
+            self.assertEqual(client.get("/metrics").status_code, 404, "Metrics served without a token configured")
+        finally:
+            self.main.config["metrics_token"] = "token"
+
+    def test_replay_download_is_json_lines(self):
+        with open(os.path.join("replay_logs", "1234.txt"), "w") as legacy:
+            legacy.write(str(hawk_json(1234, "2024-06-01 11:00:00", hive_payload(1))) + "\n")
+        self.main.db.replay_log.add_to_log(1234, hawk_json(1234, "2024-06-01 12:00:00", hive_payload(1)))
+        response = self.client().get("/download_replay/1234")
+        self.assertEqual(response.status_code, 200)
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([(line["time"] is None, line["json"]["Records"][0]["DateUTC"]) for line in lines],
+                         [(True, "2024-06-01 11:00:00"), (False, "2024-06-01 12:00:00")])
+
+    def test_data_is_revalidated_per_user(self):
+        response = self.client().get("/recent_values/1234")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Cache-Control"], "no-cache")
+        self.assertTrue({"Cookie", "Accept-Encoding"} <= set(response.vary), response.headers["Vary"])
+        response = self.client().get("/recent_values/1234", headers={"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["Cache-Control"], "no-cache")
+
+    def test_uploads_succeed_while_streams_are_open(self):
+        streams = [self.client().get("/stream?serial=1234&serial=5678", buffered=False) for i in range(2)]
+        self.assertEqual([response.status_code for response in streams], [200, 200])
+        chunks = [iter(response.response) for response in streams]
+        for stream in chunks:
+            self.assertEqual(next(stream), b"retry: 5000\n\n")
+        self.assertEqual(self.client().get("/stream?serial=1234", buffered=False).status_code, 503, "Stream opened past max_streams")
+        self.assertEqual(self.client().get("/stream?serial=1234&serial=9999").status_code, 400)
+
+        response = self.client().post("/", json=hawk_json(5678, "2024-06-01 12:00:00", weather_station_payload(55, 18.25), hive_payload(1)))
+        self.assertEqual(response.status_code, 200)
+        self.main.db.ingest_queue.join()
+        self.main.db.batch_writer.flush()
+        for stream in chunks:
+            event = next(event for event in stream if event.startswith(b"event: rows"))
+            rows = json.loads(event.split(b"data: ", 1)[1])
+            self.assertEqual([(row["serial_number"], row["hive_number"]) for row in rows], [(5678, 1)])
+
+        streams[0].close()
+        response = self.client().get("/stream?serial=1234", buffered=False)
+        self.assertEqual(response.status_code, 200, "Slot not freed when a stream closed")
+        response.close()
+        streams[1].close()
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.working_directory)
+
+
+class FakeSMTP:
+    """Stand-in for smtplib.SMTP that records sent emails and drops the first connection."""
+    connections = 0
+    sent = []
+
+    def __init__(self, host, port, timeout=None):
+        FakeSMTP.connections += 1
+        self.broken = FakeSMTP.connections == 1
+
+    def sendmail(self, from_email, recipient, email):
+        if self.broken:
+            raise smtplib.SMTPServerDisconnected
+        FakeSMTP.sent.append((recipient, email))
+
+    def quit(self):
+        pass
+
+
+class Emails(unittest.TestCase):
+
+    def test_email_sender_reconnects_and_digests(self):
+        sender = email_sender.EmailSender("ibuzz@test.com", "password", starttls=False, batch_window=0.2, retry_delay=0, smtp_factory=FakeSMTP)
+        sender.send("alex@test.com", "iBuzz ALERT weight", "weight is high")
+        sender.send("alex@test.com", "iBuzz ALERT humidity", "humidity is high")
+        sender.send("william@test.com", "iBuzz ALERT weight", "weight is high")
+        sender.close()
+        self.assertEqual(FakeSMTP.connections, 2, "Connection not reopened after failing")
+        self.assertEqual(sorted(recipient for recipient, email in FakeSMTP.sent), ["alex@test.com", "william@test.com"])
+        alex_email = [email for recipient, email in FakeSMTP.sent if recipient == "alex@test.com"][0]
+        self.assertIn("Subject: iBuzz ALERTS (2)", alex_email)
+        self.assertIn("humidity is high", alex_email)
+
+
+class PayloadDecoding(unittest.TestCase):
+
+    def test_extract_custom_data(self):
+        data = hive_payload(3, 21.5, 22.5, 23.5, 60, 40.2, 1, 10, 12, 70000)
+        self.assertEqual(encoded_data.extract_custom_data(data), (3, 21.5, 22.5, 23.5, 60, 40.2, 1, 10, 12, 70000))
+        self.assertRaises(ValueError, encoded_data.extract_custom_data, base64.b64encode(bytes(5)).decode())
+
+    def test_extract_outside_humidity_and_temperature(self):
+        self.assertEqual(encoded_data.extract_outside_humidity_and_temperature(weather_station_payload(55, 18.25)), (55, 18.25))
+        self.assertRaises(ValueError, encoded_data.extract_outside_humidity_and_temperature, hive_payload(1))
+
+    def test_decode_payload(self):
+        self.assertEqual(encoded_data.decode_payload(weather_station_payload(55, 18.25)), (encoded_data.WEATHER_STATION, (55, 18.25)))
+        self.assertEqual(encoded_data.decode_payload(hive_payload(2))[0], encoded_data.HIVE)
+        self.assertRaises(ValueError, encoded_data.decode_payload, base64.b64encode(bytes(5)).decode())
+
+    @unittest.skipIf(encoded_data.numpy is None, "NumPy isn't installed")
+    def test_batch_decoding_matches_single_decoding(self):
+        payloads = [hive_payload(i, weight=i * 1.5, frequency=i * 1000) for i in range(20)]
+        payloads += [weather_station_payload(55, 18.25), base64.b64encode(bytes(5)).decode(), "not base64"]
+        results = encoded_data.decode_payloads(payloads)
+        self.assertEqual(results[:-2], [encoded_data.decode_payload(payload) for payload in payloads[:-2]])
+        for result in results[-2:]:
+            self.assertIsInstance(result, ValueError)
+        # A payload too short for its format is found without failing the rest of the batch.
+        short = base64.b64encode(base64.b64decode(weather_station_payload(40, 10))[:-1]).decode()
+        results = encoded_data.decode_payloads([weather_station_payload(55, 18.25), short])
+        self.assertEqual(results[0], (encoded_data.WEATHER_STATION, (55, 18.25)))
+        self.assertIsInstance(results[1], ValueError)
+
+
+class DataBatches(unittest.TestCase):
+
+    def test_rows_round_trip_through_columns(self):
+        batch = hive_data.DataBatch()
+        weather_station = hive_data.WeatherStationData(1234, 55, 18.25)
+        batch.append(weather_station, hive_data.HiveData(1, 21.5, 22.5, 23.5, 60, 40.2, 0, 10, 12, 250, time=1717243200))
+        batch.append(weather_station, hive_data.HiveData(2, 21.5, None, None, None, None, None, None, None, None, time=1717243200))
+        self.assertEqual(list(batch.rows()), [(1234, 55, 18.25, 1717243200, 1, 21.5, 22.5, 23.5, 60, 40.2, 0, 10, 12, 250),
+                                              (1234, 55, 18.25, 1717243200, 2, 21.5, None, None, None, None, None, None, None, None)])
+        self.assertEqual(batch.columns[hive_data.COLUMN_NAMES.index("weight")], [40.2, None])
+        self.assertEqual(batch.columns[hive_data.COLUMN_NAMES.index("hive_number")], [1, 2])
+        partitions = batch.partition(lambda row: row[4])
+        self.assertEqual([list(partitions[hive_number].rows()) for hive_number in (1, 2)], [[row] for row in batch.rows()])
+
+
+class SensorData(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.working_directory = os.getcwd()
+        os.chdir(self.directory.name)
+        self.db = database.Database("database_test.db", flush_interval=0.01)
+
+    def ingest_and_flush(self, *uploads, db=None):
+        """Pass each upload to the database as if a Hawk sent it, then wait until all of their rows are written."""
+        db = db or self.db
+        for upload in uploads:
+            db.data_received(upload)
+        db.ingest_queue.shutdown()
+        db.batch_writer.flush()
+
+    def test_duplicate_uploads_are_stored_once(self):
+        json = hawk_json(1234, "2024-06-01 12:00:00", weather_station_payload(55, 18.25), hive_payload(1), hive_payload(2))
+        self.ingest_and_flush(json, json)
+        self.assertEqual(self.db.fetch_hive_numbers(1234), [1, 2])
+        data = self.db.fetch_field(1234, 1, "weight")
+        self.assertEqual(data["time"], [1717243200])
+        self.assertEqual(data["weight"], [40.2])
+
+    def test_most_recent_values(self):
+        self.db.data_received(hawk_json(1234, "2024-06-01 13:00:00", weather_station_payload(50, 20), hive_payload(1, weight=41)))
+        self.db.data_received(hawk_json(1234, "2024-06-01 12:00:00", weather_station_payload(55, 18.25), hive_payload(1), hive_payload(2)))
+        self.db.close()
+        for latest_values_table in (False, True, True):
+            self.db = database.Database("database_test.db", latest_values_table=latest_values_table)
+            recent_values = self.db.fetch_most_recent_values("1234")
+            self.assertEqual(sorted(recent_values), ["1", "2"])
+            self.assertEqual(recent_values["1"][3], 1717246800, "Older row returned")
+            self.assertEqual(recent_values["1"][9], 41)
+            self.db.close()
+        self.db = database.Database("database_test.db")
+
+    def test_notifications_compare_with_unwritten_uploads(self):
+        self.db.close()
+        self.db = database.Database("database_test.db", ingest_worker_count=1, flush_interval=60)
+        compared = []
+        self.db.data_received(hawk_json(1234, "2024-06-01 12:00:00", weather_station_payload(55, 18.25), hive_payload(1, weight=40)))
+        for hour, weight in ((13, 41), (14, 42)):
+            self.db.data_received(hawk_json(1234, f"2024-06-01 {hour}:00:00", weather_station_payload(55, 18.25), hive_payload(1, weight=weight)),
+                                  lambda weather_station, hive, previous_weather_station, previous_hive: compared.append((previous_hive.weight, hive.weight)))
+        self.db.ingest_queue.join()
+        self.assertEqual(self.db.batch_writer.pending.columns[9], [40, 41, 42], "Rows were written before the test finished")
+        self.assertEqual(compared, [(40, 41), (41, 42)])
+
+    def test_last_modified(self):
+        self.assertEqual(self.db.fetch_last_modified(1234), self.db.start_time)
+        self.ingest_and_flush(hawk_json(1234, "2024-06-01 12:00:00", weather_station_payload(55, 18.25), hive_payload(1)))
+        self.assertGreaterEqual(self.db.fetch_last_modified("1234"), self.db.start_time)
+        self.assertEqual(self.db.fetch_last_modified("1234"), self.db.fetch_last_modified(1234))
+        self.assertEqual(self.db.fetch_last_modified(5678), self.db.start_time)
+
+    def test_live_rows_are_published(self):
+        subscription = self.db.subscribe(["1234", 4321])
+        other_subscription = self.db.subscribe([5678])
+        self.ingest_and_flush(hawk_json(1234, "2024-06-01 12:00:00", weather_station_payload(55, 18.25), hive_payload(1, weight=41)))
+        rows = subscription.get(timeout=1)
+        self.assertEqual([(row["hive_number"], row["time"], row["weight"]) for row in rows], [(1, 1717243200, 41)])
+        self.assertTrue(other_subscription.empty())
+        self.db.unsubscribe([1234, 4321], subscription)
+        self.assertEqual(self.db.live_rows.subscriber_count(1234), 0)
+        self.assertEqual(self.db.live_rows.subscriber_count(4321), 0)
+
+    def test_migrate_old_database(self):
+        connection = sqlite3.connect("old_database.db")
+        connection.execute(f"""CREATE TABLE Data ({", ".join(database.Database.column_names)}, PRIMARY KEY(serial_number, hive_number, time))""")
+        connection.execute("""INSERT INTO Data VALUES (1234, 55, 18.25, 1717243200, 3, 20, 20, 20, 50, 40, 0, 0, 0, 250)""")
+        connection.commit()
+        connection.close()
+        old_db = database.Database("old_database.db")
+        reader = old_db.storage.pool.reader()
+        self.assertEqual(reader.execute("""PRAGMA user_version""").fetchone()[0], len(sqlite_storage.MIGRATIONS))
+        self.assertEqual(old_db.fetch_hive_numbers(1234), [3])
+        self.assertEqual(old_db.fetch_field(1234, 3, "weight"), {"time": [1717243200], "weight": [40]})
+        self.assertEqual(old_db.check_query_plans(), [])
+        self.assertNotEqual(schema.full_scans(reader, {"weight": ("""SELECT * FROM Data_202406 WHERE weight = ?""", (40,))}), [])
+        old_db.close()
+        old_db = database.Database("old_database.db")
+        self.assertEqual(schema.migrate(old_db.storage.pool, sqlite_storage.MIGRATIONS), 0, "Migrations applied twice")
+        old_db.close()
+
+    def test_partitions_and_archive(self):
+        self.ingest_and_flush(*(hawk_json(1234, date, weather_station_payload(55, 18.25), hive_payload(1))
+                                for date in ("2024-05-31 23:00:00", "2024-06-01 01:00:00", "2024-06-02 12:00:00")))
+        self.assertEqual(self.db.storage.partitions.between(), ["Data_202405", "Data_202406"])
+        self.assertEqual(self.db.storage.partitions.between(1717243200), ["Data_202406"], "Partition outside the time range included")
+        self.assertEqual(self.db.fetch_field(1234, 1, "weight", 1717196400 - 1)["time"], [1717196400, 1717203600, 1717329600])
+
+        self.assertEqual(self.db.archive_partitions(1717243200), ["Data_202405"])
+        self.assertEqual(self.db.storage.partitions.between(), ["archive.Data_202405", "Data_202406"])
+        self.assertEqual(self.db.storage.pool.reader().execute("""PRAGMA freelist_count""").fetchone()[0], 0, "Space not reclaimed")
+        self.assertEqual(len("".join(self.db.data_to_csv(1234)).splitlines()), 3, "Archived rows not exported")
+        self.db.rebuild_rollups()
+        self.assertEqual(self.db.fetch_field(1234, 1, "weight", 1717113600, 1717372800, resolution="daily")["time"], [1717113600, 1717200000, 1717286400])
+
+        self.db.close()
+        self.db = database.Database("database_test.db")
+        self.assertEqual(self.db.fetch_field(1234, 1, "weight", 0)["time"][0], 1717196400, "Archive not attached after restart")
+        self.assertRaises(RuntimeError, archive.archive, "database_test.db", 1719792000)
+        self.db.close()
+        self.assertEqual(archive.archive("database_test.db", 1719792000), ["Data_202406"])
+        self.db = database.Database("database_test.db")
+        self.assertEqual(self.db.storage.partitions.between(), ["archive.Data_202405", "archive.Data_202406"])
+
+    @unittest.skipIf(duckdb_storage.duckdb is None, "DuckDB isn't installed")
+    def test_duckdb_storage_matches_sqlite(self):
+        duckdb_db = database.Database(storage=database.create_storage("duckdb", database_path="database_test.duckdb"))
+        uploads = [hawk_json(1234, f"2024-06-01 {12 + minute // 60}:{minute % 60:02}:00", weather_station_payload(55, 18.25), hive_payload(1, weight=weight), hive_payload(2))
+                   for minute, weight in ((0, 40), (30, 42), (90, 50))]
+        for db in (self.db, duckdb_db):
+            self.ingest_and_flush(*uploads, db=db)
+        for resolution in ("raw", "hourly", "daily"):
+            self.assertEqual(duckdb_db.fetch_field("1234", "1", "weight", resolution=resolution), self.db.fetch_field(1234, 1, "weight", resolution=resolution))
+            self.assertEqual(duckdb_db.fetch_fields(1234, [1, 2], ["weight", "humidity"], resolution=resolution),
+                             self.db.fetch_fields(1234, [1, 2], ["weight", "humidity"], resolution=resolution))
+        self.assertEqual(duckdb_db.fetch_hive_numbers(1234), [1, 2])
+        # DuckDB writes whole numbers in floating point columns as 60.0 where SQLite writes 60.
+        self.assertEqual([[float(value) for value in line.split(",")] for line in "".join(duckdb_db.data_to_csv(1234, chunk_size=2)).splitlines()],
+                         [[float(value) for value in line.split(",")] for line in "".join(self.db.data_to_csv(1234, chunk_size=2)).splitlines()])
+        self.assertRaises(KeyError, duckdb_db.fetch_field, 1234, 1, "weight; DROP TABLE Data")
+        self.assertRaises(NotImplementedError, duckdb_db.archive_partitions, time.time())
+        self.assertRaises(ValueError, database.create_storage, "duckdb", database_path="other.duckdb", archive_path="archive.duckdb")
+        imported = subprocess.run([sys.executable, "-c", "import sys, database; print('duckdb' in sys.modules)"],
+                                  cwd=os.path.dirname(os.path.abspath(database.__file__)), capture_output=True, text=True).stdout
+        self.assertEqual(imported.strip(), "False", "DuckDB imported without being chosen")
+        duckdb_db.close()
+        duckdb_db = database.Database(storage=duckdb_storage.DuckDBStorage("database_test.duckdb"))
+        self.assertEqual(duckdb_db.fetch_most_recent_values(1234)["1"][3], 1717248600, "Latest values not loaded")
+        cursor_count = len(duckdb_db.storage.cursors)
+        thread = threading.Thread(target=duckdb_db.fetch_hive_numbers, args=(1234,))
+        thread.start()
+        thread.join()
+        del thread
+        self.assertEqual(len(duckdb_db.storage.cursors), cursor_count, "Cursor of a finished thread not released")
+        duckdb_db.close()
+
+    def test_rollups(self):
+        self.ingest_and_flush(*(hawk_json(1234, f"2024-06-01 {12 + minute // 60}:{minute % 60:02}:00", weather_station_payload(55, 18.25), hive_payload(1, weight=weight))
+                                for minute, weight in ((0, 40), (30, 42), (90, 50))))
+        hourly = self.db.fetch_field(1234, 1, "weight", resolution="hourly")
+        self.assertEqual(hourly, {"time": [1717243200, 1717246800], "weight": [41, 50], "weight_min": [40, 50], "weight_max": [42, 50]})
+        daily = self.db.fetch_field(1234, 1, "weight", resolution="daily")
+        self.assertEqual(daily["weight"], [44])
+        self.db.rebuild_rollups()
+        self.assertEqual(self.db.fetch_field(1234, 1, "weight", resolution="hourly"), hourly)
+        self.assertEqual(self.db.fetch_field(1234, 1, "weight", resolution="auto")["weight"], [44])
+        self.assertEqual(self.db.fetch_field(1234, 1, "weight", end_time=1717250000, resolution="auto")["weight"], [40, 42, 50])
+
+    def test_fetch_fields(self):
+        self.ingest_and_flush(*(hawk_json(1234, f"2024-06-01 {hour}:00:00", weather_station_payload(55, 18.25), hive_payload(1, weight=40), hive_payload(2, weight=50))
+                                for hour in (12, 13)))
+        data = self.db.fetch_fields(1234, [1, 2], ["weight", "humidity"])
+        self.assertEqual(data["hives"]["2"], {"time": [1717243200, 1717246800], "weight": [50, 50], "humidity": [60, 60]})
+        self.assertEqual(sorted(self.db.fetch_fields(1234, None, ["weight"])["hives"]), ["1", "2"])
+        daily = self.db.fetch_fields(1234, [1], ["weight", "humidity"], resolution="daily")
+        self.assertEqual(daily["hives"], {"1": {"time": [1717200000], "weight": [40], "weight_min": [40], "weight_max": [40],
+                                                "humidity": [60], "humidity_min": [60], "humidity_max": [60]}})
+        self.assertRaises(KeyError, self.db.fetch_fields, 1234, [1], ["weight; DROP TABLE Data"])
+
+    def test_data_to_csv(self):
+        self.ingest_and_flush(hawk_json(1234, "2024-06-01 12:00:00", weather_station_payload(55, 18.25), hive_payload(1), hive_payload(2)),
+                              hawk_json(1234, "2024-06-01 13:00:00", weather_station_payload(55, 18.25), hive_payload(1)))
+        lines = "".join(self.db.data_to_csv(1234, chunk_size=2)).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0], "1234,55,18.25,1717243200,1,21.5,22.5,23.5,60,40.2,0,10,12,250")
+        self.assertEqual(len("".join(self.db.data_to_csv(1234, start_time=1717246800, hive_number=1)).splitlines()), 1)
+
+    @unittest.skipIf(database.pyarrow is None, "PyArrow isn't installed")
+    def test_export_arrow_and_parquet(self):
+        self.ingest_and_flush(*(hawk_json(1234, f"2024-06-01 {hour}:00:00", weather_station_payload(55, 18.25), hive_payload(1)) for hour in range(12, 17)))
+        stream = b"".join(self.db.export_data(1234, "arrow", chunk_size=2))
+        self.assertEqual(database.pyarrow.ipc.open_stream(stream).read_all().column("time").to_pylist(), list(range(1717243200, 1717261200, 3600)))
+        parquet_file = database.pyarrow.parquet.ParquetFile(io.BytesIO(b"".join(self.db.export_data(1234, "parquet", chunk_size=2))))
+        self.assertEqual(parquet_file.metadata.num_row_groups, 3)
+        self.assertEqual(parquet_file.read().num_rows, 5)
+        self.assertRaises(KeyError, self.db.export_data, 1234, "xls")
+
+    @unittest.skipIf(database.numpy is None, "NumPy isn't installed")
+    def test_export_npz_needs_a_time_range(self):
+        self.ingest_and_flush(*(hawk_json(1234, f"2024-06-01 {hour}:00:00", weather_station_payload(55, 18.25), hive_payload(1)) for hour in range(12, 15)))
+        self.assertRaises(ValueError, self.db.export_data, 1234, "npz")
+        self.assertRaises(ValueError, self.db.export_data, 1234, "npz", 0, database.NPZ_MAX_TIME_RANGE + 1)
+        archive = database.numpy.load(io.BytesIO(b"".join(self.db.export_data(1234, "npz", 1717243200, 1717254000, chunk_size=2))))
+        self.assertEqual(list(archive["time"]), [1717243200, 1717246800, 1717250400])
+
+    def test_ingest_and_queries_are_measured(self):
+        rows_written = database.ROWS_WRITTEN.values.get((), 0)
+        self.ingest_and_flush(hawk_json(1234, "2024-06-01 12:00:00", weather_station_payload(55, 18.25), hive_payload(1), hive_payload(2)))
+        self.db.fetch_field(1234, 1, "weight")
+        self.assertEqual(database.ROWS_WRITTEN.values[()], rows_written + 2)
+        histogram = metrics.Histogram("test_seconds", "Test histogram.", ("query",), buckets=(0.1, 1))
+        histogram.observe(0.5, query='say "hi"')
+        histogram.observe(5, query='say "hi"')
+        text = metrics.render()
+        self.assertIn('test_seconds_bucket{query="say \\"hi\\"",le="0.1"} 0', text)
+        self.assertIn('test_seconds_bucket{query="say \\"hi\\"",le="1"} 1', text)
+        self.assertIn('test_seconds_bucket{query="say \\"hi\\"",le="+Inf"} 2', text)
+        self.assertIn('test_seconds_sum{query="say \\"hi\\""} 5.5', text)
+        self.assertIn('ibuzz_query_seconds_count{query="fetch_field"}', text)
+        metrics.REGISTRY.remove(histogram)
+
+    def test_error_logger_aggregates_and_rotates(self):
+        log = error_logger.ErrorLogger("errors.txt", max_size=200, backup_count=1, rate_window=60)
+        # Different data is counted as the same error.
+        for i in range(5):
+            data = base64.b64encode(bytes([i + 1]) * 15).decode()
+            with self.assertRaises(ValueError) as context:
+                encoded_data.decode_payload(data)
+            log.log(context.exception, 1234, data)
+        log.log(ValueError("data doesn't match any payload format"), 5678, "AAAA" * 100)
+        log.log("Disk full", details={"path": "errors.txt"})
+        log.close()
+        self.assertTrue(os.path.exists("errors.txt.1"), "Error log wasn't rotated")
+        records = []
+        for path in ("errors.txt.1", "errors.txt"):
+            if os.path.exists(path):
+                with open(path) as errors:
+                    records.extend(json.loads(line) for line in errors)
+        self.assertEqual([(record["type"], record.get("serial_number"), record.get("repeated")) for record in records],
+                         [("ValueError", "1234", None), ("ValueError", "5678", None), ("message", None, None), ("ValueError", "1234", 4)])
+        self.assertEqual(records[0]["payload"], base64.b64encode(bytes([1]) * 15).decode())
+        self.assertEqual(len(records[1]["payload"]), error_logger.PAYLOAD_FRAGMENT_LENGTH)
+        self.assertEqual(records[2]["details"], {"path": "errors.txt"})
+
+    def test_bad_payloads_are_skipped(self):
+        self.ingest_and_flush(hawk_json(1234, "2024-06-01 12:00:00", weather_station_payload(55, 18.25), "AAAA", hive_payload(1)))
+        self.assertEqual(self.db.fetch_hive_numbers(1234), [1])
+
+    def test_replay_log_rotates_into_compressed_segments(self):
+        log = replay_log.ReplayLog("logs", max_segment_size=1, flush_interval=0.01)
+        with open(os.path.join("logs", "1234.txt"), "w") as legacy:
+            legacy.write(str(hawk_json(1234, "2024-06-01 11:00:00", hive_payload(1))) + "\n")
+        start_time = time.time()
+        for hour in range(12, 18):
+            log.add_to_log(1234, hawk_json(1234, f"2024-06-01 {hour}:00:00", hive_payload(1)))
+            time.sleep(0.01)
+        log.add_to_log("../1234", {})
+        log.close()
+        self.assertFalse(os.path.exists(os.path.join("logs", "1234.jsonl")))
+        log = replay_log.ReplayLog("logs")
+        segments = log.segments(1234)
+        self.assertEqual(len(segments), 6, "Segments weren't rotated by size")
+        self.assertEqual(sum(segment["lines"] for segment in segments), 6)
+        self.assertTrue(all(segment["start_time"] <= segment["end_time"] < start_time + 1 for segment in segments))
+        lines = list(log.read(1234))
+        dates = [replay_log.decode_line(line)[1]["Records"][0]["DateUTC"] for line in lines]
+        self.assertEqual(dates, [f"2024-06-01 {hour}:00:00" for hour in range(11, 18)])
+        self.assertEqual(replay_log.decode_line(lines[0])[0], None)
+        middle = list(log.read(1234, segments[1]["start_time"], segments[3]["start_time"]))
+        self.assertEqual(middle, lines[2:4], "Wrong lines returned for the time range")
+        log.close()
+
+    def test_replay_log_reads_segments_that_failed_to_compress(self):
+        log = replay_log.ReplayLog("logs", max_segment_size=1, flush_interval=0.01)
+
+        def fail(rotated_path):
+            raise OSError("No space left on device")
+
+        log._compress = fail
+        log.add_to_log(1234, hawk_json(1234, "2024-06-01 12:00:00", hive_payload(1)))
+        log.close()
+        self.assertEqual(len(log.failed), 1)
+        self.assertTrue(log.exists(1234))
+        self.assertEqual(len(list(log.read(1234))), 1, "Segment that failed to compress not read")
+        log = replay_log.ReplayLog("logs")
+        log.close()
+        self.assertEqual(len(log.segments(1234)), 1, "Segment not compressed by the next run")
+        self.assertEqual(len(list(log.read(1234))), 1)
+
+    def test_backfill_from_replay_logs(self):
+        log = replay_log.ReplayLog("logs", max_segment_size=1)
+        with open(os.path.join("logs", "1234.txt"), "w") as legacy:
+            legacy.write(str(hawk_json(1234, "2024-06-01 11:00:00", weather_station_payload(55, 18.25), hive_payload(1, weight=30))) + "\n")
+        log.add_to_log(1234, hawk_json(1234, "2024-06-01 12:00:00", weather_station_payload(55, 18.25), hive_payload(1), hive_payload(2)))
+        log.close()
+        log = replay_log.ReplayLog("logs")
+        log.add_to_log(1234, hawk_json(1234, "2024-06-01 13:00:00", weather_station_payload(55, 18.25), hive_payload(1, weight=41)))
+        log.add_to_log(1234, {"SerNo": 1234})
+        log.close()
+        checkpoint = backfill.Checkpoint("checkpoint.json")
+        totals = backfill.backfill(["logs"], self.db.storage, checkpoint, workers=2, chunk_size=1)
+        self.assertEqual(totals, {"lines": 4, "failed": 1, "rows": 4})
+        self.assertRaises(RuntimeError, database.lock_database, "database_test.db", exclusive=True)
+        lock = database.lock_database("backfilled.db", exclusive=True)
+        self.assertRaises(RuntimeError, database.Database, "backfilled.db")
+        self.assertFalse(os.path.exists("backfilled.db"), "Database created while it was being backfilled")
+        lock.close()
+        self.assertEqual(self.db.fetch_field(1234, 1, "weight")["weight"], [30, 40.2, 41])
+        self.assertEqual(self.db.fetch_hive_numbers(1234), [1, 2])
+        # Resuming reads nothing again, and reading everything again doesn't duplicate rows.
+        totals = backfill.backfill(["logs"], self.db.storage, backfill.Checkpoint("checkpoint.json"), workers=1)
+        self.assertEqual(totals["lines"], 0)
+        backfill.backfill(["logs"], self.db.storage, workers=1)
+        self.assertEqual(self.db.fetch_field(1234, 1, "weight")["weight"], [30, 40.2, 41])
+
+    def tearDown(self):
+        self.db.close()
+        os.chdir(self.working_directory)
+        self.directory.cleanup()
+
+
 if __name__ == '__main__':
     unittest.main()
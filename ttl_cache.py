@@ -0,0 +1,41 @@
+import threading
+import time
+
+
+class TTLCache:
+
+    def __init__(self, ttl=60):
+        """Hold values for at most ttl seconds.
+
+        :param float ttl: number of seconds a value is kept before it is loaded again"""
+        self.ttl = ttl
+        self.values = {}
+        # Incremented on every invalidation so that a value loaded before an invalidation isn't stored after it.
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def fetch(self, key, load):
+        """Return the value stored for key, calling load() to get and store it if it is missing or expired."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.values.get(key)
+            generation = self.generation
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        value = load()
+        with self.lock:
+            if generation == self.generation:
+                self.values[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self, key):
+        """Forget the value stored for key."""
+        with self.lock:
+            self.values.pop(key, None)
+            self.generation += 1
+
+    def clear(self):
+        """Forget every value."""
+        with self.lock:
+            self.values.clear()
+            self.generation += 1